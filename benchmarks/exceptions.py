@@ -0,0 +1,75 @@
+"""Time signalling an exception caught by the nearest handler, at the
+bottom of deeper and deeper recursions with every level wrapped in an
+on:do: of its own, in the interpreter and the virtual machine.
+
+    python -m benchmarks.exceptions [max depth] [signals]
+
+The time to recurse to the depth is measured without signalling and
+subtracted, so what is reported is the time per signal.  Finding the
+handler and unwinding to it shouldn't depend on the depth.
+"""
+import sys
+import time
+
+from onyx.interpreter import Interpreter
+from onyx.vm import VirtualMachine
+
+SOURCE = '''
+Error subclass: DeepError [ ]
+
+Object subclass: Deep [
+    down: depth signals: count [
+        depth = 0 ifTrue: [ ^ self signals: count ].
+        ^ [ self down: depth - 1 signals: count ]
+              on: DeepError do: [:e | 0 ]
+    ]
+
+    signals: count [
+        | caught |
+        caught := 0.
+        1 to: count do: [:i |
+            caught := caught + ([ Error signal: 'deep' ]
+                                    on: Error do: [:e | 1 ]) ].
+        ^ caught
+    ]
+]
+'''
+
+
+def best_time(function, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        function()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def per_signal(interpreter, depth, signals):
+    def run(count):
+        source = 'Deep new down: {0} signals: {1}'.format(depth, count)
+        return lambda: interpreter.evaluate(source)
+    return (best_time(run(signals)) - best_time(run(0))) / signals
+
+
+def main(max_depth=800, signals=200):
+    interpreters = [('interpreter', Interpreter()),
+                    ('vm', VirtualMachine())]
+    for _, interpreter in interpreters:
+        interpreter.bootstrap()
+        interpreter.load_source(SOURCE)
+    print('{0:>6} '.format('depth') + ' '.join(
+        '{0:>16}'.format(name + ' (us)') for name, _ in interpreters))
+    depth = 0
+    while depth <= max_depth:
+        print('{0:>6} '.format(depth) + ' '.join(
+            '{0:>16.1f}'.format(
+                per_signal(interpreter, depth, signals) * 1e6)
+            for _, interpreter in interpreters))
+        depth = depth * 2 if depth else 25
+
+
+if __name__ == '__main__':
+    main(*[int(argument) for argument in sys.argv[1:]])
@@ -0,0 +1,60 @@
+"""Time an edit to one method body of a Document against re-parsing the
+whole file, for files made of more and more copies of system.ost.
+
+    python -m benchmarks.incremental [max copies]
+"""
+import os
+import sys
+import time
+
+from onyx.cache import parse_source
+from onyx.incremental import Document
+
+SYSTEM = os.path.join(os.path.dirname(__file__), '..', 'system.ost')
+
+
+def best_time(function, repeat=5, number=20):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        for _ in range(number):
+            function()
+        elapsed = (time.time() - start) / number
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def edit_middle_method(document):
+    # the start of the body of a method halfway through the file
+    definitions = [d for d in document.definitions
+                   if getattr(d, 'methods', None)]
+    methods = definitions[len(definitions) // 2].methods
+    start, end = methods[len(methods) // 2].span
+    offset = document.source.index('[', start) + 1
+
+    def edit():
+        document.edit(offset, 0, ' 1 .')
+        document.edit(offset, 4, '')
+    return edit
+
+
+def main(max_copies=32):
+    with open(SYSTEM) as f:
+        system = f.read()
+    print('{0:>6} {1:>10} {2:>12} {3:>12}'.format(
+        'copies', 'bytes', 'parse (ms)', 'edit (ms)'))
+    copies = 1
+    while copies <= max_copies:
+        source = system * copies
+        document = Document(source)
+        parse = best_time(lambda: parse_source(source), repeat=3, number=1)
+        # each round trip is two edits
+        edit = best_time(edit_middle_method(document)) / 2
+        print('{0:>6} {1:>10} {2:>12.2f} {3:>12.3f}'.format(
+            copies, len(source), parse * 1000, edit * 1000))
+        copies *= 2
+
+
+if __name__ == '__main__':
+    main(*[int(argument) for argument in sys.argv[1:]])
@@ -0,0 +1,58 @@
+"""Sources to benchmark on: system.ost and generated ones, each stressing
+one shape of code.  The generated sizes are multiplied by scale.
+
+An input is either a whole file ('file', parsed with parse_file) or the
+statements of a method body ('code', parsed with parse_executable_code).
+"""
+import os
+
+SYSTEM = os.path.join(os.path.dirname(__file__), '..', 'system.ost')
+
+
+def system(scale=1):
+    with open(SYSTEM) as f:
+        source = f.read()
+    return source * max(int(scale), 1)
+
+
+def wide(scale=1):
+    # many short statements
+    return ' .\n'.join('x{0} := y{0} foo: {0} bar: z + {0}'.format(i)
+                       for i in range(int(2000 * scale)))
+
+
+def deep(scale=1, depth=60):
+    # statements of blocks nested inside blocks.  The parser recurses a few
+    # frames per level, so depth stays well inside the recursion limit.
+    nested = '[:a | ' * depth + 'a' + ' ]' * depth
+    return ' .\n'.join([nested] * int(40 * scale))
+
+
+def cascade(scale=1):
+    # one receiver sent a long cascade of mixed messages
+    messages = ['foo', '+ 1', 'at: 1 put: 2']
+    return 'x ' + ' ; '.join(messages[i % 3]
+                             for i in range(int(3000 * scale)))
+
+
+def keyword(scale=1):
+    # one keyword message with many parts
+    return 'x ' + ' '.join('at{0}: {0}'.format(i)
+                           for i in range(int(3000 * scale)))
+
+
+def headers(scale=1):
+    # method headers one after another, for parse_method_header
+    forms = ['foo', '+ other', 'at: index put: value', 'bar']
+    return ' '.join(forms[i % 4] for i in range(int(4000 * scale)))
+
+
+# name -> (generator, kind)
+INPUTS = {
+    'system': (system, 'file'),
+    'wide': (wide, 'code'),
+    'deep': (deep, 'code'),
+    'cascade': (cascade, 'code'),
+    'keyword': (keyword, 'code'),
+    'headers': (headers, 'headers'),
+}
@@ -0,0 +1,281 @@
+"""Measure the throughput of the stream, the readers and the parser.
+
+    python -m benchmarks [-o results.json] [-c baseline.json] [-k filter]
+
+Each benchmark runs on each of its inputs (see benchmarks.inputs) in a
+fresh process, so the peak RSS reported is its own.  Throughput is
+reported as the mean and standard deviation over the timed runs, in
+units per second.  Results are saved as JSON; given a baseline saved by
+an earlier run, cases that got slower by more than the threshold (and by
+more than the noise) are flagged and the exit status is 1.
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import sys
+import tempfile
+import time
+import timeit
+
+from onyx.parser import Parser
+from onyx.reader import FastReader, Reader, StringReader
+from onyx.term import Node
+from onyx.util.stream import Stream
+
+from .inputs import INPUTS
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+
+
+def count_terms(terms):
+    count = 0
+    for term in terms:
+        count += 1
+        if term.is_compound:
+            count += count_terms(term.value)
+    return count
+
+
+def count_nodes(value):
+    if isinstance(value, Node):
+        return 1 + sum(count_nodes(getattr(value, name))
+                       for name in value._fields)
+    elif isinstance(value, (list, tuple)):
+        return sum(count_nodes(item) for item in value)
+    return 0
+
+
+# Each benchmark takes the source and its kind, does any setup and returns
+# a function that runs once, and one that counts the units in what it
+# returned (which isn't timed).  Files a benchmark makes go in
+# _temporary_files, which run_case removes once the case has run (atexit
+# handlers don't run in the processes run_isolated starts).
+
+_temporary_files = []
+
+
+def stream_sequence(source, kind):
+    def run():
+        count = 0
+        for _ in Stream.from_sequence(source):
+            count += 1
+        return count
+    return run, int
+
+
+def stream_file(source, kind):
+    fd, filename = tempfile.mkstemp(suffix='.ost')
+    _temporary_files.append(filename)
+    with os.fdopen(fd, 'w') as f:
+        f.write(source)
+
+    def run():
+        count = 0
+        for _ in Stream.from_file(filename):
+            count += 1
+        return count
+    return run, int
+
+
+def _reader_benchmark(make_reader):
+    def benchmark(source, kind):
+        def run():
+            reader = make_reader(source)
+            terms = []
+            while True:
+                term = reader.read_term()
+                if term.is_eof:
+                    return terms
+                terms.append(term)
+        return run, count_terms
+    return benchmark
+
+
+def parser(source, kind):
+    # the terms are read beforehand, so only the parser is timed
+    terms = list(FastReader(source))
+
+    def run():
+        parser = Parser(list(terms))
+        if kind == 'file':
+            return list(parser.parse_file())
+        elif kind == 'code':
+            return parser.parse_executable_code()
+        headers = []
+        while not parser.at_end():
+            headers.append(parser.parse_method_header())
+        return headers
+    return run, count_nodes
+
+
+def _count_headers(headers):
+    return sum(1 + len(arguments) for _, arguments in headers)
+
+
+def headers(source, kind):
+    run, _ = parser(source, kind)
+    return run, _count_headers
+
+
+# name -> (benchmark, unit, input names)
+_code_inputs = ('system', 'wide', 'deep', 'cascade', 'keyword')
+BENCHMARKS = {
+    'stream.sequence': (stream_sequence, 'chars', _code_inputs),
+    'stream.file': (stream_file, 'chars', ('system',)),
+    'reader.stream': (
+        _reader_benchmark(lambda s: Reader(Stream.from_sequence(s))),
+        'tokens', _code_inputs),
+    'reader.string': (_reader_benchmark(StringReader), 'tokens',
+                      _code_inputs),
+    'reader.fast': (_reader_benchmark(FastReader), 'tokens', _code_inputs),
+    'parser': (parser, 'nodes', _code_inputs),
+    'parser.headers': (headers, 'nodes', ('headers',)),
+}
+
+
+def cases(pattern=None):
+    for name in sorted(BENCHMARKS):
+        for input_name in BENCHMARKS[name][2]:
+            key = '{0}/{1}'.format(name, input_name)
+            if pattern is None or pattern in key:
+                yield key, name, input_name
+
+
+def mean(values):
+    return sum(values) / len(values)
+
+
+def stddev(values):
+    if len(values) < 2:
+        return 0.0
+    m = mean(values)
+    return math.sqrt(sum((v - m) ** 2 for v in values) / (len(values) - 1))
+
+
+def peak_rss():
+    # in kilobytes, or None where it can't be had
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss //= 1024
+    return rss
+
+
+def run_case(name, input_name, repeat=5, scale=1):
+    benchmark, unit, _ = BENCHMARKS[name]
+    generate, kind = INPUTS[input_name]
+    try:
+        run, count = benchmark(generate(scale), kind)
+        units = count(run())
+        rates = []
+        for _ in range(repeat):
+            start = timeit.default_timer()
+            run()
+            rates.append(units / (timeit.default_timer() - start))
+    finally:
+        while _temporary_files:
+            os.remove(_temporary_files.pop())
+    return {'unit': '{0}/s'.format(unit), 'units': units,
+            'mean': mean(rates), 'stddev': stddev(rates), 'rates': rates,
+            'peak_rss_kb': peak_rss()}
+
+
+def _run_child(connection, arguments):
+    try:
+        connection.send((True, run_case(*arguments)))
+    except Exception as e:
+        connection.send((False, '{0}: {1}'.format(e.__class__.__name__, e)))
+    connection.close()
+
+
+def run_isolated(*arguments):
+    if multiprocessing is None:
+        return run_case(*arguments)
+    parent, child = multiprocessing.Pipe(False)
+    process = multiprocessing.Process(target=_run_child,
+                                      args=(child, arguments))
+    process.start()
+    ok, result = parent.recv()
+    process.join()
+    if not ok:
+        raise RuntimeError(result)
+    return result
+
+
+def compare(baseline, results, threshold=0.1):
+    # (key, baseline mean, mean, relative change, is a regression) for the
+    # cases in both
+    rows = []
+    for key in sorted(results):
+        if key not in baseline:
+            continue
+        old, new = baseline[key], results[key]
+        change = float(new['mean'] - old['mean']) / old['mean']
+        slower = old['mean'] - new['mean']
+        regression = (-change > threshold and
+                      slower > old['stddev'] + new['stddev'])
+        rows.append((key, old['mean'], new['mean'], change, regression))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks', description=__doc__.split('\n')[0])
+    parser.add_argument('-o', '--output', help='save results to this file')
+    parser.add_argument('-c', '--compare', metavar='BASELINE',
+                        help='compare with results saved earlier')
+    parser.add_argument('-t', '--threshold', type=float, default=0.1,
+                        help='slowdown flagged as a regression '
+                             '(default: %(default)s)')
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    parser.add_argument('-s', '--scale', type=float, default=1,
+                        help='multiply the size of the inputs')
+    parser.add_argument('-k', dest='pattern',
+                        help='only run cases whose name contains this')
+    parser.add_argument('--in-process', action='store_true',
+                        help="don't run each case in a fresh process")
+    options = parser.parse_args(argv)
+
+    run = run_case if options.in_process else run_isolated
+    results = {}
+    for key, name, input_name in cases(options.pattern):
+        result = results[key] = run(name, input_name, options.repeat,
+                                    options.scale)
+        print('{0:<28} {1:>12.0f} {2:<9} +-{3:>5.1f}%  {4:>8} KB'.format(
+            key, result['mean'], result['unit'],
+            100 * result['stddev'] / result['mean'],
+            result['peak_rss_kb']))
+        sys.stdout.flush()
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump({'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'repeat': options.repeat, 'scale': options.scale,
+                       'results': results}, f, indent=2, sort_keys=True)
+
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)['results']
+        regressions = 0
+        print('')
+        for key, old, new, change, regression in compare(
+                baseline, results, options.threshold):
+            regressions += regression
+            print('{0:<28} {1:>12.0f} {2:>12.0f} {3:>+7.1%}{4}'.format(
+                key, old, new, change, '  REGRESSION' if regression else ''))
+        if regressions:
+            return 1
+    return 0
@@ -0,0 +1,259 @@
+from .term import (AssignTerm, BinarySend, BlockTerm, CascadeSend,
+                   EscapeTerm, Identifier, KeywordSend, UnarySend)
+
+# Static analyses of method and block bodies, shared by the interpreter and
+# the compilers.
+
+SEND_CLASSES = (UnarySend, BinarySend, KeywordSend)
+
+
+def children(node):
+    # the nodes directly inside node, in evaluation order
+    cls = node.__class__
+    if cls is EscapeTerm:
+        return [node.term]
+    elif cls is AssignTerm:
+        return [node.rhs]
+    elif cls is CascadeSend:
+        nodes = [node.receiver]
+        for message in node.messages:
+            nodes.extend(message.arguments)
+        return nodes
+    elif cls is BlockTerm:
+        return list(node.statements)
+    elif cls in SEND_CLASSES:
+        return [node.receiver] + list(node.arguments)
+    return []
+
+
+def has_block_return(statements):
+    # whether a block in statements has a ^ in it, so could return from
+    # the method the statements are the body of
+    def visit(node, in_block):
+        if node.__class__ is EscapeTerm and in_block:
+            return True
+        in_block = in_block or node.__class__ is BlockTerm
+        return any(visit(child, in_block) for child in children(node))
+    return any(visit(statement, False) for statement in statements)
+
+
+def is_super(node):
+    return node.__class__ is Identifier and node.name == 'super'
+
+
+def tail_position(statements, is_method):
+    # The index in a body's statements of its tail send, the send whose
+    # value the body returns as the last thing it does: its last statement
+    # (or, in a method, a ^ statement, which ends the body) being a send.
+    # None if there is none.
+    #
+    # A tail send can reuse the body's activation, unless something still
+    # needs that: a method's, if a block in it can ^ return from it, so
+    # methods with those have no tail send.  Super sends and cascades aren't
+    # counted.  It is an index rather than the node because interned nodes
+    # can appear more than once in a body.
+    if is_method and has_block_return(statements):
+        return None
+    for index, statement in enumerate(statements):
+        if statement.__class__ is EscapeTerm:
+            if not is_method:
+                return None
+            statement = statement.term
+            break
+    else:
+        if not statements:
+            return None
+    if statement.__class__ in SEND_CLASSES and not is_super(
+            statement.receiver):
+        return index
+    return None
+
+
+# The selectors the compilers inline when they are sent with literal blocks,
+# as branches and loops that only fall back to the send for receivers that
+# aren't Booleans, nil or SmallInts.  Each maps to how many arguments its
+# blocks take, and whether its receiver is a literal block too.
+INLINED_SELECTORS = {
+    'ifTrue:': ((0,), False),
+    'ifFalse:': ((0,), False),
+    'ifTrue:ifFalse:': ((0, 0), False),
+    'ifFalse:ifTrue:': ((0, 0), False),
+    'and:': ((0,), False),
+    'or:': ((0,), False),
+    'ifNil:': ((0,), False),
+    'ifNotNil:': ((0,), False),
+    'ifNil:ifNotNil:': ((0, 0), False),
+    'whileTrue:': ((0,), True),
+    'whileFalse:': ((0,), True),
+    'to:do:': ((None, 1), False),
+}
+
+
+def _is_literal_block(node, argument_count):
+    # blocks with temporaries aren't inlined, as they would need clearing
+    # each time round
+    return (node.__class__ is BlockTerm and
+            len(node.arguments) == argument_count and
+            not node.temporary_variables)
+
+
+def is_inlined(node):
+    # whether the compilers inline the send node
+    if node.__class__ is not KeywordSend or is_super(node.receiver):
+        return False
+    entry = INLINED_SELECTORS.get(node.message)
+    if entry is None:
+        return False
+    counts, block_receiver = entry
+    if block_receiver and not _is_literal_block(node.receiver, 0):
+        return False
+    for argument, count in zip(node.arguments, counts):
+        if count is not None and not _is_literal_block(argument, count):
+            return False
+    if node.message == 'to:do:':
+        # the loop variable becomes a local of the code the loop is in,
+        # which must be the only one changing it, and as there is one
+        # variable for every time round, no block may capture it
+        body = node.arguments[1]
+        name = body.arguments[0].name
+        return not any(_assigns_or_captures(statement, name, False)
+                       for statement in body.statements)
+    return True
+
+
+def inlined_children(node):
+    # children(node), but with the literal blocks of an inlined send
+    # replaced by their statements, which run in the code the send is in
+    if not is_inlined(node):
+        return children(node)
+    nodes = []
+    if INLINED_SELECTORS[node.message][1]:
+        nodes.extend(node.receiver.statements)
+    else:
+        nodes.append(node.receiver)
+    for argument in node.arguments:
+        if argument.__class__ is BlockTerm:
+            nodes.extend(argument.statements)
+        else:
+            nodes.append(argument)
+    return nodes
+
+
+def _assigns_or_captures(node, name, in_block):
+    cls = node.__class__
+    if cls is AssignTerm and node.lhs.name == name:
+        return True
+    if cls is Identifier:
+        return in_block and node.name == name
+    in_block = in_block or cls is BlockTerm
+    return any(_assigns_or_captures(child, name, in_block)
+               for child in inlined_children(node))
+
+
+# What the code making a block does with its closure.  This is all that is
+# looked at: a block passed down can still be stored by the method it is
+# passed to and called after the code making it has returned, so
+# PASSED_DOWN doesn't prove a block doesn't escape.
+PASSED_DOWN = 'passed-down'
+READ_ONLY = 'read-only'
+ESCAPING = 'escaping'
+
+
+class BlockInfo(object):
+    # What classify_blocks finds out about a block: captured are the
+    # variables of the code around it that it (or a block in it) uses,
+    # assigned those of them it assigns, and closed_over its own arguments
+    # and temporaries that a block inside it uses.  escapes is whether the
+    # code making it lets its closure escape: stores it, returns it or has
+    # it as its value, rather than only passing it down as the receiver or
+    # an argument of a send, or dropping it.
+    __slots__ = ('escapes', 'captured', 'assigned', 'closed_over')
+
+    def __init__(self):
+        self.escapes = False
+        self.captured = set()
+        self.assigned = set()
+        self.closed_over = set()
+
+    @property
+    def kind(self):
+        if not self.escapes:
+            return PASSED_DOWN
+        elif self.assigned:
+            return ESCAPING
+        return READ_ONLY
+
+
+def classify_blocks(statements, names=()):
+    # {id(block node): its BlockInfo} for the blocks in a body, which
+    # declares names, not counting the literal blocks of inlined sends,
+    # whose statements are part of the code they are in.  An interned block
+    # appearing more than once gets the one BlockInfo covering all of them.
+    infos = {}
+
+    def resolve(name, scopes, assigned):
+        for index in range(len(scopes) - 1, -1, -1):
+            info, declared = scopes[index]
+            if name in declared:
+                break
+        else:
+            return
+        if info is not None and index < len(scopes) - 1:
+            info.closed_over.add(name)
+        for inner, _ in scopes[index + 1:]:
+            if inner is not None:
+                inner.captured.add(name)
+                if assigned:
+                    inner.assigned.add(name)
+
+    def visit_body(statements, scopes, escapes):
+        # the last statement's value is the body's, which escapes if the
+        # body's does
+        last = len(statements) - 1
+        for index, statement in enumerate(statements):
+            visit(statement, scopes, escapes and index == last)
+
+    def visit(node, scopes, escapes):
+        cls = node.__class__
+        if cls is Identifier:
+            resolve(node.name, scopes, False)
+        elif cls is AssignTerm:
+            resolve(node.lhs.name, scopes, True)
+            visit(node.rhs, scopes, True)
+        elif cls is EscapeTerm:
+            visit(node.term, scopes, True)
+        elif cls is BlockTerm:
+            info = infos.get(id(node))
+            if info is None:
+                info = infos[id(node)] = BlockInfo()
+            info.escapes = info.escapes or escapes
+            declared = set(a.name for a in node.arguments)
+            declared.update(t.name for t in node.temporary_variables)
+            visit_body(node.statements, scopes + [(info, declared)], True)
+        elif cls is CascadeSend:
+            for child in children(node):
+                visit(child, scopes, False)
+        elif is_inlined(node):
+            visit_inlined(node, scopes, escapes)
+        elif cls in SEND_CLASSES:
+            for child in children(node):
+                visit(child, scopes, False)
+
+    def visit_inlined(node, scopes, escapes):
+        if INLINED_SELECTORS[node.message][1]:
+            visit_body(node.receiver.statements, scopes, False)
+        else:
+            visit(node.receiver, scopes, False)
+        for argument in node.arguments:
+            if argument.__class__ is not BlockTerm:
+                visit(argument, scopes, False)
+            elif argument.arguments:
+                # to:do:'s variable, a local of the code the loop is in
+                declared = set([argument.arguments[0].name])
+                visit_body(argument.statements, scopes + [(None, declared)],
+                           False)
+            else:
+                visit_body(argument.statements, scopes, escapes)
+
+    visit_body(statements, [(None, set(names))], True)
+    return infos
@@ -0,0 +1,147 @@
+import hashlib
+import marshal
+import os
+import sys
+import tempfile
+
+from .location import LineIndex, SourceError
+from .parser import Parser
+from .reader import FastReader
+from .term import (AssignTerm, BinarySend, BlockTerm, CascadeSend, ClassTerm,
+                   EscapeTerm, Identifier, KeywordSend, LiteralTerm,
+                   MethodTerm, Node, UnarySend)
+
+# Bump FORMAT_VERSION whenever the node classes or their encoding change.
+# marshal's format belongs to the Python version, so that is part of the
+# header as well.
+FORMAT_VERSION = 2
+MAGIC = 'onyxc'
+CACHE_DIRECTORY = '__onyxcache__'
+
+# A node is encoded as a tuple of its class's index in this list, its
+# encoded fields and then its start and end.  Lists are encoded as lists,
+# so a tuple always starts a node.  Every node class takes its fields as
+# positional arguments.
+NODE_CLASSES = [Identifier, UnarySend, BinarySend, KeywordSend, CascadeSend,
+                AssignTerm, BlockTerm, EscapeTerm, LiteralTerm, MethodTerm,
+                ClassTerm]
+_node_codes = dict((cls, code) for code, cls in enumerate(NODE_CLASSES))
+
+
+class CacheError(Exception):
+    pass
+
+
+def encode(value):
+    if isinstance(value, Node):
+        cls = value.__class__
+        encoded = [_node_codes[cls]]
+        encoded.extend(encode(getattr(value, name)) for name in cls._fields)
+        encoded.append(value.start)
+        encoded.append(value.end)
+        return tuple(encoded)
+    elif isinstance(value, (list, tuple)):
+        return [encode(item) for item in value]
+    return value
+
+
+def decode(value):
+    if isinstance(value, tuple):
+        cls = NODE_CLASSES[value[0]]
+        node = cls(*[decode(item) for item in value[1:-2]])
+        node.start, node.end = value[-2:]
+        return node
+    elif isinstance(value, list):
+        return [decode(item) for item in value]
+    return value
+
+
+def source_key(source):
+    return hashlib.sha1(source).hexdigest()
+
+
+def cache_path(filename, cache_dir=None):
+    directory, name = os.path.split(os.path.abspath(filename))
+    if cache_dir is None:
+        cache_dir = os.path.join(directory, CACHE_DIRECTORY)
+    return os.path.join(cache_dir, '{0}.py{1}{2}.onyxc'.format(
+        name, *sys.version_info[:2]))
+
+
+def _header():
+    return (MAGIC, FORMAT_VERSION, tuple(sys.version_info[:2]))
+
+
+def read_marshalled(path, key):
+    # what write_marshalled wrote to path under key, or None if the file
+    # is missing, unreadable, stale or from another version
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except (IOError, OSError):
+        return None
+    try:
+        header, cached_key, payload = marshal.loads(data)
+    except (EOFError, ValueError, TypeError):
+        return None
+    if header != _header() or cached_key != key:
+        return None
+    return payload
+
+
+def write_marshalled(path, key, payload):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    data = marshal.dumps((_header(), key, payload))
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        # rename is atomic on POSIX; os.replace is needed on Windows, where
+        # rename refuses to overwrite
+        getattr(os, 'replace', os.rename)(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def read_cache(path, key):
+    definitions = read_marshalled(path, key)
+    if definitions is None:
+        return None
+    return [decode(definition) for definition in definitions]
+
+
+def write_cache(path, key, definitions):
+    write_marshalled(path, key,
+                     [encode(definition) for definition in definitions])
+
+
+def parse_source(source, reader_class=FastReader, parser_class=Parser,
+                 filename=None):
+    try:
+        return list(parser_class(reader_class(source)).parse_file())
+    except SourceError as e:
+        e.locate(LineIndex(source), filename)
+        raise
+
+
+def load_file(filename, cache_dir=None, reader_class=FastReader,
+              parser_class=Parser):
+    with open(filename, 'rb') as f:
+        source = f.read()
+    key = source_key(source)
+    path = cache_path(filename, cache_dir)
+
+    definitions = read_cache(path, key)
+    if definitions is not None:
+        return definitions
+
+    definitions = parse_source(source, reader_class, parser_class, filename)
+    try:
+        write_cache(path, key, definitions)
+    except (IOError, OSError):
+        # like __pycache__, an unwritable cache only costs the next startup
+        pass
+    return definitions
@@ -0,0 +1,605 @@
+from array import array
+
+from .analysis import (PASSED_DOWN, SEND_CLASSES, classify_blocks,
+                       is_inlined, is_super, tail_position)
+from .cache import cache_path, read_marshalled, write_marshalled
+from .runtime import OnyxError
+from .term import (AssignTerm, BinarySend, BlockTerm, CascadeSend, ClassTerm,
+                   EscapeTerm, Identifier, KeywordSend, LiteralTerm,
+                   UnarySend)
+
+# Bump BYTECODE_VERSION whenever the instruction set or the encoding of
+# CompiledCode changes.
+BYTECODE_VERSION = 4
+
+# The instruction set.  An instruction is its opcode followed by its
+# operands, each a word of the code's array('H'):
+#   PUSH_SELF, PUSH_NIL, PUSH_TRUE, PUSH_FALSE
+#   PUSH_LITERAL n        literals[n]
+#   PUSH_TEMP n           the n'th local of the running code
+#   PUSH_OUTER d n        the n'th local of the code d blocks out
+#   PUSH_NAME n           the instance variable or global names[n]
+#   STORE_TEMP n, STORE_OUTER d n, STORE_NAME n
+#                         store the top of the stack, leaving it there
+#   POP, DUP
+#   SEND n a              sends sites[n] to the receiver under a arguments
+#   SUPER_SEND n a        the same, looked up from the method's superclass
+#   MAKE_BLOCK n          a closure of blocks[n] over the running code
+#   RETURN                returns the top of the stack from the running code
+#   RETURN_HOME           returns it from the method the code is in (^)
+#   TAIL_SEND n a         SEND as the code's tail send: returns what
+#                         Interpreter.tail_site gives
+#   JUMP n                continues at offset n
+#   JUMP_TRUE n o, JUMP_FALSE n o
+#                         pops a Boolean, continuing at n if it is true (or
+#                         false) and with the next instruction if not;
+#                         anything else is left on the stack for the send
+#                         at o
+#   JUMP_NOT_NIL n o      pops nil, continuing with the next instruction,
+#                         or a Boolean or SmallInt, continuing at n;
+#                         anything else is left for the send at o
+#   FOR_PREP l o          pops the bounds of a to:do:, and if they are
+#                         SmallInts sets up locals l, l + 1 and l + 2 as its
+#                         variable, end and step; if not, leaves them for
+#                         the send at o
+#   FOR_LOOP l n          continues at n if the variable is past the end
+#   FOR_NEXT l n          steps the variable and continues at n
+# The locals of a code are its arguments followed by its temporaries, which
+# include those of the loops inlined in it and of the blocks sharing its
+# frame.
+(PUSH_SELF, PUSH_NIL, PUSH_TRUE, PUSH_FALSE, PUSH_LITERAL, PUSH_TEMP,
+ PUSH_OUTER, PUSH_NAME, STORE_TEMP, STORE_OUTER, STORE_NAME, POP, DUP, SEND,
+ SUPER_SEND, MAKE_BLOCK, RETURN, RETURN_HOME, TAIL_SEND, JUMP, JUMP_TRUE,
+ JUMP_FALSE, JUMP_NOT_NIL, FOR_PREP, FOR_LOOP, FOR_NEXT) = range(26)
+
+OPCODE_NAMES = ['PUSH_SELF', 'PUSH_NIL', 'PUSH_TRUE', 'PUSH_FALSE',
+                'PUSH_LITERAL', 'PUSH_TEMP', 'PUSH_OUTER', 'PUSH_NAME',
+                'STORE_TEMP', 'STORE_OUTER', 'STORE_NAME', 'POP', 'DUP',
+                'SEND', 'SUPER_SEND', 'MAKE_BLOCK', 'RETURN', 'RETURN_HOME',
+                'TAIL_SEND', 'JUMP', 'JUMP_TRUE', 'JUMP_FALSE',
+                'JUMP_NOT_NIL', 'FOR_PREP', 'FOR_LOOP', 'FOR_NEXT']
+OPERAND_COUNTS = [0, 0, 0, 0, 1, 1, 2, 1, 1, 2, 1, 0, 0, 2, 2, 1, 0, 0, 2,
+                  1, 2, 2, 2, 2, 2, 2]
+
+# How the branching selectors are inlined: the jump testing the receiver,
+# then what runs when it doesn't jump and what runs when it does, each the
+# index of the argument whose block it is or the pseudo variable it answers.
+_BRANCHES = {
+    'ifTrue:': (JUMP_FALSE, 0, 'nil'),
+    'ifFalse:': (JUMP_TRUE, 0, 'nil'),
+    'ifTrue:ifFalse:': (JUMP_FALSE, 0, 1),
+    'ifFalse:ifTrue:': (JUMP_TRUE, 0, 1),
+    'and:': (JUMP_FALSE, 0, 'false'),
+    'or:': (JUMP_TRUE, 0, 'true'),
+    'ifNil:': (JUMP_NOT_NIL, 0, 'nil'),
+    'ifNotNil:': (JUMP_NOT_NIL, 'nil', 0),
+    'ifNil:ifNotNil:': (JUMP_NOT_NIL, 0, 1),
+}
+
+_PUSH_PSEUDO = {'self': PUSH_SELF, 'nil': PUSH_NIL, 'true': PUSH_TRUE,
+                'false': PUSH_FALSE}
+_PSEUDO_VARIABLES = frozenset(['self', 'super', 'nil', 'true', 'false'])
+
+
+class SendSite(object):
+    # A send instruction's inline cache, with the slots of a MessageSend's
+    # so that Interpreter.send_site takes either.
+    __slots__ = ('message', 'cache_class', 'cache_method', 'cache_epoch')
+
+    def __init__(self, message):
+        self.message = message
+        self.cache_class = None
+        self.cache_method = None
+        self.cache_epoch = None
+
+    def __repr__(self):
+        return '<SendSite #{0}>'.format(self.message)
+
+
+class CompiledCode(object):
+    # The code of a method, a block or top level statements.  bytecode is
+    # an array('H') of instructions, whose operands index literals, sites
+    # (one per send), names and blocks (the CompiledCode of the blocks made
+    # in it).  Everything but the sites, which are made afresh, survives
+    # encode() and decode(), and so marshal.
+    #
+    # A block whose code has a base runs in the frame of the code it is
+    # made in, its locals being those of that frame from base on.
+    __slots__ = ('bytecode', 'literals', 'sites', 'names', 'blocks',
+                 'argument_count', 'temporary_count', 'name', 'base')
+
+    def __init__(self, bytecode, literals, selectors, names, blocks,
+                 argument_count, temporary_count, name=None, base=None):
+        self.bytecode = bytecode
+        self.literals = tuple(literals)
+        self.sites = tuple(SendSite(selector) for selector in selectors)
+        self.names = tuple(names)
+        self.blocks = tuple(blocks)
+        self.argument_count = argument_count
+        self.temporary_count = temporary_count
+        self.name = name
+        self.base = base
+
+    @property
+    def local_count(self):
+        return self.argument_count + self.temporary_count
+
+    def encode(self):
+        return (self.bytecode.tostring(), self.literals,
+                tuple(site.message for site in self.sites), self.names,
+                tuple(block.encode() for block in self.blocks),
+                self.argument_count, self.temporary_count, self.name,
+                self.base)
+
+    @classmethod
+    def decode(cls, encoded):
+        (bytecode, literals, selectors, names, blocks, argument_count,
+         temporary_count, name, base) = encoded
+        return cls(array('H', bytecode), literals, selectors, names,
+                   [cls.decode(block) for block in blocks], argument_count,
+                   temporary_count, name, base)
+
+    def instructions(self):
+        # (offset, opcode name, operands) of each instruction
+        bytecode = self.bytecode
+        pc = 0
+        while pc < len(bytecode):
+            opcode = bytecode[pc]
+            count = OPERAND_COUNTS[opcode]
+            yield pc, OPCODE_NAMES[opcode], tuple(bytecode[pc + 1:
+                                                           pc + 1 + count])
+            pc += 1 + count
+
+    def __repr__(self):
+        return '<CompiledCode {0}>'.format(self.name)
+
+
+class _Scope(object):
+    # the names of the locals of a code being compiled, and the scope of
+    # the code it is in
+    def __init__(self, names, outer=None):
+        self.names = list(names)
+        self.outer = outer
+
+    def resolve(self, name):
+        # (depth, index) of the local name, or None if it isn't one; the
+        # last of the names, as an inlined loop's variable can shadow one
+        scope = self
+        depth = 0
+        while scope is not None:
+            if name in scope.names:
+                names = scope.names
+                return depth, len(names) - 1 - names[::-1].index(name)
+            scope = scope.outer
+            depth += 1
+        return None
+
+
+class Compiler(object):
+    # Compiles method bodies, block bodies and top level statements to
+    # CompiledCode.  Variables that aren't locals of the code or of the
+    # code it is in are left to be found by name when run, as instance
+    # variables or globals, so code compiles without knowing its class and
+    # can be cached apart from it.
+    #
+    # Sends of the selectors in analysis.INLINED_SELECTORS with literal
+    # blocks are compiled to jumps around and between the blocks' bodies,
+    # which run in the code the send is in.  The send itself is compiled
+    # too, for receivers the jumps don't test.
+    #
+    # Blocks are classified by analysis.classify_blocks.  One that the code
+    # making it only passes down shares that code's frame: its arguments
+    # and temporaries are compiled as more locals of the code, unless a
+    # block inside it uses them, which would see them change from one call
+    # to the next.  Nothing else uses those slots, and the method it is
+    # passed to may keep it and call it again, even from inside itself or
+    # after the code has returned, so VirtualMachine.call_block saves and
+    # restores them around every call; that is what makes sharing sound.
+    # Other blocks get a context of their own each time they are called.
+    def __init__(self):
+        self._compilers = {
+            Identifier: self.compile_identifier,
+            LiteralTerm: self.compile_literal,
+            UnarySend: self.compile_send,
+            BinarySend: self.compile_send,
+            KeywordSend: self.compile_send,
+            CascadeSend: self.compile_cascade,
+            AssignTerm: self.compile_assign,
+            BlockTerm: self.compile_block,
+        }
+
+    def compile_method(self, node):
+        names = [v.name for v in node.arguments + node.temporary_variables]
+        return self.compile_body(node.arguments, node.temporary_variables,
+                                 node.statements, None, node.selector,
+                                 tail_position(node.statements, True),
+                                 classify_blocks(node.statements, names))
+
+    def compile_statements(self, statements, temporary_names=(), name=None):
+        # top level code, whose temporaries are named by temporary_names
+        return self.compile_body((), [Identifier(n) for n in temporary_names],
+                                 statements, None, name, None,
+                                 classify_blocks(statements, temporary_names))
+
+    def compile_body(self, arguments, temporary_variables, statements, outer,
+                     name=None, tail=None, infos=None, shared=False):
+        # tail is the index of the body's tail send, if it has one, and
+        # infos the BlockInfos of the blocks in it.  A shared body is a
+        # block's sharing the frame of outer.
+        names = [a.name for a in arguments] + [
+            t.name for t in temporary_variables]
+        if shared:
+            scope = outer
+            base = len(scope.names)
+            scope.names.extend(names)
+        else:
+            scope = _Scope(names, outer)
+            base = 0
+        unit = _Unit(scope, outer is not None, infos)
+        if not statements:
+            unit.emit(PUSH_NIL)
+        for index, statement in enumerate(statements):
+            if index == tail:
+                if statement.__class__ is EscapeTerm:
+                    statement = statement.term
+                self._compile_tail(statement, unit)
+                break
+            if statement.__class__ is EscapeTerm:
+                self.compile(statement.term, unit)
+                # a method returns to itself, so only a block needs to go
+                # through its home
+                unit.emit(RETURN_HOME if outer is not None else RETURN)
+                break
+            self.compile(statement, unit)
+            if index < len(statements) - 1:
+                unit.emit(POP)
+        else:
+            unit.emit(RETURN)
+        local_count = len(scope.names) - base
+        if shared:
+            # its variables are out of scope in the rest of outer
+            scope.names[base:] = [None] * local_count
+        return CompiledCode(unit.bytecode, unit.literals, unit.selectors,
+                            unit.names, unit.blocks, len(arguments),
+                            local_count - len(arguments), name,
+                            base if shared else None)
+
+    def _compile_tail(self, node, unit):
+        # node as the value the code returns
+        if is_inlined(node):
+            self.compile_inlined(node, unit, True)
+        elif node.__class__ in SEND_CLASSES and not is_super(node.receiver):
+            self.compile(node.receiver, unit)
+            self._compile_message(node, False, unit, TAIL_SEND)
+        else:
+            self.compile(node, unit)
+            unit.emit(RETURN)
+
+    def compile(self, node, unit):
+        self._compilers[node.__class__](node, unit)
+
+    def compile_literal(self, node, unit):
+        unit.emit(PUSH_LITERAL, unit.literal(node.value))
+
+    def compile_identifier(self, node, unit):
+        name = node.name
+        if name in _PUSH_PSEUDO:
+            unit.emit(_PUSH_PSEUDO[name])
+        elif name == 'super':
+            # only meaningful as a receiver, where compile_send handles it
+            unit.emit(PUSH_SELF)
+        else:
+            location = unit.scope.resolve(name)
+            if location is None:
+                unit.emit(PUSH_NAME, unit.name(name))
+            elif location[0] == 0:
+                unit.emit(PUSH_TEMP, location[1])
+            else:
+                unit.emit(PUSH_OUTER, *location)
+
+    def compile_assign(self, node, unit):
+        name = node.lhs.name
+        if name in _PSEUDO_VARIABLES:
+            raise OnyxError('cannot assign to {0}'.format(name))
+        self.compile(node.rhs, unit)
+        location = unit.scope.resolve(name)
+        if location is None:
+            unit.emit(STORE_NAME, unit.name(name))
+        elif location[0] == 0:
+            unit.emit(STORE_TEMP, location[1])
+        else:
+            unit.emit(STORE_OUTER, *location)
+
+    def compile_block(self, node, unit):
+        info = unit.infos.get(id(node))
+        shared = (info is not None and info.kind == PASSED_DOWN and
+                  not info.closed_over)
+        code = self.compile_body(node.arguments, node.temporary_variables,
+                                 node.statements, unit.scope, 'a block',
+                                 tail_position(node.statements, False),
+                                 unit.infos, shared)
+        unit.blocks.append(code)
+        unit.emit(MAKE_BLOCK, len(unit.blocks) - 1)
+
+    def compile_send(self, node, unit):
+        if is_inlined(node):
+            self.compile_inlined(node, unit, False)
+            return
+        self.compile(node.receiver, unit)
+        self._compile_message(node, is_super(node.receiver), unit)
+
+    def compile_cascade(self, node, unit):
+        receiver_is_super = is_super(node.receiver)
+        self.compile(node.receiver, unit)
+        last = len(node.messages) - 1
+        for index, message in enumerate(node.messages):
+            if index < last:
+                unit.emit(DUP)
+            self._compile_message(message, receiver_is_super, unit)
+            if index < last:
+                unit.emit(POP)
+
+    def _compile_message(self, node, is_super, unit, opcode=SEND):
+        for argument in node.arguments:
+            self.compile(argument, unit)
+        unit.emit(SUPER_SEND if is_super else opcode,
+                  unit.site(node.message), len(node.arguments))
+
+    # inlining
+
+    def compile_inlined(self, node, unit, tail):
+        # node, an inlined send, leaving its value on the stack, or if tail
+        # returning it from the code
+        if node.message in _BRANCHES:
+            self._compile_branch(node, unit, tail)
+            return
+        if node.message == 'to:do:':
+            self._compile_to_do(node, unit)
+        else:
+            self._compile_while(node, unit)
+        if tail:
+            unit.emit(RETURN)
+
+    def _compile_inline_body(self, block, unit, tail):
+        # the statements of a literal block, as a part of the code
+        statements = block.statements
+        if not statements:
+            unit.emit(PUSH_NIL)
+            if tail:
+                unit.emit(RETURN)
+            return
+        last = len(statements) - 1
+        for index, statement in enumerate(statements):
+            if statement.__class__ is EscapeTerm:
+                if tail and not unit.in_block:
+                    self._compile_tail(statement.term, unit)
+                else:
+                    self.compile(statement.term, unit)
+                    unit.emit(RETURN_HOME if unit.in_block else RETURN)
+                return
+            if tail and index == last:
+                self._compile_tail(statement, unit)
+                return
+            self.compile(statement, unit)
+            if index < last:
+                unit.emit(POP)
+
+    def _compile_fallback(self, node, unit, tail):
+        # the send itself, its receiver being on the stack
+        for argument in node.arguments:
+            self.compile(argument, unit)
+        unit.emit(TAIL_SEND if tail else SEND, unit.site(node.message),
+                  len(node.arguments))
+
+    def _compile_branch(self, node, unit, tail):
+        opcode, fall, taken = _BRANCHES[node.message]
+        self.compile(node.receiver, unit)
+        jump = unit.emit(opcode, 0, 0)
+        ends = []
+        for taking, arm in enumerate((fall, taken)):
+            if taking:
+                unit.patch(jump, 0)
+            if arm in _PUSH_PSEUDO:
+                unit.emit(_PUSH_PSEUDO[arm])
+                if tail:
+                    unit.emit(RETURN)
+            else:
+                self._compile_inline_body(node.arguments[arm], unit, tail)
+            if not tail:
+                ends.append(unit.emit(JUMP, 0))
+        unit.patch(jump, 1)
+        self._compile_fallback(node, unit, tail)
+        for end in ends:
+            unit.patch(end, 0)
+
+    def _compile_while(self, node, unit):
+        #   loop:  condition
+        #          JUMP_FALSE exit, other     (whileFalse: JUMP_TRUE, not)
+        #   body:  body, POP, JUMP loop
+        #   not:   SEND not
+        #          JUMP_FALSE exit, other
+        #          JUMP body
+        #   other: the condition's value ifFalse: [ false ] ifTrue: [ true ]
+        #          JUMP_FALSE exit, skip
+        #          JUMP body
+        #   skip:  POP, JUMP loop
+        #   exit:  PUSH_NIL
+        # so a condition that isn't a Boolean gets the sends whileTrue:
+        # would have made
+        exits = []
+        loop = unit.here()
+        self._compile_inline_body(node.receiver, unit, False)
+        if node.message == 'whileTrue:':
+            test = unit.emit(JUMP_FALSE, 0, 0)
+        else:
+            test = unit.emit(JUMP_TRUE, 0, 0)
+        exits.append(test)
+        body = unit.here()
+        self._compile_inline_body(node.arguments[0], unit, False)
+        unit.emit(POP)
+        unit.emit(JUMP, loop)
+        if node.message == 'whileFalse:':
+            unit.patch(test, 1)
+            unit.emit(SEND, unit.site('not'), 0)
+            test = unit.emit(JUMP_FALSE, 0, 0)
+            exits.append(test)
+            unit.emit(JUMP, body)
+        unit.patch(test, 1)
+        unit.emit(MAKE_BLOCK, unit.constant_block('false'))
+        unit.emit(MAKE_BLOCK, unit.constant_block('true'))
+        unit.emit(SEND, unit.site('ifFalse:ifTrue:'), 2)
+        test = unit.emit(JUMP_FALSE, 0, 0)
+        exits.append(test)
+        unit.emit(JUMP, body)
+        unit.patch(test, 1)
+        unit.emit(POP)
+        unit.emit(JUMP, loop)
+        for test in exits:
+            unit.patch(test, 0)
+        unit.emit(PUSH_NIL)
+
+    def _compile_to_do(self, node, unit):
+        #         start, end
+        #         FOR_PREP l, other
+        #   loop: FOR_LOOP l, exit
+        #         body, POP, FOR_NEXT l, loop
+        #   exit: PUSH_NIL, JUMP end
+        #   other: the to:do: send
+        # with the loop's variable, end and step in three new locals
+        block = node.arguments[1]
+        self.compile(node.receiver, unit)
+        self.compile(node.arguments[0], unit)
+        names = unit.scope.names
+        local = len(names)
+        names.extend([block.arguments[0].name, None, None])
+        prep = unit.emit(FOR_PREP, local, 0)
+        loop = unit.emit(FOR_LOOP, local, 0)
+        self._compile_inline_body(block, unit, False)
+        unit.emit(POP)
+        unit.emit(FOR_NEXT, local, loop)
+        # the variable is out of scope after the loop
+        names[local] = None
+        unit.patch(loop, 1)
+        unit.emit(PUSH_NIL)
+        end = unit.emit(JUMP, 0)
+        unit.patch(prep, 1)
+        self.compile(node.arguments[1], unit)
+        unit.emit(SEND, unit.site(node.message), 2)
+        unit.patch(end, 0)
+
+
+class _Unit(object):
+    # the code being emitted for one body, and its tables; in_block is
+    # whether the body is a block's
+    def __init__(self, scope, in_block=False, infos=None):
+        self.scope = scope
+        self.in_block = in_block
+        self.infos = infos or {}
+        self.bytecode = array('H')
+        self.literals = []
+        self._literal_index = {}
+        self.selectors = []
+        self.names = []
+        self.blocks = []
+
+    def emit(self, opcode, *operands):
+        # the instruction's offset
+        offset = len(self.bytecode)
+        self.bytecode.append(opcode)
+        self.bytecode.extend(operands)
+        return offset
+
+    def here(self):
+        return len(self.bytecode)
+
+    def patch(self, offset, operand):
+        # makes that operand of the jump at offset the next offset
+        self.bytecode[offset + 1 + operand] = len(self.bytecode)
+
+    def constant_block(self, name):
+        # the index of a block answering the pseudo variable name
+        self.blocks.append(CompiledCode(
+            array('H', [_PUSH_PSEUDO[name], RETURN]), (), (), (), (), 0, 0,
+            'a block'))
+        return len(self.blocks) - 1
+
+    def literal(self, value):
+        # the type is part of the key, 1 == 1L but they print differently
+        key = (value.__class__, value)
+        index = self._literal_index.get(key)
+        if index is None:
+            index = self._literal_index[key] = len(self.literals)
+            self.literals.append(value)
+        return index
+
+    def site(self, selector):
+        # every send gets its own site, so its own inline cache
+        self.selectors.append(selector)
+        return len(self.selectors) - 1
+
+    def name(self, name):
+        if name not in self.names:
+            self.names.append(name)
+        return self.names.index(name)
+
+
+def compile_definitions(definitions, compiler=None):
+    # The CompiledCode of each of a file's definitions: for a class, a pair
+    # of dicts mapping the selectors of its instance and class side methods
+    # to theirs, and for a statement, its code as top level code.
+    if compiler is None:
+        compiler = Compiler()
+    compiled = []
+    for definition in definitions:
+        if isinstance(definition, ClassTerm):
+            compiled.append((
+                dict((m.selector, compiler.compile_method(m))
+                     for m in definition.methods),
+                dict((m.selector, compiler.compile_method(m))
+                     for m in definition.class_methods)))
+        else:
+            compiled.append(compiler.compile_statements([definition]))
+    return compiled
+
+
+def _encode_compiled(compiled):
+    encoded = []
+    for item in compiled:
+        if isinstance(item, tuple):
+            encoded.append(tuple(
+                dict((selector, code.encode())
+                     for selector, code in methods.items())
+                for methods in item))
+        else:
+            encoded.append(item.encode())
+    return encoded
+
+
+def _decode_compiled(encoded):
+    compiled = []
+    for item in encoded:
+        if isinstance(item, tuple) and len(item) == 2:
+            compiled.append(tuple(
+                dict((selector, CompiledCode.decode(code))
+                     for selector, code in methods.items())
+                for methods in item))
+        else:
+            compiled.append(CompiledCode.decode(item))
+    return compiled
+
+
+def compiled_path(filename, cache_dir=None):
+    # next to the file's parse cache
+    return cache_path(filename, cache_dir)[:-len('.onyxc')] + '.onyxb'
+
+
+def read_compiled(path, key):
+    encoded = read_marshalled(path, (key, BYTECODE_VERSION))
+    if encoded is None:
+        return None
+    return _decode_compiled(encoded)
+
+
+def write_compiled(path, key, compiled):
+    write_marshalled(path, (key, BYTECODE_VERSION),
+                     _encode_compiled(compiled))
@@ -0,0 +1,430 @@
+from .location import LineIndex, SourceError
+from .parser import Parser
+from .reader import FastReader, ReadError
+from .term import ClassTerm, Node
+
+# A Document keeps the source of a file together with its top-level terms
+# and definitions, and brings them up to date after each edit by re-reading
+# and re-parsing as little as it can:
+#
+# - Terms are re-read from a run of siblings around the edit in the
+#   innermost compound that strictly contains it, until the reader lines up
+#   with an old sibling after the edit again.  Every other term is kept and
+#   only the positions of the siblings after the edit (and of the enclosing
+#   compounds and theirs) are shifted.  If the compound's text no longer
+#   reads as a compound the enclosing one is tried, and so on out to the
+#   top level.
+# - A method whose body contains the edit is re-parsed on its own.  Any
+#   other edit re-parses the top-level definitions it touches, reusing the
+#   MethodTerm of every method whose body term survived.
+#
+# Term positions are relative to the enclosing compound, so the only work
+# proportional to the size of the file is shifting one integer per
+# top-level term and definition after the edit.  The (absolute) node
+# positions of definitions after the edit are brought up to date lazily,
+# when definitions is read.
+
+# How many terms after an item the parser may look at while parsing it: to
+# tell whether a statement runs on or a class definition starts next,
+# Parser.peek_for_class_definition peeks at the next four terms (it needs
+# tokens.has(3)), so re-parsing an item must see that many terms past it.
+_LOOKAHEAD = 4
+
+
+def _search(terms, name, value):
+    # the index of the first term whose start (or end) is at least value
+    low, high = 0, len(terms)
+    while low < high:
+        middle = (low + high) // 2
+        if getattr(terms[middle], name) < value:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+def _shift(terms, delta):
+    for term in terms:
+        term.start += delta
+        term.end += delta
+
+
+def _shift_positions(value, position, delta):
+    # move the node positions at or after position under value by delta
+    if isinstance(value, Node):
+        if value.start is not None:
+            if value.end < position:
+                # a node's text covers its children's
+                return
+            if value.start >= position:
+                value.start += delta
+            value.end += delta
+        for name in value._fields:
+            _shift_positions(getattr(value, name), position, delta)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            _shift_positions(item, position, delta)
+
+
+class _Item(object):
+    # A top-level definition, the range [first, end) of top-level terms it
+    # was parsed from, the start offset its spans were last correct for and
+    # where each of its methods came from.
+    __slots__ = ('definition', 'first', 'end', 'offset', 'records')
+
+    def __init__(self, definition, first, end, offset, records):
+        self.definition = definition
+        self.first = first
+        self.end = end
+        self.offset = offset
+        self.records = records
+
+
+class _MethodRecord(object):
+    # The terms list of the class body (or class side) a method was parsed
+    # from and the indices of its header and body within it.
+    __slots__ = ('method', 'container', 'header_index', 'body_index')
+
+    def __init__(self, method, container, header_index, body_index):
+        self.method = method
+        self.container = container
+        self.header_index = header_index
+        self.body_index = body_index
+
+
+class _DocumentParser(Parser):
+    def __init__(self, reader, reuse=None):
+        super(_DocumentParser, self).__init__(reader)
+        if reuse is None:
+            reuse = {}
+        self.reuse = reuse
+        self.records = {}
+
+    def parse_method_definition(self):
+        container = self.tokens.terms
+        header_index = self.tokens.position
+        method = super(_DocumentParser, self).parse_method_definition()
+        body_index = self.tokens.position - 1
+        self.records[container[body_index]] = _MethodRecord(
+            method, container, header_index, body_index)
+        return method
+
+    def parse_method_body(self, name, arguments, start=None):
+        self.assert_term_compound('[]')
+        body = self.current_term()
+        method = self.reuse.get(body)
+        if (method is None or method.selector != name or
+                method.arguments != arguments):
+            return super(_DocumentParser, self).parse_method_body(
+                name, arguments, start)
+        self.step()
+        # the body's text is unchanged, but may have moved
+        end = self.term_end_offset(body)
+        _shift_positions(method, 0, end - method.end)
+        method.start = start
+        method.arguments = arguments
+        return method
+
+
+class Document(object):
+    # The positions of top-level terms are absolute, so rather than shift
+    # every top-level term after an edit, the shift is added to a Fenwick
+    # tree over their indices (_lags) and a term's position is its stored
+    # one plus its lag.  Lags are folded back into the terms (flushed)
+    # before the top-level terms are read again or handed out.
+    def __init__(self, source, reader_class=FastReader):
+        self.source = source
+        self.reader_class = reader_class
+        self._terms = None
+        self._lags = None
+        self._items = None
+        self.reload()
+
+    @property
+    def terms(self):
+        if self._terms is not None:
+            self._flush()
+        return self._terms
+
+    @property
+    def definitions(self):
+        if self._items is None:
+            self.reload()
+        for item in self._items:
+            self._sync(item)
+        return [item.definition for item in self._items]
+
+    def reload(self):
+        # Read and parse the whole source again.  A document whose source
+        # doesn't read or parse is left without terms or definitions, and
+        # the next edit (or reading definitions) tries again.
+        try:
+            return self._reload()
+        except SourceError as e:
+            e.locate(LineIndex(self.source))
+            raise
+
+    def _reload(self):
+        self._terms = None
+        self._items = None
+        terms = list(self.reader_class(self.source))
+        self._terms = terms
+        self._lags = [0] * (len(terms) + 1)
+        self._items = self._parse_items(0, len(terms))[0]
+        return [item.definition for item in self._items]
+
+    def edit(self, offset, length, text):
+        # Replace length characters at offset with text, returning the nodes
+        # that were parsed again: the method containing the edit, or the
+        # top-level definitions it touched.
+        if offset < 0 or length < 0 or offset + length > len(self.source):
+            raise ValueError('edit out of range: {0}+{1}'.format(
+                offset, length))
+        self.source = self.source[:offset] + text + self.source[
+            offset + length:]
+        try:
+            return self._edit(offset, length, text)
+        except SourceError as e:
+            e.locate(LineIndex(self.source))
+            raise
+
+    def _edit(self, offset, length, text):
+        if self._items is None:
+            return self._reload()
+
+        delta = len(text) - length
+        path = self._enclosing(offset, offset + length)
+        while True:
+            if path:
+                siblings, index, base = path[-1]
+                compound = siblings[index]
+                terms = compound.value
+                limit = base + compound.end - 1 + delta
+                base += compound.start
+                start = base + 1
+            else:
+                self._flush()
+                terms = self._terms
+                base = start = 0
+                limit = len(self.source)
+            try:
+                first, stop, new_terms = self._reread(
+                    terms, base, start, limit, offset, offset + length, delta)
+                break
+            except ReadError:
+                if not path:
+                    self._terms = None
+                    self._items = None
+                    raise
+                path.pop()
+
+        terms[first:stop] = new_terms
+        if not path:
+            _shift(terms[first + len(new_terms):], delta)
+            self._lags = [0] * (len(terms) + 1)
+            if not self._items:
+                return self._reload()
+            low = self._item_at(max(first - 1, 0))
+            high = self._item_at(max(stop - 1, first))
+            return self._reparse_items(low, high,
+                                       len(new_terms) - (stop - first))
+
+        _shift(terms[first + len(new_terms):], delta)
+        for siblings, index, _ in reversed(path):
+            siblings[index].end += delta
+            if siblings is self._terms:
+                self._add_lag(index + 1, delta)
+            else:
+                _shift(siblings[index + 1:], delta)
+
+        item_index = self._item_at(path[0][1])
+        item = self._items[item_index]
+        if isinstance(item.definition, ClassTerm):
+            for siblings, index, container_base in path[1:]:
+                record = item.records.get(siblings[index])
+                if record is not None and record.container is siblings:
+                    return [self._reparse_method(item, record, container_base,
+                                                 offset + length, delta)]
+        return self._reparse_items(item_index, item_index, 0,
+                                   item.end + _LOOKAHEAD)
+
+    def _lag(self, index):
+        lags = self._lags
+        index += 1
+        total = 0
+        while index > 0:
+            total += lags[index]
+            index -= index & -index
+        return total
+
+    def _add_lag(self, index, delta):
+        # shift the top-level terms from index on
+        lags = self._lags
+        index += 1
+        while index < len(lags):
+            lags[index] += delta
+            index += index & -index
+
+    def _settle(self, first, stop):
+        # fold the lags of terms[first:stop] into their positions
+        for index in range(first, stop):
+            lag = self._lag(index)
+            if lag:
+                term = self._terms[index]
+                term.start += lag
+                term.end += lag
+                self._add_lag(index, -lag)
+                self._add_lag(index + 1, lag)
+
+    def _flush(self):
+        if any(self._lags):
+            for index, term in enumerate(self._terms):
+                lag = self._lag(index)
+                term.start += lag
+                term.end += lag
+            self._lags = [0] * len(self._lags)
+
+    def _sync(self, item):
+        start = self._terms[item.first].start + self._lag(item.first)
+        if start != item.offset:
+            _shift_positions(item.definition, 0, start - item.offset)
+            item.offset = start
+
+    def _enclosing(self, low, high):
+        # The compounds strictly containing [low, high], outermost first, as
+        # (siblings, index, base) where base is the offset the positions of
+        # siblings are relative to (for the top level, the lag of index).
+        terms = self._terms
+        index, count = 0, len(terms)
+        while count > 0:
+            step = count // 2
+            if terms[index + step].start + self._lag(index + step) < low:
+                index += step + 1
+                count -= step + 1
+            else:
+                count = step
+        index -= 1
+        path = []
+        siblings, base = terms, self._lag(index)
+        while index >= 0:
+            term = siblings[index]
+            if not term.is_compound or high - base >= term.end:
+                break
+            path.append((siblings, index, base))
+            base += term.start
+            siblings = term.value
+            index = _search(siblings, 'start', low - base) - 1
+        return path
+
+    def _reread(self, terms, base, start, limit, low, high, delta):
+        # Read the terms replacing terms[first:stop], starting after the last
+        # sibling that ends before the edit (whose extent can't depend on
+        # it) and stopping once a term starts where an old sibling after
+        # the edit now starts.
+        first = _search(terms, 'end', low - base)
+        if first > 0:
+            start = base + terms[first - 1].end
+        stop = _search(terms, 'start', high - base)
+        reader = self.reader_class(self.source, start, limit, base)
+        new_terms = []
+        while True:
+            term = reader.read_term()
+            if term.is_eof:
+                return first, len(terms), new_terms
+            while stop < len(terms) and terms[stop].start + delta < term.start:
+                stop += 1
+            if stop < len(terms) and terms[stop].start + delta == term.start:
+                return first, stop, new_terms
+            new_terms.append(term)
+
+    def _item_at(self, index):
+        # the index of the item containing top-level term index
+        items = self._items
+        low, high = 0, len(items)
+        while low < high:
+            middle = (low + high) // 2
+            if items[middle].first <= index:
+                low = middle + 1
+            else:
+                high = middle
+        return max(low - 1, 0)
+
+    def _parse_items(self, first, stop, following=(), reuse=None, limit=None):
+        # Parse items from terms[first:limit] up to stop.  If the last one
+        # runs on into following (the items after stop) the ones it ran into
+        # are consumed as well, until an item ends where one of them did.
+        # Returns the new items and the number of following consumed.
+        terms = self._terms
+        parser = _DocumentParser(terms[first:limit], reuse)
+        tokens = parser.tokens
+        items = []
+        consumed = 0
+        while True:
+            while first + tokens.position < stop and not parser.at_end():
+                index = first + tokens.position
+                parser.records = {}
+                definition = parser.parse_file_item()
+                items.append(_Item(definition, index, first + tokens.position,
+                                   terms[index].start, parser.records))
+            position = first + tokens.position
+            while (consumed < len(following) and
+                   following[consumed].first < position):
+                stop = following[consumed].end
+                consumed += 1
+            if position >= stop or parser.at_end():
+                return items, consumed
+
+    def _reparse_items(self, low, high, difference, limit=None):
+        # Re-parse items[low:high + 1], whose terms now end difference
+        # terms later.  The previous item is included when terms were
+        # replaced at the top level, since a statement runs on into
+        # whatever follows it unless that starts a class; otherwise the top
+        # level terms are unchanged and parsing stops at limit.  If they
+        # don't parse the document is left without definitions until the
+        # next edit.
+        items = self._items
+        following = ()
+        if limit is None:
+            for item in items[high + 1:]:
+                item.first += difference
+                item.end += difference
+            items[high].end += difference
+            following = items[high + 1:]
+        else:
+            self._settle(items[low].first, items[high].end)
+        reuse = {}
+        for item in items[low:high + 1]:
+            for body, record in item.records.items():
+                reuse[body] = record.method
+        try:
+            new_items, consumed = self._parse_items(
+                items[low].first, items[high].end, following, reuse, limit)
+        except Exception:
+            self._items = None
+            raise
+        items[low:high + 1 + consumed] = new_items
+        return [item.definition for item in new_items]
+
+    def _reparse_method(self, item, record, base, high, delta):
+        # If the method's new text doesn't parse, the document is left
+        # without definitions until the next edit, as _reparse_items leaves
+        # it.
+        self._sync(item)
+        definition = item.definition
+        _shift_positions(definition, high, delta)
+
+        parser = _DocumentParser(
+            record.container[record.header_index:record.body_index + 1])
+        parser.tokens.base = base
+        try:
+            method = parser.parse_method_definition()
+            parser.assert_at_end()
+        except Exception:
+            self._items = None
+            raise
+        for methods in definition.methods, definition.class_methods:
+            for index, old in enumerate(methods):
+                if old is record.method:
+                    methods[index] = method
+        record.method = method
+        return method
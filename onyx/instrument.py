@@ -0,0 +1,188 @@
+import functools
+import inspect
+import timeit
+import types
+
+from .parser import Parser, TokenBuffer
+from .reader import FastReader, Reader, StringReader
+from .util.stream import PendingState
+
+
+_active = None
+
+
+class Profiler(object):
+    # Counts and times the read_* methods of the readers and the parse_*
+    # methods (and subparse) of the parser, and counts stream forces,
+    # parser instances, subparse frames and pushed back terms, the latter
+    # split out by whether they had to copy the buffer's terms.
+    #
+    # Enabling it wraps the methods in place on their classes, and disabling
+    # it puts the originals back, so it costs nothing when it isn't on.  Only
+    # one profiler can be on at a time.  Subclasses that override methods
+    # (e.g. a parser with its own parse_*) are passed in classes.
+    #
+    # calls maps 'Class.method' to [count, cumulative seconds], time spent
+    # in recursive calls being counted once.  stacks maps tuples of those
+    # names, outermost first, to the seconds spent in the innermost one
+    # itself, which is what collapsed() exports.
+    timer = staticmethod(timeit.default_timer)
+    prefixes = {Reader: 'read_', StringReader: 'read_', FastReader: 'read_',
+                Parser: 'parse_'}
+
+    def __init__(self, classes=()):
+        self.classes = list(classes)
+        self._saved = []
+        self.reset()
+
+    def reset(self):
+        self.calls = {}
+        self.counters = {}
+        self.stacks = {}
+        self._stack = []
+        self._depths = {}
+
+    @property
+    def enabled(self):
+        return _active is self
+
+    def enable(self):
+        global _active
+        if _active is not None:
+            raise RuntimeError('a profiler is already enabled')
+        _active = self
+        targets = [(cls, prefix) for cls, prefix in self.prefixes.items()]
+        for cls in self.classes:
+            if issubclass(cls, Parser):
+                targets.append((cls, 'parse_'))
+            elif issubclass(cls, Reader):
+                targets.append((cls, 'read_'))
+        for cls, prefix in targets:
+            for name, value in list(cls.__dict__.items()):
+                # generators would only be timed creating themselves; what
+                # they call is timed instead (parse_file -> parse_file_item)
+                if (name.startswith(prefix) and
+                        isinstance(value, types.FunctionType) and
+                        not inspect.isgeneratorfunction(value)):
+                    self._patch(cls, name, self._timed(
+                        '{0}.{1}'.format(cls.__name__, name), value))
+        self._patch(Parser, 'subparse', self._timed(
+            'Parser.subparse', Parser.__dict__['subparse']))
+        self._patch(Parser, '__init__',
+                    self._counted('parser', Parser.__dict__['__init__']))
+        self._patch(TokenBuffer, 'enter',
+                    self._counted('subparse.frame',
+                                  TokenBuffer.__dict__['enter']))
+        self._patch(PendingState, 'force',
+                    self._counted('stream.force',
+                                  PendingState.__dict__['force']))
+        self._patch(TokenBuffer, 'pushback',
+                    self._pushback(TokenBuffer.__dict__['pushback']))
+        return self
+
+    def disable(self):
+        global _active
+        if _active is not self:
+            return
+        while self._saved:
+            cls, name, value = self._saved.pop()
+            setattr(cls, name, value)
+        _active = None
+
+    def __enter__(self):
+        return self.enable()
+
+    def __exit__(self, *exc_info):
+        self.disable()
+
+    def _patch(self, cls, name, wrapper):
+        if any(c is cls and n == name for c, n, _ in self._saved):
+            return
+        self._saved.append((cls, name, cls.__dict__[name]))
+        setattr(cls, name, wrapper)
+
+    def _count(self, name):
+        self.counters[name] = self.counters.get(name, 0) + 1
+
+    def _counted(self, name, function):
+        count = self._count
+
+        def wrapper(*args, **kwargs):
+            count(name)
+            return function(*args, **kwargs)
+        return functools.wraps(function)(wrapper)
+
+    def _pushback(self, function):
+        count = self._count
+
+        def pushback(tokens, term):
+            count('push_term')
+            if not tokens._owned:
+                count('push_term.rebuild')
+            return function(tokens, term)
+        return functools.wraps(function)(pushback)
+
+    def _timed(self, name, function):
+        calls = self.calls
+        stacks = self.stacks
+        depths = self._depths
+        stack = self._stack
+        timer = self.timer
+
+        def wrapper(*args, **kwargs):
+            # frame: [stack key, seconds spent in calls made from it]
+            frame = [(stack[-1][0] if stack else ()) + (name,), 0.0]
+            stack.append(frame)
+            depths[name] = depths.get(name, 0) + 1
+            start = timer()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = timer() - start
+                stack.pop()
+                depth = depths[name] = depths[name] - 1
+                record = calls.get(name)
+                if record is None:
+                    record = calls[name] = [0, 0.0]
+                record[0] += 1
+                if not depth:
+                    record[1] += elapsed
+                key = frame[0]
+                stacks[key] = stacks.get(key, 0.0) + elapsed - frame[1]
+                if stack:
+                    stack[-1][1] += elapsed
+        return functools.wraps(function)(wrapper)
+
+    def report(self):
+        # (name, count, cumulative seconds), the most time first
+        rows = [(name, count, seconds)
+                for name, (count, seconds) in self.calls.items()]
+        rows.sort(key=lambda row: (-row[2], row[0]))
+        return rows
+
+    def format_report(self):
+        lines = ['{0:<40} {1:>10} {2:>12}'.format('function', 'calls',
+                                                   'seconds')]
+        for name, count, seconds in self.report():
+            lines.append('{0:<40} {1:>10} {2:>12.6f}'.format(
+                name, count, seconds))
+        if self.counters:
+            lines.append('')
+            for name in sorted(self.counters):
+                lines.append('{0:<40} {1:>10}'.format(
+                    name, self.counters[name]))
+        return '\n'.join(lines)
+
+    def collapsed(self, unit=1e-6):
+        # 'outer;inner;innermost count' lines, as read by flamegraph.pl and
+        # speedscope, counting self time in units (microseconds by default)
+        lines = []
+        for key in sorted(self.stacks):
+            lines.append('{0} {1}'.format(
+                ';'.join(key), int(round(self.stacks[key] / unit))))
+        return lines
+
+    def write_collapsed(self, filename, unit=1e-6):
+        with open(filename, 'w') as f:
+            for line in self.collapsed(unit):
+                f.write(line + '\n')
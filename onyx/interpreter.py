@@ -0,0 +1,947 @@
+import os
+import sys
+import threading
+from bisect import bisect_left
+from Queue import Queue
+
+from .analysis import tail_position
+from .cache import parse_source
+from .location import LineIndex, SourceError
+from .parser import Parser
+from .primitives import PRIMITIVES, TAIL_PRIMITIVES
+from .reader import FastReader
+from .runtime import (Block, Character, Class, Continuation, Instance, Method,
+                      OnyxError, Symbol, method_cache)
+from .term import (AssignTerm, BinarySend, BlockTerm, CascadeSend, ClassTerm,
+                   EscapeTerm, Identifier, KeywordSend, LiteralTerm,
+                   UnarySend)
+
+SYSTEM = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                      'system.ost')
+
+# The Python types that stand for instances of these classes.  Any other
+# value is an object with a cls.
+BUILTIN_TYPES = {
+    'UndefinedObject': (type(None),),
+    'SmallInt': (int, long),
+    'String': (str, bytearray),
+    'Symbol': (Symbol,),
+    'Character': (Character,),
+    'Array': (list,),
+}
+
+PSEUDO_VARIABLES = frozenset(['self', 'super', 'nil', 'true', 'false'])
+
+# a prompt in Interpreter.mark_stack is (_PROMPT, its tag)
+_PROMPT = object()
+
+# The threads abort blocks are run in (see Interpreter.abort) get this much
+# stack for each frame the recursion limit allows (CPython 2.7 takes about
+# 400 bytes a frame on x86-64), and at most IDLE_WORKERS of them are kept
+# for the next abort block once they have run one.
+FRAME_STACK_SIZE = 512
+IDLE_WORKERS = 8
+
+# A send site caches up to SITE_ENTRIES receiver classes before it goes
+# megamorphic.
+SITE_ENTRIES = 4
+
+# the cache_class of a site whose selector is a primitive's, and of one that
+# has seen too many classes
+_PRIMITIVE = object()
+_MEGAMORPHIC = object()
+
+
+class Frame(object):
+    # The activation of a method or a block.  variables holds the arguments
+    # and temporaries (and self, in a method's frame).  outer is the frame a
+    # block was made in, where its other variables are found, and home the
+    # frame of the method it is in, which ^ returns from and which is live
+    # until it has returned.  Top level code runs in a frame with no method.
+    __slots__ = ('variables', 'outer', 'home', 'method', 'live')
+
+    def __init__(self, variables, outer=None, home=None, method=None):
+        self.variables = variables
+        self.outer = outer
+        if home is None:
+            home = self
+        self.home = home
+        self.method = method
+        self.live = True
+
+
+class _Segment(object):
+    # A segment of the mark stack: the prompt for tag and the marks (key,
+    # value) installed inside it, innermost last, on top of the segment
+    # parent.  The root segment has no prompt, parent None and level 0;
+    # level counts the segments below.  prompted is whether the prompt is
+    # still installed, which it isn't once it has been aborted to.
+    #
+    # continuations are the live continuations captured up to the prompt,
+    # if any, and channel is set while the segment is running again, one of
+    # them having been resumed from its abort block.
+    __slots__ = ('tag', 'marks', 'parent', 'level', 'prompted',
+                 'abort_block', 'continuations', 'channel')
+
+    def __init__(self, tag=None, parent=None, abort_block=None):
+        self.tag = tag
+        self.marks = []
+        self.parent = parent
+        self.level = 0 if parent is None else parent.level + 1
+        self.prompted = parent is not None
+        self.abort_block = abort_block
+        self.continuations = None
+        self.channel = None
+
+
+class _Channel(object):
+    # Passes control between the two threads of an abort to a prompt that
+    # live continuations were captured up to: the segments from the one of
+    # the prompt up to the innermost (segments, innermost first), parked
+    # while the abort block runs in the other.  Each sends the other a
+    # message (what, value) and waits for one back; to the segments:
+    #   ('resume', (continuation, block))  a continuation was resumed
+    #   ('return', value)                  the abort block returned
+    #   ('raise', error)                   or raised error
+    # and back to the abort block, once a resumed continuation has left the
+    # prompt, ('return', value) or ('raise', error).
+    __slots__ = ('segments', 'to_segments', 'to_abort_block')
+
+    def __init__(self, segments):
+        self.segments = segments
+        self.to_segments = Queue()
+        self.to_abort_block = Queue()
+
+
+class _Worker(threading.Thread):
+    # A thread that abort blocks are run in.  One that has run a job waits
+    # for the next if fewer than IDLE_WORKERS others are, and exits if not.
+    idle = []
+    idle_lock = threading.Lock()
+
+    def __init__(self):
+        super(_Worker, self).__init__()
+        self.daemon = True
+        self.jobs = Queue()
+
+    def run(self):
+        while True:
+            function, arguments = self.jobs.get()
+            function(*arguments)
+            # the job has handed its result back already, so others may be
+            # finishing theirs at the same time
+            with _Worker.idle_lock:
+                if len(_Worker.idle) >= IDLE_WORKERS:
+                    return
+                _Worker.idle.append(self)
+
+    @classmethod
+    def get(cls):
+        # an idle worker, or a new one; OnyxError if none can be started
+        try:
+            return cls.idle.pop()
+        except IndexError:
+            pass
+        try:
+            size = threading.stack_size(
+                sys.getrecursionlimit() * FRAME_STACK_SIZE)
+            try:
+                worker = cls()
+                worker.start()
+            finally:
+                threading.stack_size(size)
+        except (threading.ThreadError, MemoryError, ValueError) as e:
+            raise OnyxError('cannot start a thread to run an abort block '
+                            'in: {0}'.format(e))
+        return worker
+
+    def submit(self, function, *arguments):
+        self.jobs.put((function, arguments))
+
+
+class _NonLocalReturn(Exception):
+    def __init__(self, home, value):
+        self.home = home
+        self.value = value
+
+
+class _Abort(Exception):
+    # what is 'abort', for the prompt to call its abort block with value, or
+    # (its abort block having been run in another thread) 'return' or
+    # 'raise', for the prompt to return or raise value
+    def __init__(self, segment, value, what='abort'):
+        self.segment = segment
+        self.value = value
+        self.what = what
+
+
+class _Resume(Exception):
+    def __init__(self, continuation, block):
+        self.continuation = continuation
+        self.block = block
+
+
+class _TailCall(object):
+    # What a body returns instead of a value to have its caller invoke
+    # method, in place of its own activation.
+    __slots__ = ('method', 'receiver', 'arguments')
+
+    def __init__(self, method, receiver, arguments):
+        self.method = method
+        self.receiver = receiver
+        self.arguments = arguments
+
+
+class Interpreter(object):
+    # Evaluates the AST directly.  Each kind of node is evaluated by the
+    # method that _evaluators maps its class to, and sends whose selector is
+    # a primitive's call it through the primitives dict without a lookup.
+    #
+    # Classes and globals live in globals, and bootstrap() loads system.ost,
+    # which every other onyx source builds on.  Methods are looked up through
+    # method_cache, by default the one all interpreters share, behind the
+    # inline cache of each send site (see send_site).
+    #
+    # Tail sends (see analysis.tail_position) don't invoke the method they
+    # find: the body returns a _TailCall and the method invoking it, or
+    # call_block, invokes that in a loop, so loops written as recursion run
+    # in constant stack.
+    #
+    # The continuation marks and prompts of the code being run are kept in
+    # segments, each starting at a prompt, and segment is the innermost.
+    # Installing a prompt pushes a segment and installing a mark appends to
+    # the innermost one; the primitive installing either takes it off again
+    # when it returns or is unwound through.  They are indexed as they go:
+    # prompt_index maps id(tag) to the segments of the prompts for it, and
+    # mark_index id(key) to the levels of the segments of the marks with it
+    # and their values, all innermost last, so finding the innermost prompt
+    # for a tag or mark for a key is a lookup, and the marks inside a prompt
+    # are a slice.  Keys and tags are compared by identity, and kept alive
+    # by the segments while they are in the index.
+    #
+    # A continuation is delimited by the innermost prompt for its tag, and
+    # can be resumed until the primitive that captured it returns, but not
+    # after.  Capturing one copies nothing.  Resuming one from inside it
+    # escapes back to where it was captured.  Aborting to a prompt that
+    # live continuations were captured up to doesn't unwind: the segments
+    # from the prompt's up are taken out of the index and parked, in the
+    # thread running them, and the abort block is run in another.  If it
+    # resumes one of them they are put back on top of the segments it is
+    # running in, and run again, without the prompt, until they leave it;
+    # whatever they return or raise is what resuming does.  Once the abort
+    # block has returned or raised, the prompt does the same.  Only one of
+    # the threads runs at a time.  The one waiting blocks in Queue.get with
+    # no timeout, which on Python 2 can't be interrupted, so Ctrl-C isn't
+    # seen until control comes back to the main thread.
+    recursion_limit = 20000
+
+    def __init__(self, output=None, method_cache=method_cache):
+        self.globals = {'nil': None}
+        self.method_cache = method_cache
+        self.primitives = dict(PRIMITIVES)
+        self.type_classes = {}
+        self.true = None
+        self.false = None
+        self.block_class = None
+        self.segment = _Segment()
+        self.prompt_index = {}
+        self.mark_index = {}
+        if output is None:
+            output = sys.stdout
+        self.output = output
+        self._evaluators = {
+            Identifier: self.eval_identifier,
+            LiteralTerm: self.eval_literal,
+            UnarySend: self.eval_send,
+            BinarySend: self.eval_send,
+            KeywordSend: self.eval_send,
+            CascadeSend: self.eval_cascade,
+            AssignTerm: self.eval_assign,
+            BlockTerm: self.eval_block,
+        }
+
+    # loading
+
+    def bootstrap(self, filename=SYSTEM):
+        return self.load_file(filename)
+
+    def load_file(self, filename):
+        with open(filename, 'rb') as f:
+            source = f.read()
+        return self.load_source(source, filename)
+
+    def load_source(self, source, filename=None):
+        return self.execute(parse_source(source, filename=filename))
+
+    def execute(self, definitions):
+        # defines the classes and runs the statements of a parsed file,
+        # returning the value of the last statement
+        frame = Frame({'self': None})
+        value = None
+        for definition in definitions:
+            if isinstance(definition, ClassTerm):
+                self.define_class(definition)
+            else:
+                value = self._run_top_level([definition], frame)
+        return value
+
+    def evaluate(self, source, filename=None):
+        # runs source as the body of a method with self nil, returning the
+        # value of its last statement
+        try:
+            parser = Parser(FastReader(source))
+            temporary_variables, statements = parser.parse_executable_code()
+            parser.assert_at_end()
+        except SourceError as e:
+            e.locate(LineIndex(source), filename)
+            raise
+        variables = dict((t.name, None) for t in temporary_variables)
+        variables['self'] = None
+        return self._run_top_level(statements, Frame(variables))
+
+    def _run_top_level(self, statements, frame):
+        limit = sys.getrecursionlimit()
+        if limit < self.recursion_limit:
+            sys.setrecursionlimit(self.recursion_limit)
+        try:
+            return self.run(statements, frame)
+        except _NonLocalReturn as e:
+            if e.home is not frame:
+                raise OnyxError('non-local return to a method that has '
+                                'returned')
+            return e.value
+        except RuntimeError as e:
+            if 'recursion' not in str(e):
+                raise
+            raise OnyxError('stack overflow')
+        finally:
+            sys.setrecursionlimit(limit)
+
+    def define_class(self, node):
+        # (re)defines the class of a ClassTerm, returning it
+        superclass = None
+        if node.superclass != 'nil':
+            superclass = self.globals.get(node.superclass)
+            if not isinstance(superclass, Class):
+                raise OnyxError('superclass of {0} is not a class: {1}'.format(
+                    node.name, node.superclass))
+        class_class = self.globals.get('Class')
+        if superclass is not None:
+            metasuperclass = superclass.cls
+        else:
+            metasuperclass = class_class
+        instance_variables = [v.name for v in node.instance_variables]
+        class_variables = [v.name for v in node.class_instance_variables]
+
+        cls = self.globals.get(node.name)
+        if isinstance(cls, Class):
+            metaclass = cls.cls
+            metaclass.instance_variables = class_variables
+            metaclass.set_superclass(metasuperclass)
+            cls.instance_variables = instance_variables
+            cls.set_superclass(superclass)
+        else:
+            metaclass = Class(node.name + ' class', metasuperclass,
+                              class_variables, class_class)
+            cls = Class(node.name, superclass, instance_variables, metaclass)
+            metaclass.instance_class = cls
+        cls.ivars.extend([None] * (len(metaclass.all_variables) -
+                                   len(cls.ivars)))
+        cls.replace_methods([Method(cls, method) for method in node.methods])
+        metaclass.replace_methods([Method(metaclass, method)
+                                   for method in node.class_methods])
+        self.globals[node.name] = cls
+        self._register(cls)
+        return cls
+
+    def _register(self, cls):
+        # hooks up the classes that the interpreter itself needs
+        name = cls.name
+        for python_type in BUILTIN_TYPES.get(name, ()):
+            self.type_classes[python_type] = cls
+        if name == 'True':
+            self.true = self.globals['true'] = Instance(cls)
+        elif name == 'False':
+            self.false = self.globals['false'] = Instance(cls)
+        elif name == 'BlockClosure':
+            self.block_class = cls
+        elif name == 'Class':
+            # the metaclasses made before Class was defined
+            for value in self.globals.values():
+                if isinstance(value, Class):
+                    metaclass = value.cls
+                    if metaclass.cls is None:
+                        metaclass.cls = cls
+                    if value.superclass is None and metaclass is not cls.cls:
+                        metaclass.set_superclass(cls)
+
+    # evaluation
+
+    def eval(self, node, frame):
+        return self._evaluators[node.__class__](node, frame)
+
+    def run(self, statements, frame, tail=None):
+        # runs the statements of a method or block body in frame, returning
+        # the value of the last (or nil), or a _TailCall for the statement
+        # at index tail if there is one
+        evaluators = self._evaluators
+        if tail is not None:
+            for index in xrange(tail):
+                statement = statements[index]
+                evaluators[statement.__class__](statement, frame)
+            statement = statements[tail]
+            if statement.__class__ is EscapeTerm:
+                statement = statement.term
+            return self.eval_tail(statement, frame)
+        value = None
+        for statement in statements:
+            if statement.__class__ is EscapeTerm:
+                term = statement.term
+                value = evaluators[term.__class__](term, frame)
+                home = frame.home
+                if home is frame:
+                    return value
+                if not home.live:
+                    raise OnyxError('non-local return to a method that has '
+                                    'returned')
+                raise _NonLocalReturn(home, value)
+            value = evaluators[statement.__class__](statement, frame)
+        return value
+
+    def eval_literal(self, node, frame):
+        return node.value
+
+    def eval_identifier(self, node, frame):
+        name = node.name
+        f = frame
+        while f is not None:
+            variables = f.variables
+            if name in variables:
+                return variables[name]
+            f = f.outer
+        home = frame.home
+        method = home.method
+        if method is not None:
+            index = method.owner.variable_index.get(name)
+            if index is not None:
+                return home.variables['self'].ivars[index]
+        try:
+            return self.globals[name]
+        except KeyError:
+            raise OnyxError('undefined variable: {0}'.format(name))
+
+    def eval_assign(self, node, frame):
+        evaluator = self._evaluators[node.rhs.__class__]
+        value = evaluator(node.rhs, frame)
+        name = node.lhs.name
+        if name in PSEUDO_VARIABLES:
+            raise OnyxError('cannot assign to {0}'.format(name))
+        f = frame
+        while f is not None:
+            variables = f.variables
+            if name in variables:
+                variables[name] = value
+                return value
+            f = f.outer
+        home = frame.home
+        method = home.method
+        if method is not None:
+            index = method.owner.variable_index.get(name)
+            if index is not None:
+                home.variables['self'].ivars[index] = value
+                return value
+        self.globals[name] = value
+        return value
+
+    def eval_block(self, node, frame):
+        return Block(self.block_class, node, frame)
+
+    def eval_send(self, node, frame):
+        evaluators = self._evaluators
+        receiver = node.receiver
+        if receiver.__class__ is Identifier and receiver.name == 'super':
+            arguments = [evaluators[a.__class__](a, frame)
+                         for a in node.arguments]
+            return self.super_send(frame, node.message, arguments)
+        receiver = evaluators[receiver.__class__](receiver, frame)
+        arguments = [evaluators[a.__class__](a, frame)
+                     for a in node.arguments]
+        return self.send_site(node, receiver, arguments)
+
+    def eval_tail(self, node, frame):
+        evaluators = self._evaluators
+        receiver = evaluators[node.receiver.__class__](node.receiver, frame)
+        arguments = [evaluators[a.__class__](a, frame)
+                     for a in node.arguments]
+        return self.tail_site(node, receiver, arguments)
+
+    def eval_cascade(self, node, frame):
+        evaluators = self._evaluators
+        receiver = node.receiver
+        is_super = (receiver.__class__ is Identifier and
+                    receiver.name == 'super')
+        if not is_super:
+            receiver = evaluators[receiver.__class__](receiver, frame)
+        value = None
+        for message in node.messages:
+            arguments = [evaluators[a.__class__](a, frame)
+                         for a in message.arguments]
+            if is_super:
+                value = self.super_send(frame, message.message, arguments)
+            else:
+                value = self.send_site(message, receiver, arguments)
+        return value
+
+    # sending
+
+    def class_of(self, value):
+        cls = self.type_classes.get(value.__class__)
+        if cls is not None:
+            return cls
+        try:
+            return value.cls
+        except AttributeError:
+            raise OnyxError('not an onyx object: {0!r}'.format(value))
+
+    def send(self, receiver, selector, arguments):
+        primitive = self.primitives.get(selector)
+        if primitive is not None:
+            return primitive(self, receiver, *arguments)
+        method = self.method_cache.lookup(self.class_of(receiver), selector)
+        if method is None:
+            return self.does_not_understand(receiver, selector, arguments)
+        return self.invoke(method, receiver, arguments)
+
+    def send_site(self, node, receiver, arguments):
+        # sends node's message through its inline cache (the cache_ slots of
+        # the MessageSend), which is
+        #   empty:        cache_class None
+        #   primitive:    cache_class _PRIMITIVE, cache_method the function
+        #   monomorphic:  cache_class the receiver class, cache_method the
+        #                 method found in it
+        #   polymorphic:  cache_class a tuple of up to SITE_ENTRIES classes,
+        #                 cache_method a tuple of their methods
+        #   megamorphic:  cache_class _MEGAMORPHIC, looking up through
+        #                 method_cache
+        # Other than a primitive's, it only holds while cache_epoch is
+        # Class.epoch, so defining a method anywhere empties every site.
+        cached = node.cache_class
+        if cached is _PRIMITIVE:
+            return node.cache_method(self, receiver, *arguments)
+        cls = self.type_classes.get(receiver.__class__)
+        if cls is None:
+            cls = self.class_of(receiver)
+        if cached is cls and node.cache_epoch == Class.epoch:
+            method = node.cache_method
+        else:
+            method = self._site_miss(node, cls)
+            if method is _PRIMITIVE:
+                return node.cache_method(self, receiver, *arguments)
+        if method is None:
+            return self.does_not_understand(receiver, node.message, arguments)
+        return self.invoke(method, receiver, arguments)
+
+    def tail_site(self, node, receiver, arguments):
+        # send_site for a tail send: a method found comes back as a
+        # _TailCall for the caller to invoke, as does the tail send of a
+        # block that a primitive calls
+        cached = node.cache_class
+        if cached is not _PRIMITIVE:
+            cls = self.type_classes.get(receiver.__class__)
+            if cls is None:
+                cls = self.class_of(receiver)
+            if cached is cls and node.cache_epoch == Class.epoch:
+                method = node.cache_method
+            else:
+                method = self._site_miss(node, cls)
+        if cached is _PRIMITIVE or method is _PRIMITIVE:
+            function = node.cache_method
+            return TAIL_PRIMITIVES.get(function, function)(self, receiver,
+                                                           *arguments)
+        if method is None:
+            return self.does_not_understand(receiver, node.message, arguments)
+        return _TailCall(method, receiver, arguments)
+
+    def _site_miss(self, node, cls):
+        # looks up node's message in cls, moving the site on to the next
+        # state; nodes may be frozen, so the slots are set past Node's guard
+        set_slot = object.__setattr__
+        epoch = Class.epoch
+        if node.cache_epoch != epoch:
+            set_slot(node, 'cache_epoch', epoch)
+            set_slot(node, 'cache_class', None)
+            set_slot(node, 'cache_method', None)
+            primitive = self.primitives.get(node.message)
+            if primitive is not None:
+                set_slot(node, 'cache_class', _PRIMITIVE)
+                set_slot(node, 'cache_method', primitive)
+                return _PRIMITIVE
+        cached = node.cache_class
+        if cached.__class__ is tuple:
+            for index, entry in enumerate(cached):
+                if entry is cls:
+                    return node.cache_method[index]
+        method = self.method_cache.lookup(cls, node.message)
+        if method is None or cached is _MEGAMORPHIC:
+            # a site that doesn't understand is left for the next send
+            return method
+        if cached is None:
+            set_slot(node, 'cache_class', cls)
+            set_slot(node, 'cache_method', method)
+        elif cached.__class__ is not tuple:
+            set_slot(node, 'cache_class', (cached, cls))
+            set_slot(node, 'cache_method', (node.cache_method, method))
+        elif len(cached) < SITE_ENTRIES:
+            set_slot(node, 'cache_class', cached + (cls,))
+            set_slot(node, 'cache_method', node.cache_method + (method,))
+        else:
+            set_slot(node, 'cache_class', _MEGAMORPHIC)
+            set_slot(node, 'cache_method', None)
+        return method
+
+    def super_send(self, frame, selector, arguments):
+        home = frame.home
+        return self.send_super(home.method, home.variables['self'], selector,
+                               arguments)
+
+    def send_super(self, sender, receiver, selector, arguments):
+        # sends selector to receiver, looking it up from the superclass of
+        # the class that sender (the method sending) was defined in
+        primitive = self.primitives.get(selector)
+        if primitive is not None:
+            return primitive(self, receiver, *arguments)
+        if sender is None:
+            raise OnyxError('super used outside of a method')
+        superclass = sender.owner.superclass
+        method = None
+        if superclass is not None:
+            method = self.method_cache.lookup(superclass, selector)
+        if method is None:
+            return self.does_not_understand(receiver, selector, arguments)
+        return self.invoke(method, receiver, arguments)
+
+    def invoke(self, method, receiver, arguments):
+        while True:
+            variables = dict(zip(method.argument_names, arguments))
+            for name in method.temporary_names:
+                variables[name] = None
+            variables['self'] = receiver
+            frame = Frame(variables, None, None, method)
+            try:
+                value = self.run(method.node.statements, frame, method.tail)
+            except _NonLocalReturn as e:
+                if e.home is not frame:
+                    raise
+                return e.value
+            finally:
+                frame.live = False
+            if value.__class__ is not _TailCall:
+                return value
+            method = value.method
+            receiver = value.receiver
+            arguments = value.arguments
+
+    def call_block(self, block, arguments, tail=False):
+        # the value of the block's body; with tail, that of a tail send in
+        # it is left as a _TailCall
+        if block.__class__ is not Block:
+            raise OnyxError('not a block: {0}'.format(
+                self.print_string(block)))
+        names = block.argument_names
+        if len(arguments) != len(names):
+            raise OnyxError('block takes {0} arguments, got {1}'.format(
+                len(names), len(arguments)))
+        variables = dict(zip(names, arguments))
+        for name in block.temporary_names:
+            variables[name] = None
+        outer = block.frame
+        statements = block.node.statements
+        value = self.run(statements, Frame(variables, outer, outer.home),
+                         tail_position(statements, False))
+        if value.__class__ is _TailCall and not tail:
+            return self.invoke(value.method, value.receiver, value.arguments)
+        return value
+
+    def does_not_understand(self, receiver, selector, arguments):
+        method = self.method_cache.lookup(self.class_of(receiver),
+                                          'doesNotUnderstand:')
+        message_class = self.globals.get('Message')
+        if method is None or not isinstance(message_class, Class):
+            raise OnyxError('{0} does not understand #{1}'.format(
+                self.print_string(receiver), selector), receiver)
+        message = Instance(message_class)
+        index = message_class.variable_index
+        message.ivars[index['selector']] = Symbol(selector)
+        message.ivars[index['arguments']] = list(arguments)
+        return self.invoke(method, receiver, [message])
+
+    # prompts, continuations and marks
+
+    @property
+    def mark_stack(self):
+        # the marks (key, value) and prompts (_PROMPT, tag) installed,
+        # outermost first, for debugging
+        segments = []
+        segment = self.segment
+        while segment is not None:
+            segments.append(segment)
+            segment = segment.parent
+        entries = []
+        for segment in reversed(segments):
+            if segment.prompted:
+                entries.append((_PROMPT, segment.tag))
+            entries.extend(segment.marks)
+        return entries
+
+    def with_mark(self, block, key, value):
+        segment = self.segment
+        entry = self.mark_index.get(id(key))
+        if entry is None:
+            entry = self.mark_index[id(key)] = ([], [])
+        segment.marks.append((key, value))
+        entry[0].append(segment.level)
+        entry[1].append(value)
+        try:
+            return self.call_block(block, ())
+        finally:
+            # looked up again, as parking the segment takes it out of the
+            # index
+            segment.marks.pop()
+            levels, values = self.mark_index[id(key)]
+            levels.pop()
+            values.pop()
+            if not levels:
+                del self.mark_index[id(key)]
+
+    def with_prompt(self, block, tag, abort_block):
+        segment = self.segment = _Segment(tag, self.segment, abort_block)
+        prompts = self.prompt_index.get(id(tag))
+        if prompts is None:
+            prompts = self.prompt_index[id(tag)] = []
+        prompts.append(segment)
+        try:
+            try:
+                value = self.call_block(block, ())
+            finally:
+                self.segment = segment.parent
+                if segment.prompted:
+                    prompts = self.prompt_index[id(tag)]
+                    prompts.pop()
+                    if not prompts:
+                        del self.prompt_index[id(tag)]
+        except _Abort as e:
+            if e.segment is segment:
+                if e.what == 'return':
+                    return e.value
+                elif e.what == 'raise':
+                    raise e.value
+                value = e.value
+            elif segment.channel is None:
+                raise
+            else:
+                return self._leave_resumed(segment, 'raise', e)
+        except Exception as e:
+            if segment.channel is None:
+                raise
+            return self._leave_resumed(segment, 'raise', e)
+        else:
+            if segment.channel is None:
+                return value
+            return self._leave_resumed(segment, 'return', value)
+        return self.call_block(abort_block, (value,))
+
+    def _leave_resumed(self, segment, what, value):
+        # segment, run again from its abort block, has been left: that is
+        # what resuming it does, and what the abort block then does is what
+        # the prompt does
+        channel = segment.channel
+        segment.channel = None
+        channel.to_abort_block.put((what, value))
+        what, value = channel.to_segments.get()
+        if what == 'raise':
+            raise value
+        return value
+
+    def abort(self, tag, value):
+        prompts = self.prompt_index.get(id(tag))
+        if prompts is None:
+            raise OnyxError('abort to a prompt that is not installed: '
+                            '{0}'.format(self.print_string(tag)), value)
+        segment = prompts[-1]
+        if not segment.continuations:
+            raise _Abort(segment, value)
+        self._park(segment, value)
+
+    def _park(self, prompt, value):
+        # runs prompt's abort block in another thread, the segments from
+        # prompt's up waiting here to be resumed.  The worker is got first,
+        # so that if there is none the segments are left as they are.
+        worker = _Worker.get()
+        segments = []
+        segment = self.segment
+        while segment is not prompt:
+            segments.append(segment)
+            segment = segment.parent
+        segments.append(prompt)
+        self._unindex(segments)
+        prompt.prompted = False
+        self.segment = prompt.parent
+        channel = _Channel(segments)
+        for continuation in prompt.continuations:
+            continuation.channel = channel
+        worker.submit(self._run_abort_block, channel, prompt.abort_block,
+                      value)
+        what, value = channel.to_segments.get()
+        for continuation in prompt.continuations:
+            continuation.channel = None
+        if what == 'resume':
+            # put back by resume
+            prompt.channel = channel
+            raise _Resume(*value)
+        self._reindex(segments, self.segment)
+        raise _Abort(prompt, value, what)
+
+    def _run_abort_block(self, channel, abort_block, value):
+        try:
+            message = ('return', self.call_block(abort_block, (value,)))
+        except Exception as e:
+            message = ('raise', e)
+        channel.to_segments.put(message)
+
+    def _unindex(self, segments):
+        # takes segments, innermost first, out of the index
+        for segment in segments:
+            for key, _ in reversed(segment.marks):
+                levels, values = self.mark_index[id(key)]
+                levels.pop()
+                values.pop()
+                if not levels:
+                    del self.mark_index[id(key)]
+            if segment.prompted:
+                prompts = self.prompt_index[id(segment.tag)]
+                prompts.pop()
+                if not prompts:
+                    del self.prompt_index[id(segment.tag)]
+
+    def _reindex(self, segments, parent):
+        # puts segments, innermost first, back on top of parent
+        segments[-1].parent = parent
+        for segment in reversed(segments):
+            segment.level = segment.parent.level + 1
+            if segment.prompted:
+                prompts = self.prompt_index.get(id(segment.tag))
+                if prompts is None:
+                    prompts = self.prompt_index[id(segment.tag)] = []
+                prompts.append(segment)
+            for key, value in segment.marks:
+                entry = self.mark_index.get(id(key))
+                if entry is None:
+                    entry = self.mark_index[id(key)] = ([], [])
+                entry[0].append(segment.level)
+                entry[1].append(value)
+        self.segment = segments[0]
+
+    def with_continuation(self, block, tag):
+        # calls block with its continuation up to the prompt for tag
+        continuation = Continuation(self.globals['Continuation'])
+        prompts = self.prompt_index.get(id(tag))
+        prompt = None
+        if prompts is not None:
+            prompt = prompts[-1]
+            if prompt.continuations is None:
+                prompt.continuations = []
+            prompt.continuations.append(continuation)
+        arguments = (continuation,)
+        try:
+            while True:
+                try:
+                    return self.call_block(block, arguments)
+                except _Resume as e:
+                    if e.continuation is not continuation:
+                        raise
+                    block, arguments = e.block, ()
+        finally:
+            continuation.live = False
+            if prompt is not None:
+                prompt.continuations.remove(continuation)
+
+    def resume(self, continuation, block):
+        if not continuation.live:
+            raise OnyxError('continuation resumed after the primitive '
+                            'capturing it has returned')
+        channel = continuation.channel
+        if channel is None:
+            raise _Resume(continuation, block)
+        # from the abort block of its prompt, with its segments parked
+        self._reindex(channel.segments, self.segment)
+        channel.to_segments.put(('resume', (continuation, block)))
+        what, value = channel.to_abort_block.get()
+        if what == 'raise':
+            raise value
+        return value
+
+    def _prompt_level(self, tag):
+        # the level of the innermost prompt for tag, or of the root segment
+        # if there is none
+        prompts = self.prompt_index.get(id(tag))
+        if prompts is None:
+            return 0
+        return prompts[-1].level
+
+    def marks(self, key, tag):
+        # the values marked with key, innermost first, up to the prompt for
+        # tag
+        entry = self.mark_index.get(id(key))
+        if entry is None:
+            return []
+        levels, values = entry
+        values = values[bisect_left(levels, self._prompt_level(tag)):]
+        values.reverse()
+        return values
+
+    def first_mark(self, key, tag):
+        entry = self.mark_index.get(id(key))
+        if entry is None or entry[0][-1] < self._prompt_level(tag):
+            return None
+        return entry[1][-1]
+
+    # printing and debugging
+
+    def print_string(self, value):
+        if value is None:
+            return 'nil'
+        elif value is self.true:
+            return 'true'
+        elif value is self.false:
+            return 'false'
+        elif value.__class__ is int or value.__class__ is long:
+            return str(value)
+        elif isinstance(value, (str, bytearray)):
+            return "'{0}'".format(value)
+        elif isinstance(value, (Symbol, Character)):
+            return repr(value)
+        elif isinstance(value, list):
+            return '({0})'.format(' '.join(self.print_string(v)
+                                           for v in value))
+        elif isinstance(value, Class):
+            return value.name
+        try:
+            name = self.class_of(value).name
+        except OnyxError:
+            return repr(value)
+        article = 'an' if name[:1] in 'AEIOU' else 'a'
+        return '{0} {1}'.format(article, name)
+
+    def stack_trace(self):
+        # 'Class>>selector' for the methods being run, innermost first,
+        # found on the Python stack so that keeping it costs nothing
+        code = self.invoke.__func__.__code__
+        trace = []
+        frame = sys._getframe()
+        while frame is not None:
+            if frame.f_code is code:
+                method = frame.f_locals['method']
+                trace.append('{0}>>{1}'.format(method.owner.name,
+                                               method.selector))
+            frame = frame.f_back
+        return trace
@@ -0,0 +1,195 @@
+import marshal
+
+from .cache import (cache_path, decode, encode, read_cache, source_key,
+                    write_cache)
+from .location import LineIndex, SourceError
+from .parser import Parser
+from .reader import FastReader, ReadError
+
+try:
+    from concurrent.futures import ProcessPoolExecutor
+except ImportError:
+    ProcessPoolExecutor = None
+
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+
+# Below SERIAL_SIZE bytes in all, the files are parsed in this process, a
+# pool costing more to start than it saves.  Files over CHUNK_SIZE bytes are
+# split into chunks of about that size.
+SERIAL_SIZE = 64 * 1024
+CHUNK_SIZE = 64 * 1024
+
+
+class LoadError(Exception):
+    # The SourceErrors of the files that failed to load, located and in the
+    # order the files were given, each being the first error in its file.
+    def __init__(self, errors):
+        super(LoadError, self).__init__(errors)
+        self.errors = errors
+
+    def __str__(self):
+        return '\n'.join(str(error) for error in self.errors)
+
+
+def item_boundaries(source, reader_class=FastReader):
+    # Offsets in source that top-level items (class definitions and
+    # statements) start at, found by reading the top-level terms without
+    # reading inside their compounds, so parsing from each of them gives the
+    # same items as parsing the whole source.  The first is 0.
+    try:
+        terms = list(reader_class(source, lazy_depth=0))
+    except ReadError:
+        # parsed whole, so the error is the one the whole source gives
+        return [0]
+    boundaries = [0]
+    index = 0
+    while index < len(terms):
+        if index > 0:
+            boundaries.append(terms[index - 1].end)
+        if (index + 3 < len(terms) and terms[index].is_id and
+                terms[index + 1].is_keyword and
+                terms[index + 1].value == 'subclass:' and
+                terms[index + 2].is_id and terms[index + 3].is_compound and
+                terms[index + 3].shape == '[]'):
+            index += 4
+            continue
+        while index < len(terms):
+            term = terms[index]
+            index += 1
+            if term.is_delimiter and term.value == '.':
+                break
+    return boundaries
+
+
+def chunk(source, chunk_size=CHUNK_SIZE, reader_class=FastReader):
+    # (start, end) ranges of source, split at item boundaries, of at least
+    # chunk_size bytes each except maybe the last
+    if len(source) <= chunk_size:
+        return [(0, len(source))]
+    ranges = []
+    start = 0
+    for boundary in item_boundaries(source, reader_class):
+        if boundary - start >= chunk_size:
+            ranges.append((start, boundary))
+            start = boundary
+    ranges.append((start, len(source)))
+    return ranges
+
+
+def parse_range(source, start, end, reader_class=FastReader,
+                parser_class=Parser, offset=0):
+    # Parses source[start:end], where source is the text of a file from
+    # offset on.  Positions (and those of errors) are offsets into the whole
+    # file: the parser adds offset to those of the nodes and its errors,
+    # and it is added to those of read errors here.
+    parser = parser_class(reader_class(source, start, end))
+    parser.tokens.base = offset
+    try:
+        return list(parser.parse_file())
+    except ReadError as e:
+        if e.position is not None:
+            e.position += offset
+        raise
+
+
+def _parse_task(task):
+    # runs in a worker; the definitions go back marshalled, which is much
+    # smaller and quicker to send than the pickled nodes
+    try:
+        definitions = parse_range(*task)
+    except SourceError as e:
+        return False, e
+    return True, marshal.dumps([encode(d) for d in definitions])
+
+
+def _map(function, tasks, workers):
+    if ProcessPoolExecutor is not None:
+        with ProcessPoolExecutor(workers) as executor:
+            return list(executor.map(function, tasks))
+    pool = multiprocessing.Pool(workers)
+    try:
+        return pool.map(function, tasks, 1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def load_files(filenames, workers=None, cache_dir=None,
+               reader_class=FastReader, parser_class=Parser,
+               chunk_size=CHUNK_SIZE, serial_size=SERIAL_SIZE):
+    # Parses the files across a pool of worker processes (workers of them,
+    # by default one per CPU) and returns their definitions, a list per
+    # file, using and updating the parse cache as load_file does.  Large
+    # files are split into chunks at top-level items, so reader_class must
+    # take a range of its source like StringReader.  If any file fails to
+    # parse, LoadError is raised once all of them have been tried.
+    sources = []
+    results = [None] * len(filenames)
+    for filename in filenames:
+        with open(filename, 'rb') as f:
+            sources.append(f.read())
+    keys = [source_key(source) for source in sources]
+    paths = [cache_path(filename, cache_dir) for filename in filenames]
+
+    pending = []
+    for index, source in enumerate(sources):
+        results[index] = read_cache(paths[index], keys[index])
+        if results[index] is None:
+            pending.append(index)
+
+    if workers is None and multiprocessing is not None:
+        workers = multiprocessing.cpu_count()
+    size = sum(len(sources[index]) for index in pending)
+    if (size < serial_size or workers == 1 or
+            (ProcessPoolExecutor is None and multiprocessing is None)):
+        outcomes = []
+        for index in pending:
+            try:
+                outcomes.append([(True, parse_range(
+                    sources[index], 0, len(sources[index]), reader_class,
+                    parser_class))])
+            except SourceError as e:
+                outcomes.append([(False, e)])
+    else:
+        tasks = []
+        owners = []
+        for index in pending:
+            source = sources[index]
+            for start, end in chunk(source, chunk_size, reader_class):
+                # only the chunk's text is sent to the worker
+                tasks.append((source[start:end], 0, end - start,
+                              reader_class, parser_class, start))
+                owners.append(index)
+        outcomes = [[] for _ in pending]
+        slots = dict((index, n) for n, index in enumerate(pending))
+        for owner, (ok, value) in zip(owners,
+                                      _map(_parse_task, tasks, workers)):
+            if ok:
+                value = [decode(d) for d in marshal.loads(value)]
+            outcomes[slots[owner]].append((ok, value))
+
+    errors = []
+    for index, chunks in zip(pending, outcomes):
+        definitions = []
+        for ok, value in chunks:
+            if not ok:
+                # the first error in the file is the one in its first chunk
+                # that failed, as parsing it whole would have found
+                errors.append(value.locate(LineIndex(sources[index]),
+                                           filenames[index]))
+                definitions = None
+                break
+            definitions.extend(value)
+        if definitions is None:
+            continue
+        results[index] = definitions
+        try:
+            write_cache(paths[index], keys[index], definitions)
+        except (IOError, OSError):
+            pass
+    if errors:
+        raise LoadError(errors)
+    return results
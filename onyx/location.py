@@ -0,0 +1,58 @@
+from bisect import bisect_right
+
+
+class LineIndex(object):
+    # Maps source offsets to (line, column), both counted from 1, by binary
+    # search over the offsets that lines start at.  Build one per source;
+    # it works on anything with find(), mmaps included.
+    __slots__ = ('_starts',)
+
+    def __init__(self, source):
+        starts = [0]
+        position = source.find('\n')
+        while position >= 0:
+            starts.append(position + 1)
+            position = source.find('\n', position + 1)
+        self._starts = starts
+
+    def __len__(self):
+        return len(self._starts)
+
+    def location(self, offset):
+        line = bisect_right(self._starts, offset)
+        return line, offset - self._starts[line - 1] + 1
+
+    def offset(self, line, column):
+        return self._starts[line - 1] + column - 1
+
+
+class SourceError(Exception):
+    # An error at the source offset position (None where it isn't known).
+    # Whoever has the source can locate() it, adding the line, column and
+    # filename to its message.
+    def __init__(self, message, position=None):
+        super(SourceError, self).__init__(message, position)
+        self.position = position
+        self.filename = None
+        self.line = None
+        self.column = None
+
+    def locate(self, lines, filename=None):
+        if filename is not None:
+            self.filename = filename
+        if self.position is not None and self.line is None:
+            self.line, self.column = lines.location(self.position)
+        return self
+
+    def __str__(self):
+        message = self.args[0]
+        if self.line is not None:
+            where = '{0}:{1}'.format(self.line, self.column)
+            if self.filename is not None:
+                where = '{0}:{1}'.format(self.filename, where)
+            return '{0}: {1}'.format(where, message)
+        if self.filename is not None:
+            return '{0}: {1}'.format(self.filename, message)
+        if self.position is not None:
+            return '{0} (at offset {1})'.format(message, self.position)
+        return message
@@ -1,77 +1,240 @@
-from itertools import chain
+from .term import (AssignTerm, BinarySend, BlockTerm, CascadeSend, ClassTerm,
+                   EscapeTerm, Identifier, KeywordSend, LiteralTerm,
+                   MethodTerm, Term, UnarySend)
+from .location import SourceError
+from .reader import UnreadTerms
+from .util.stream import EmptyStreamError
 
-from .term import (AssignTerm, BinarySend, BlockTerm, CascadeSend, EscapeTerm,
-                   Identifier, KeywordSend, Term, UnarySend)
-from .util.stream import EmptyStreamError, Stream
 
-
-class ParseError(Exception):
+class ParseError(SourceError):
     pass
 
 
+def _located(node, start, end):
+    node.start = start
+    node.end = end
+    return node
+
+
+class TokenBuffer(object):
+    # Terms are pulled from the source iterator into a flat list on demand
+    # and addressed by index.  A list source (e.g. the value of a compound
+    # term) is used in place and only copied if a term is pushed back into
+    # it.  Terms consumed from an iterator are periodically dropped, keeping
+    # one behind the cursor so pushback can overwrite it.
+    #
+    # enter() switches to the terms of a compound, saving the current
+    # position as a frame, and leave() returns to it.  base is the source
+    # offset that the positions of the current terms are relative to.
+    __slots__ = ('_terms', '_index', '_source', '_owned', '_frames', 'base')
+    compact_size = 256
+
+    def __init__(self, source):
+        if isinstance(source, list):
+            self._terms = source
+            self._source = None
+            self._owned = False
+        else:
+            self._terms = []
+            self._source = iter(source)
+            self._owned = True
+        self._index = 0
+        self._frames = []
+        self.base = 0
+
+    def enter(self, terms, base=None):
+        self._frames.append(
+            (self._terms, self._index, self._source, self._owned, self.base))
+        self._terms = terms
+        self._index = 0
+        self._source = None
+        self._owned = False
+        if base is not None:
+            self.base = base
+
+    def leave(self):
+        (self._terms, self._index,
+         self._source, self._owned, self.base) = self._frames.pop()
+
+    @property
+    def depth(self):
+        return len(self._frames)
+
+    def _fill(self, index):
+        source = self._source
+        if source is None:
+            return False
+        terms = self._terms
+        if self._index > self.compact_size and self._index * 2 > len(terms):
+            del terms[:self._index - 1]
+            index -= self._index - 1
+            self._index = 1
+        while len(terms) <= index:
+            try:
+                terms.append(next(source))
+            except StopIteration:
+                self._source = None
+                return False
+        return True
+
+    def has(self, n=0):
+        index = self._index + n
+        return index < len(self._terms) or self._fill(index)
+
+    def at_end(self):
+        return not self.has(0)
+
+    def peek(self, n=0):
+        index = self._index + n
+        if index >= len(self._terms) and not self._fill(index):
+            raise EmptyStreamError()
+        return self._terms[self._index + n]
+
+    @property
+    def position(self):
+        return self._index
+
+    @property
+    def terms(self):
+        return self._terms
+
+    def advance(self):
+        self._index += 1
+
+    def pushback(self, term):
+        if not self._owned:
+            self._terms = list(self._terms)
+            self._owned = True
+        if self._index == 0:
+            self._terms.insert(0, term)
+        else:
+            self._index -= 1
+            self._terms[self._index] = term
+
+
+class LazyMethodBody(object):
+    __slots__ = ('parser_class', 'terms')
+
+    def __init__(self, parser_class, terms):
+        self.parser_class = parser_class
+        self.terms = terms
+
+    def parse(self):
+        parser = self.parser_class(self.terms.reader())
+        parser.tokens.base = self.terms.start
+        temporary_variables, statements = parser.parse_executable_code()
+        parser.assert_at_end()
+        return temporary_variables, statements
+
+
 class Parser(object):
     def __init__(self, reader):
-        self.stream = Stream.from_sequence(reader)
+        self.tokens = TokenBuffer(reader)
 
     def step(self):
-        self.stream = self.stream.rest
+        self.tokens.advance()
 
     def at_end(self):
-        return self.stream.is_empty
+        return self.tokens.at_end()
+
+    def current_term(self):
+        return self.tokens.peek()
+
+    def term_offset(self, term):
+        if term.start is None:
+            return None
+        return self.tokens.base + term.start
+
+    def term_end_offset(self, term):
+        if term.end is None:
+            return None
+        return self.tokens.base + term.end
+
+    def error(self, message):
+        # a ParseError at the current term, if there is one
+        position = None
+        if self.tokens.has():
+            position = self.term_offset(self.tokens.peek())
+        return ParseError(message, position)
 
     def assert_at_end(self):
         if not self.at_end():
-            raise ParseError(
-                "Expected no more terms.  Got: {0}".format(self.stream.first))
+            raise self.error(
+                "Expected no more terms.  Got: {0}".format(
+                    self.current_term()))
 
     def assert_term_value(self, value):
-        term = self.stream.first
+        term = self.current_term()
         term_value = term.value
         if term_value != value:
-            raise ParseError("Expected term value: {0}, "
+            raise self.error("Expected term value: {0}, "
                              "got: {1}".format(value, term_value))
 
     def assert_term_compound(self, shape):
-        term = self.stream.first
+        term = self.current_term()
         if not (term.is_compound and term.shape == shape):
-            raise ParseError("Expected compound with shape {0!r}, "
+            raise self.error("Expected compound with shape {0!r}, "
                              "got: {1}".format(shape, term))
 
     def assert_term_kind(self, kind):
-        term = self.stream.first
+        term = self.current_term()
         value = getattr(term, kind, False)
         if not value:
-            raise ParseError(
+            raise self.error(
                 "Expected term kind {0!r}, got: {1}".format(kind, term))
 
     def push_term(self, value, kind):
-        term = Term(value, kind)
-        it = chain([term], self.stream)
-        self.stream = Stream.from_sequence(it)
+        self.tokens.pushback(Term(value, kind))
 
     def peek_for_assignment(self):
-        if not self.stream.is_empty and self.stream.first.is_id:
-            rest = self.stream.rest
-            return not rest.is_empty and rest.first.is_assignment
-        return False
-
-
-    def subparse(self, shape, parse_name):
+        tokens = self.tokens
+        return (tokens.has(1) and tokens.peek().is_id and
+                tokens.peek(1).is_assignment)
+
+    def peek_for_negative_literal(self):
+        tokens = self.tokens
+        if not tokens.has(1):
+            return False
+        term = tokens.peek()
+        number = tokens.peek(1)
+        return (term.is_binsel and term.value == '-' and number.is_integer and
+                term.end is not None and term.end == number.start)
+
+    def peek_for_class_definition(self):
+        tokens = self.tokens
+        if not tokens.has(3):
+            return False
+        body = tokens.peek(3)
+        return (tokens.peek().is_id and tokens.peek(1).is_keyword and
+                tokens.peek(1).value == 'subclass:' and
+                tokens.peek(2).is_id and body.is_compound and
+                body.shape == '[]')
+
+    def subparse(self, shape, parse_name, *args):
         self.assert_term_compound(shape)
-        parser = self.__class__(self.stream.first.value)
-        parse_method = getattr(parser, parse_name)
-        term = parse_method()
-        parser.assert_at_end()
+        compound = self.current_term()
+        terms = compound.value
+        if isinstance(terms, UnreadTerms):
+            terms = list(terms.reader(lazy=True))
+        tokens = self.tokens
+        tokens.enter(terms, self.term_offset(compound))
+        try:
+            term = getattr(self, parse_name)(*args)
+            self.assert_at_end()
+        finally:
+            tokens.leave()
         self.step()
         return term
 
     def parse_block_arguments(self):
         arguments = []
-        if not self.at_end() and self.stream.first.is_block_argument:
+        if not self.at_end() and self.current_term().is_block_argument:
             while not self.at_end():
-                term = self.stream.first
+                term = self.current_term()
                 if term.is_block_argument:
-                    arguments.append(term.as_identifier())
+                    arguments.append(_located(term.as_identifier(),
+                                              self.term_offset(term),
+                                              self.term_end_offset(term)))
                     self.step()
                 elif term.is_binsel and term.value == '|':
                     self.step()
@@ -81,7 +244,7 @@ class Parser(object):
                     self.push_term('|', 'binsel')
                     break
                 else:
-                    raise ParseError('not a block argument')
+                    raise self.error('not a block argument')
         return arguments
 
     def parse_block(self):
@@ -95,48 +258,66 @@ class Parser(object):
         while not self.at_end():
             statement = self.parse_statement()
             statements.append(statement)
-            if self.at_end() or not self.stream.first.value == '.':
+            if self.at_end() or not self.current_term().value == '.':
                 break
             self.step()
         return temporary_variables, statements
 
     def parse_primary(self):
         try:
-            term = self.stream.first
+            term = self.current_term()
 
+            start = self.term_offset(term)
             if term.is_id:
-                term = Identifier(term.value)
+                term = _located(Identifier(term.value), start,
+                                self.term_end_offset(term))
+                self.step()
+            elif term.is_integer or term.is_string:
+                term = _located(LiteralTerm(term.value), start,
+                                self.term_end_offset(term))
+                self.step()
+            elif self.peek_for_negative_literal():
+                self.step()
+                number = self.current_term()
+                term = _located(LiteralTerm(-number.value), start,
+                                self.term_end_offset(number))
                 self.step()
             elif term.is_compound:
+                # a parenthesized expression's text includes the parentheses
+                end = self.term_end_offset(term)
                 if term.shape == '()':
-                    term = self.subparse('()', 'parse_expression')
+                    term = _located(self.subparse('()', 'parse_expression'),
+                                    start, end)
                 elif term.shape == '[]':
-                    term = self.subparse('[]', 'parse_block')
+                    term = _located(self.subparse('[]', 'parse_block'),
+                                    start, end)
                 else:
-                    raise ParseError('should write this...')
+                    raise self.error('should write this...')
             else:
-                raise ParseError('Expected primary')
+                raise self.error('Expected primary')
             while not self.at_end():
-                next_term = self.stream.first
+                next_term = self.current_term()
                 if not next_term.is_id:
                     break
-                term = UnarySend(term, next_term.value)
+                term = _located(UnarySend(term, next_term.value), term.start,
+                                self.term_end_offset(next_term))
                 self.step()
             return term
         except EmptyStreamError as e:
-            raise ParseError('End of stream encountered, expected primary', e)
+            raise self.error('End of stream encountered, expected primary')
 
     def parse_binary(self):
         term = self.parse_primary()
 
         while not self.at_end():
-            next_term = self.stream.first
+            next_term = self.current_term()
             if not next_term.is_binsel:
                 break
             message = next_term.value
             self.step()
             argument = self.parse_primary()
-            term = BinarySend(term, message, [argument])
+            term = _located(BinarySend(term, message, [argument]),
+                            term.start, argument.end)
         return term
 
     def parse_keyword(self):
@@ -144,14 +325,15 @@ class Parser(object):
         name, arguments = self.parse_keyword_extension(self.parse_binary)
 
         if name != "":
-            term = KeywordSend(term, name, arguments)
+            term = _located(KeywordSend(term, name, arguments), term.start,
+                            arguments[-1].end)
         return term
 
     def parse_keyword_extension(self, parse_argument):
         name = []
         arguments = []
         while not self.at_end():
-            term = self.stream.first
+            term = self.current_term()
             if not term.is_keyword:
                 break
             name.append(term.value)
@@ -164,59 +346,68 @@ class Parser(object):
         term = self.parse_keyword()
         messages = []
         while not self.at_end():
-            next_term = self.stream.first
+            next_term = self.current_term()
             if not (next_term.is_delimiter and next_term.value == ';'):
                 break
             self.step()
-            next_term = self.stream.first
+            next_term = self.current_term()
             arguments = []
             name = next_term.value
+            start = self.term_offset(next_term)
             if next_term.is_id:
+                end = self.term_end_offset(next_term)
                 self.step()
                 message = UnarySend(None, name, arguments)
             elif next_term.is_binsel:
                 self.step()
                 arguments.append(self.parse_primary())
+                end = arguments[-1].end
                 message = BinarySend(None, name, arguments)
             elif next_term.is_keyword:
                 name, arguments = \
                     self.parse_keyword_extension(self.parse_binary)
+                end = arguments[-1].end
                 message = KeywordSend(None, name, arguments)
             else:
-                raise ParseError('Expected message cascade part')
+                raise self.error('Expected message cascade part')
 
-            messages.append(message)
+            messages.append(_located(message, start, end))
 
         if messages != []:
             receiver = term.receiver
             term.receiver = None
-            term = CascadeSend(receiver, [term] + messages)
+            term = _located(CascadeSend(receiver, [term] + messages),
+                            term.start, messages[-1].end)
         return term
 
     def parse_expression(self):
         if self.peek_for_assignment():
             lhs = self.parse_identifier()
             self.step()
-            return AssignTerm(lhs, self.parse_expression())
+            rhs = self.parse_expression()
+            return _located(AssignTerm(lhs, rhs), lhs.start, rhs.end)
         return self.parse_cascade()
 
     def parse_statement(self):
-        wrapper = lambda x: x
-        term = self.stream.first
+        term = self.current_term()
         if term.is_delimiter and term.value == '^':
+            start = self.term_offset(term)
             self.step()
-            wrapper = EscapeTerm
-        return wrapper(self.parse_expression())
+            expression = self.parse_expression()
+            return _located(EscapeTerm(expression), start, expression.end)
+        return self.parse_expression()
 
     def parse_temporary_variables(self):
-        term = self.stream.first
         names = []
+        if self.at_end():
+            return names
+        term = self.current_term()
         if term.is_binsel and term.value == '|':
             self.step()
-            term = self.stream.first
+            term = self.current_term()
             while term.is_id:
                 names.append(self.parse_identifier())
-                term = self.stream.first
+                term = self.current_term()
             self.assert_term_kind('is_binsel')
             self.assert_term_value('|')
             self.step()
@@ -226,12 +417,14 @@ class Parser(object):
 
     def parse_identifier(self):
         self.assert_term_kind('is_id')
-        identifier = self.stream.first.as_identifier()
+        term = self.current_term()
+        identifier = _located(term.as_identifier(), self.term_offset(term),
+                              self.term_end_offset(term))
         self.step()
         return identifier
 
     def parse_method_header(self):
-        term = self.stream.first
+        term = self.current_term()
         arguments = []
         if term.is_id:
             name = term.value
@@ -244,8 +437,76 @@ class Parser(object):
             name, arguments = \
                 self.parse_keyword_extension(self.parse_identifier)
         else:
-            raise ParseError(
+            raise self.error(
                 "Expected id, binary selector, or keyword. "
                 "got: {0}".format(term))
         return name, arguments
 
+    def parse_method_definition(self):
+        start = self.term_offset(self.current_term())
+        name, arguments = self.parse_method_header()
+        return self.parse_method_body(name, arguments, start)
+
+    def parse_method_body(self, name, arguments, start=None):
+        self.assert_term_compound('[]')
+        body = self.current_term()
+        end = self.term_end_offset(body)
+        if isinstance(body.value, UnreadTerms):
+            self.step()
+            return MethodTerm(name, arguments, span=(start, end),
+                              body=LazyMethodBody(self.__class__, body.value))
+        temporary_variables, statements = \
+            self.subparse('[]', 'parse_executable_code')
+        return MethodTerm(name, arguments, temporary_variables, statements,
+                          (start, end))
+
+    def parse_class_body(self, name, class_side=False):
+        instance_variables = self.parse_temporary_variables()
+        methods = []
+        class_instance_variables = []
+        class_methods = []
+        while not self.at_end():
+            term = self.current_term()
+            if term.is_id and self.tokens.has(1) and self.tokens.peek(1).is_id:
+                if class_side or term.value != name:
+                    raise self.error(
+                        "Expected class side of {0}, got: {1}".format(
+                            name, term))
+                self.step()
+                self.assert_term_value('class')
+                self.step()
+                class_body = self.subparse('[]', 'parse_class_body', name,
+                                           True)
+                class_instance_variables.extend(class_body[0])
+                class_methods.extend(class_body[1])
+            else:
+                methods.append(self.parse_method_definition())
+        return (instance_variables, methods,
+                class_instance_variables, class_methods)
+
+    def parse_class_definition(self):
+        start = self.term_offset(self.current_term())
+        superclass = self.parse_identifier().name
+        self.assert_term_value('subclass:')
+        self.step()
+        name = self.parse_identifier().name
+        end = self.term_end_offset(self.current_term())
+        body = self.subparse('[]', 'parse_class_body', name)
+        return ClassTerm(name, superclass, *body, span=(start, end))
+
+    def parse_file(self):
+        while not self.at_end():
+            yield self.parse_file_item()
+
+    def parse_file_item(self):
+        if self.peek_for_class_definition():
+            return self.parse_class_definition()
+        statement = self.parse_statement()
+        if not self.at_end():
+            term = self.current_term()
+            if term.is_delimiter and term.value == '.':
+                self.step()
+            elif not self.peek_for_class_definition():
+                raise self.error(
+                    "Expected '.' or class definition, got: {0}".format(term))
+        return statement
@@ -0,0 +1,361 @@
+from .runtime import (Character, Class, Continuation, Halt, Instance,
+                      OnyxError, Symbol)
+
+# The primitives that system.ost is written in terms of.  A primitive is a
+# message whose selector starts with '_', which any object understands: the
+# interpreter calls the function registered for the selector here with
+# itself, the receiver and the arguments.  A primitive fails by raising
+# OnyxError.
+PRIMITIVES = {}
+
+# The functions to call instead of these primitives' when they are a tail
+# send, which may return a _TailCall for the interpreter to invoke.
+TAIL_PRIMITIVES = {}
+
+
+def primitive(selector):
+    def register(function):
+        PRIMITIVES[selector] = function
+        return function
+    return register
+
+
+def _fail(selector, *values):
+    return OnyxError('primitive {0} failed: {1}'.format(
+        selector, ', '.join(repr(value) for value in values)))
+
+
+def _is_int(value):
+    return (value.__class__ is int or value.__class__ is long)
+
+
+def _is_string(value):
+    # literal strings are Python strings, and those made at run time (which
+    # can be changed) bytearrays
+    return isinstance(value, (str, bytearray))
+
+
+def _index(selector, sequence, index):
+    if not (_is_int(index) and 0 <= index < len(sequence)):
+        raise _fail(selector, sequence, index)
+    return index
+
+
+# objects
+
+@primitive('_objectEqual:')
+def object_equal(interpreter, receiver, other):
+    # integers have no identity of their own (nor do characters and
+    # symbols, but they are interned)
+    if receiver is other or (_is_int(receiver) and _is_int(other) and
+                             receiver == other):
+        return interpreter.true
+    return interpreter.false
+
+
+@primitive('_objectClass')
+def object_class(interpreter, receiver):
+    return interpreter.class_of(receiver)
+
+
+@primitive('_objectStackTrace')
+def object_stack_trace(interpreter, receiver):
+    return interpreter.stack_trace()
+
+
+@primitive('_objectDebug')
+def object_debug(interpreter, receiver):
+    interpreter.output.write(interpreter.print_string(receiver) + '\n')
+    return receiver
+
+
+@primitive('_objectHalt')
+def object_halt(interpreter, receiver):
+    raise Halt('halt', receiver)
+
+
+@primitive('_objectAbort:')
+def object_abort(interpreter, receiver, prompt_tag):
+    interpreter.abort(prompt_tag, receiver)
+
+
+@primitive('_systemIsBroken:')
+def system_is_broken(interpreter, receiver, message):
+    if message is None:
+        message = 'unhandled {0}'.format(interpreter.print_string(receiver))
+        not_understood = _ivar(receiver, 'message')
+        if _ivar(not_understood, 'selector') is not None:
+            message = '{0}: {1} does not understand {2!r}'.format(
+                message, interpreter.print_string(_ivar(receiver, 'receiver')),
+                _ivar(not_understood, 'selector'))
+    raise OnyxError(message, receiver)
+
+
+def _ivar(value, name):
+    # the instance variable name of value, or None if it hasn't one
+    if not isinstance(value, Instance):
+        return None
+    index = value.cls.variable_index.get(name)
+    if index is None:
+        return None
+    return value.ivars[index]
+
+
+# classes
+
+@primitive('_classNew')
+def class_new(interpreter, receiver):
+    if not isinstance(receiver, Class):
+        raise _fail('_classNew', receiver)
+    return Instance(receiver)
+
+
+@primitive('_classSuperclass')
+def class_superclass(interpreter, receiver):
+    if not isinstance(receiver, Class):
+        raise _fail('_classSuperclass', receiver)
+    return receiver.superclass
+
+
+@primitive('_className')
+def class_name(interpreter, receiver):
+    if not isinstance(receiver, Class):
+        raise _fail('_className', receiver)
+    return receiver.name
+
+
+# blocks and continuations
+
+@primitive('_blockValue')
+def block_value(interpreter, receiver):
+    return interpreter.call_block(receiver, ())
+
+
+@primitive('_blockValue:')
+def block_value_1(interpreter, receiver, a):
+    return interpreter.call_block(receiver, (a,))
+
+
+@primitive('_blockValue:value:')
+def block_value_2(interpreter, receiver, a, b):
+    return interpreter.call_block(receiver, (a, b))
+
+
+@primitive('_blockValue:value:value:')
+def block_value_3(interpreter, receiver, a, b, c):
+    return interpreter.call_block(receiver, (a, b, c))
+
+
+@primitive('_blockValue:value:value:value:')
+def block_value_4(interpreter, receiver, a, b, c, d):
+    return interpreter.call_block(receiver, (a, b, c, d))
+
+
+def _tail_block_value(interpreter, receiver, *arguments):
+    # the block's own tail send is left to the caller
+    return interpreter.call_block(receiver, arguments, True)
+
+
+for _function in (block_value, block_value_1, block_value_2, block_value_3,
+                  block_value_4):
+    TAIL_PRIMITIVES[_function] = _tail_block_value
+
+
+@primitive('_blockWithPrompt:abort:')
+def block_with_prompt(interpreter, receiver, prompt_tag, abort_block):
+    return interpreter.with_prompt(receiver, prompt_tag, abort_block)
+
+
+@primitive('_blockWithCont:')
+def block_with_cont(interpreter, receiver, prompt_tag):
+    return interpreter.with_continuation(receiver, prompt_tag)
+
+
+@primitive('_blockWithMark:value:')
+def block_with_mark(interpreter, receiver, key, value):
+    return interpreter.with_mark(receiver, key, value)
+
+
+@primitive('_continuationDo:')
+def continuation_do(interpreter, receiver, block):
+    if not isinstance(receiver, Continuation):
+        raise _fail('_continuationDo:', receiver)
+    return interpreter.resume(receiver, block)
+
+
+@primitive('_continuationFirstMark:')
+def continuation_first_mark(interpreter, receiver, prompt_tag):
+    return interpreter.first_mark(receiver, prompt_tag)
+
+
+@primitive('_continuationMarks:')
+def continuation_marks(interpreter, receiver, prompt_tag):
+    return interpreter.marks(receiver, prompt_tag)
+
+
+# small integers
+
+def _arithmetic(selector, operation):
+    def function(interpreter, receiver, other):
+        if not (_is_int(receiver) and _is_int(other)):
+            raise _fail(selector, receiver, other)
+        return operation(receiver, other)
+    return primitive(selector)(function)
+
+
+def _quo(a, b):
+    # truncated towards zero
+    if b == 0:
+        raise _fail('_smallIntQuo:', a, b)
+    q = abs(a) // abs(b)
+    if (a < 0) != (b < 0):
+        return -q
+    return q
+
+
+_arithmetic('_addSmallInt:', lambda a, b: a + b)
+_arithmetic('_smallIntSub:', lambda a, b: a - b)
+_arithmetic('_mulSmallInt:', lambda a, b: a * b)
+_arithmetic('_smallIntQuo:', _quo)
+
+
+@primitive('_smallIntLt:')
+def small_int_lt(interpreter, receiver, other):
+    if not (_is_int(receiver) and _is_int(other)):
+        raise _fail('_smallIntLt:', receiver, other)
+    if receiver < other:
+        return interpreter.true
+    return interpreter.false
+
+
+@primitive('_smallIntIsOdd')
+def small_int_is_odd(interpreter, receiver):
+    if not _is_int(receiver):
+        raise _fail('_smallIntIsOdd', receiver)
+    if receiver & 1:
+        return interpreter.true
+    return interpreter.false
+
+
+# characters, strings and symbols
+
+@primitive('_characterClassCodePoint:')
+def character_class_code_point(interpreter, receiver, code):
+    if not (_is_int(code) and 0 <= code <= 0x10ffff):
+        raise _fail('_characterClassCodePoint:', code)
+    return Character(code)
+
+
+@primitive('_characterCodePoint')
+def character_code_point(interpreter, receiver):
+    if not isinstance(receiver, Character):
+        raise _fail('_characterCodePoint', receiver)
+    return receiver.code
+
+
+@primitive('_stringAsSymbol')
+def string_as_symbol(interpreter, receiver):
+    if not _is_string(receiver):
+        raise _fail('_stringAsSymbol', receiver)
+    return Symbol(str(receiver))
+
+
+@primitive('_symbolAsString')
+def symbol_as_string(interpreter, receiver):
+    if not isinstance(receiver, Symbol):
+        raise _fail('_symbolAsString', receiver)
+    return receiver.name
+
+
+@primitive('_stringNew:')
+def string_new(interpreter, receiver, size):
+    if not (_is_int(size) and size >= 0):
+        raise _fail('_stringNew:', size)
+    return bytearray(size)
+
+
+@primitive('_stringCopy')
+def string_copy(interpreter, receiver):
+    if not _is_string(receiver):
+        raise _fail('_stringCopy', receiver)
+    return bytearray(receiver)
+
+
+@primitive('_stringIsMutable')
+def string_is_mutable(interpreter, receiver):
+    if not _is_string(receiver):
+        raise _fail('_stringIsMutable', receiver)
+    if isinstance(receiver, bytearray):
+        return interpreter.true
+    return interpreter.false
+
+
+@primitive('_stringAt:')
+def string_at(interpreter, receiver, index):
+    if not _is_string(receiver):
+        raise _fail('_stringAt:', receiver)
+    index = _index('_stringAt:', receiver, index)
+    if isinstance(receiver, bytearray):
+        return Character(receiver[index])
+    return Character(ord(receiver[index]))
+
+
+@primitive('_stringAt:put:')
+def string_at_put(interpreter, receiver, index, character):
+    if not (isinstance(receiver, bytearray) and
+            isinstance(character, Character) and character.code < 256):
+        raise _fail('_stringAt:put:', receiver, index, character)
+    receiver[_index('_stringAt:put:', receiver, index)] = character.code
+    return character
+
+
+@primitive('_stringSize')
+def string_size(interpreter, receiver):
+    if not _is_string(receiver):
+        raise _fail('_stringSize', receiver)
+    return len(receiver)
+
+
+@primitive('_stringConcat:')
+def string_concat(interpreter, receiver, other):
+    if not (_is_string(receiver) and _is_string(other)):
+        raise _fail('_stringConcat:', receiver, other)
+    return receiver + other
+
+
+# arrays
+
+@primitive('_arrayNew:')
+def array_new(interpreter, receiver, size):
+    if not (_is_int(size) and size >= 0):
+        raise _fail('_arrayNew:', size)
+    return [None] * size
+
+
+@primitive('_arraySize')
+def array_size(interpreter, receiver):
+    if receiver.__class__ is not list:
+        raise _fail('_arraySize', receiver)
+    return len(receiver)
+
+
+@primitive('_arrayAt:')
+def array_at(interpreter, receiver, index):
+    if receiver.__class__ is not list:
+        raise _fail('_arrayAt:', receiver)
+    return receiver[_index('_arrayAt:', receiver, index)]
+
+
+@primitive('_arrayAt:put:')
+def array_at_put(interpreter, receiver, index, value):
+    if receiver.__class__ is not list:
+        raise _fail('_arrayAt:put:', receiver)
+    receiver[_index('_arrayAt:put:', receiver, index)] = value
+    return value
+
+
+@primitive('_arrayAppend:')
+def array_append(interpreter, receiver, other):
+    if receiver.__class__ is not list or other.__class__ is not list:
+        raise _fail('_arrayAppend:', receiver, other)
+    return receiver + other
@@ -0,0 +1,556 @@
+from .analysis import (INLINED_SELECTORS, SEND_CLASSES, children,
+                       has_block_return, inlined_children, is_inlined,
+                       is_super, tail_position)
+from .compiler import JUMP_FALSE, JUMP_TRUE, SendSite, _BRANCHES
+from .interpreter import _NonLocalReturn
+from .runtime import OnyxError
+from .term import (AssignTerm, BinarySend, BlockTerm, CascadeSend,
+                   EscapeTerm, Identifier, KeywordSend, LiteralTerm,
+                   UnarySend)
+
+_PSEUDO_VARIABLES = frozenset(['self', 'super', 'nil', 'true', 'false'])
+
+_CONSTANTS = {'nil': 'None', 'true': 'vm.true', 'false': 'vm.false'}
+
+# the tests of an inlined branch's receiver, by the jump compiler.Compiler
+# has for it: for running its first arm and its second
+_TESTS = {
+    JUMP_FALSE: ('{0} is vm.true', '{0} is vm.false'),
+    JUMP_TRUE: ('{0} is vm.false', '{0} is vm.true'),
+}
+_NOT_NIL_TESTS = ('{0} is None', '{0} is vm.true or {0} is vm.false or '
+                  '{0}.__class__ is int or {0}.__class__ is long')
+
+
+class FunctionBlock(object):
+    # A block closure of a method compiled to Python: function is the
+    # nested Python function of its body, closed over the method's locals.
+    __slots__ = ('cls', 'function', 'argument_count')
+
+    def __init__(self, cls, function, argument_count):
+        self.cls = cls
+        self.function = function
+        self.argument_count = argument_count
+
+    def __repr__(self):
+        return '<a BlockClosure>'
+
+
+class _Home(object):
+    # stands for a running method that blocks in it can ^ return from
+    __slots__ = ('live',)
+
+    def __init__(self):
+        self.live = True
+
+
+def _escape(home, value):
+    if not home.live:
+        raise OnyxError('non-local return to a method that has returned')
+    raise _NonLocalReturn(home, value)
+
+
+class _Scope(object):
+    # the variables declared by a method or block, and which of them are
+    # cells: assigned by a block inside it, so kept in a one element list
+    # that both can change (Python 2 has no nonlocal).  renamed maps those
+    # that aren't v_ locals, an inlined loop's variable, to theirs.
+    def __init__(self, names, outer, cells, renamed=None):
+        self.names = names
+        self.outer = outer
+        self.cells = cells
+        self.renamed = renamed or {}
+
+    def local(self, name):
+        return self.renamed.get(name) or _local(name)
+
+    def resolve(self, name):
+        scope = self
+        while scope is not None:
+            if name in scope.names:
+                return scope
+            scope = scope.outer
+        return None
+
+
+class _Buffer(object):
+    # lines of Python source at one indentation
+    def __init__(self, indent):
+        self.indent = indent
+        self.lines = []
+
+    def emit(self, line):
+        self.lines.append('    ' * self.indent + line)
+
+
+class PythonCompiler(object):
+    # Translates a method to the source of a Python function of the
+    # receiver and the arguments, which compile() turns into code that runs
+    # on CPython's own evaluation loop.  Arguments and temporaries become
+    # Python locals (or cells, see _Scope), blocks nested functions, and
+    # every send a call through its own SendSite.  Each expression becomes
+    # statements assigning to fresh temporaries _tN, keeping the evaluation
+    # order of the interpreter.
+    #
+    # Instance variables are indexed with the layout of the class the
+    # method is built for, and other free variables are globals.
+    #
+    # Inlined sends (see compiler.Compiler) become if statements and while
+    # loops.  Homes are found as if they weren't, and cells too but for the
+    # blocks of whileTrue: and whileFalse:, as the other blocks are still
+    # compiled for the sends falling back.
+    def __init__(self, vm):
+        self.vm = vm
+        self._compilers = {
+            Identifier: self.compile_identifier,
+            LiteralTerm: self.compile_literal,
+            UnarySend: self.compile_send,
+            BinarySend: self.compile_send,
+            KeywordSend: self.compile_send,
+            CascadeSend: self.compile_cascade,
+            AssignTerm: self.compile_assign,
+            BlockTerm: self.compile_block,
+        }
+
+    def build(self, method):
+        # the Python function for method, a runtime Method
+        source, namespace = self.translate(method)
+        code = compile(source, '<onyx {0!r}>'.format(method), 'exec')
+        exec code in namespace
+        return namespace['method']
+
+    def translate(self, method):
+        # the source of method's function, and the namespace it runs in
+        node = method.node
+        self._variable_index = method.owner.variable_index
+        self._namespace = {
+            'vm': self.vm,
+            'send': self.vm.send_site,
+            'tail': self.vm.tail_site,
+            'send_super': self.vm.send_super,
+            'load_global': self.vm.load_global,
+            'store_global': self.vm.store_global,
+            'make_block': self._make_block,
+            'escape': _escape,
+            'Home': _Home,
+            'NonLocalReturn': _NonLocalReturn,
+            'sender': method,
+        }
+        self._count = 0
+        self._block = None
+        self._cells = _find_cells(node)
+        self._needs_home = has_block_return(node.statements)
+        scope = self._scope(node, None)
+
+        buffer = _Buffer(0)
+        buffer.emit('def method({0}):'.format(', '.join(
+            ['rcv'] + [_local(a.name) for a in node.arguments])))
+        body = _Buffer(1)
+        if self._needs_home:
+            buffer.emit('    home = Home()')
+            buffer.emit('    try:')
+            body = _Buffer(2)
+        self._compile_body(node, scope, body, None, method.tail)
+        buffer.lines.extend(body.lines)
+        if self._needs_home:
+            buffer.emit('    except NonLocalReturn as e:')
+            buffer.emit('        if e.home is not home:')
+            buffer.emit('            raise')
+            buffer.emit('        return e.value')
+            buffer.emit('    finally:')
+            buffer.emit('        home.live = False')
+        return '\n'.join(buffer.lines) + '\n', self._namespace
+
+    def _make_block(self, function, argument_count):
+        return FunctionBlock(self.vm.block_class, function, argument_count)
+
+    def _scope(self, node, outer):
+        names = [a.name for a in node.arguments] + [
+            t.name for t in node.temporary_variables]
+        return _Scope(names, outer, self._cells.get(id(node), set()))
+
+    def _compile_body(self, node, scope, buffer, block, tail):
+        # the statements of a method (block None) or a block, ending in the
+        # return of the last one's value, or of its tail send's (at index
+        # tail) as tail() gives it
+        for argument in node.arguments:
+            if argument.name in scope.cells:
+                buffer.emit('{0} = [{0}]'.format(_local(argument.name)))
+        for temporary in node.temporary_variables:
+            if temporary.name in scope.cells:
+                buffer.emit('{0} = [None]'.format(_local(temporary.name)))
+            else:
+                buffer.emit('{0} = None'.format(_local(temporary.name)))
+        value = 'None'
+        for index, statement in enumerate(node.statements):
+            if index == tail:
+                if statement.__class__ is EscapeTerm:
+                    statement = statement.term
+                self._compile_tail(statement, scope, buffer)
+                return
+            if statement.__class__ is EscapeTerm:
+                value, _ = self.compile(statement.term, scope, buffer)
+                if block is not None:
+                    buffer.emit('escape(home, {0})'.format(value))
+                    return
+                break
+            value, _ = self.compile(statement, scope, buffer)
+        buffer.emit('return {0}'.format(value))
+
+    def _compile_tail(self, node, scope, buffer):
+        # emits the return of node's value
+        if is_inlined(node):
+            self.compile_inlined(node, scope, buffer, True)
+        elif node.__class__ in SEND_CLASSES and not is_super(node.receiver):
+            values = self._compile_operands([node.receiver] + node.arguments,
+                                            scope, buffer)
+            site = self.constant('s', SendSite(node.message))
+            buffer.emit('return tail({0}, {1}, [{2}])'.format(
+                site, values[0], ', '.join(values[1:])))
+        else:
+            value, _ = self.compile(node, scope, buffer)
+            buffer.emit('return {0}'.format(value))
+
+    def temporary(self):
+        self._count += 1
+        return '_t{0}'.format(self._count)
+
+    def constant(self, prefix, value):
+        self._count += 1
+        name = '_{0}{1}'.format(prefix, self._count)
+        self._namespace[name] = value
+        return name
+
+    def compile(self, node, scope, buffer):
+        # emits the statements computing node into buffer, returning the
+        # expression for its value, and whether that expression stays the
+        # same if later statements run (so isn't a variable)
+        return self._compilers[node.__class__](node, scope, buffer)
+
+    def compile_literal(self, node, scope, buffer):
+        return repr(node.value), True
+
+    def compile_identifier(self, node, scope, buffer):
+        name = node.name
+        if name in ('self', 'super'):
+            return 'rcv', True
+        elif name == 'nil':
+            return 'None', True
+        elif name == 'true':
+            return 'vm.true', True
+        elif name == 'false':
+            return 'vm.false', True
+        declared = scope.resolve(name)
+        if declared is not None:
+            if name in declared.cells:
+                return declared.local(name) + '[0]', False
+            return declared.local(name), False
+        index = self._variable_index.get(name)
+        if index is not None:
+            return 'rcv.ivars[{0}]'.format(index), False
+        value = self.temporary()
+        buffer.emit('{0} = load_global({1!r})'.format(value, name))
+        return value, True
+
+    def compile_assign(self, node, scope, buffer):
+        name = node.lhs.name
+        if name in _PSEUDO_VARIABLES:
+            raise OnyxError('cannot assign to {0}'.format(name))
+        value, _ = self.compile(node.rhs, scope, buffer)
+        declared = scope.resolve(name)
+        if declared is not None:
+            target = declared.local(name)
+            if name in declared.cells:
+                target += '[0]'
+        else:
+            index = self._variable_index.get(name)
+            if index is None:
+                buffer.emit('store_global({0!r}, {1})'.format(name, value))
+                return value, False
+            target = 'rcv.ivars[{0}]'.format(index)
+        buffer.emit('{0} = {1}'.format(target, value))
+        return target, False
+
+    def compile_block(self, node, scope, buffer):
+        inner = self._scope(node, scope)
+        name = self.temporary()
+        buffer.emit('def {0}({1}):'.format(
+            name, ', '.join(_local(a.name) for a in node.arguments)))
+        body = _Buffer(buffer.indent + 1)
+        block, self._block = self._block, node
+        self._compile_body(node, inner, body, node,
+                           tail_position(node.statements, False))
+        self._block = block
+        buffer.lines.extend(body.lines)
+        value = self.temporary()
+        buffer.emit('{0} = make_block({1}, {2})'.format(
+            value, name, len(node.arguments)))
+        return value, True
+
+    def _compile_operands(self, nodes, scope, buffer):
+        # the expressions for nodes, evaluated in order: one that a later
+        # operand's statements could change is saved in a temporary first
+        compiled = []
+        for node in nodes:
+            operand = _Buffer(buffer.indent)
+            compiled.append((operand,) + self.compile(node, scope, operand))
+        values = []
+        for index, (operand, value, stable) in enumerate(compiled):
+            buffer.lines.extend(operand.lines)
+            if not stable and any(later[0].lines
+                                  for later in compiled[index + 1:]):
+                saved = self.temporary()
+                buffer.emit('{0} = {1}'.format(saved, value))
+                value = saved
+            values.append(value)
+        return values
+
+    def _emit_send(self, receiver, message, arguments, is_super, buffer):
+        value = self.temporary()
+        if is_super:
+            buffer.emit('{0} = send_super(sender, rcv, {1!r}, [{2}])'.format(
+                value, message.message, ', '.join(arguments)))
+        else:
+            site = self.constant('s', SendSite(message.message))
+            buffer.emit('{0} = send({1}, {2}, [{3}])'.format(
+                value, site, receiver, ', '.join(arguments)))
+        return value
+
+    def compile_send(self, node, scope, buffer):
+        if is_inlined(node):
+            return self.compile_inlined(node, scope, buffer, False), True
+        values = self._compile_operands([node.receiver] + node.arguments,
+                                        scope, buffer)
+        return self._emit_send(values[0], node, values[1:],
+                               is_super(node.receiver), buffer), True
+
+    def compile_cascade(self, node, scope, buffer):
+        receiver, stable = self.compile(node.receiver, scope, buffer)
+        if not stable:
+            saved = self.temporary()
+            buffer.emit('{0} = {1}'.format(saved, receiver))
+            receiver = saved
+        value = None
+        for message in node.messages:
+            arguments = self._compile_operands(message.arguments, scope,
+                                               buffer)
+            value = self._emit_send(receiver, message, arguments,
+                                    is_super(node.receiver), buffer)
+        return value, True
+
+    # inlining
+
+    def compile_inlined(self, node, scope, buffer, tail):
+        # emits node, an inlined send, returning the temporary its value is
+        # in, or if tail returning the value
+        if node.message in _BRANCHES:
+            return self._compile_branch(node, scope, buffer, tail)
+        if node.message == 'to:do:':
+            value = self._compile_to_do(node, scope, buffer)
+        else:
+            value = self._compile_while(node, scope, buffer)
+        if tail:
+            buffer.emit('return {0}'.format(value))
+        return value
+
+    def _compile_inline_body(self, block, scope, buffer, tail):
+        # emits the statements of a literal block as part of the function,
+        # returning the expression for their value, or None if they return
+        statements = block.statements
+        last = len(statements) - 1
+        value = 'None'
+        for index, statement in enumerate(statements):
+            if statement.__class__ is EscapeTerm:
+                if self._block is not None:
+                    value, _ = self.compile(statement.term, scope, buffer)
+                    buffer.emit('escape(home, {0})'.format(value))
+                elif tail:
+                    self._compile_tail(statement.term, scope, buffer)
+                else:
+                    value, _ = self.compile(statement.term, scope, buffer)
+                    buffer.emit('return {0}'.format(value))
+                return None
+            if tail and index == last:
+                self._compile_tail(statement, scope, buffer)
+                return None
+            value, _ = self.compile(statement, scope, buffer)
+        if tail:
+            buffer.emit('return {0}'.format(value))
+            return None
+        return value
+
+    def _compile_fallback(self, node, receiver, arguments, scope, buffer,
+                          tail):
+        # emits the send itself, arguments being the expressions of those
+        # that aren't blocks
+        arguments = list(arguments)
+        for argument in node.arguments[len(arguments):]:
+            arguments.append(self.compile(argument, scope, buffer)[0])
+        if tail:
+            site = self.constant('s', SendSite(node.message))
+            buffer.emit('return tail({0}, {1}, [{2}])'.format(
+                site, receiver, ', '.join(arguments)))
+            return None
+        return self._emit_send(receiver, node, arguments, False, buffer)
+
+    def _stable(self, node, scope, buffer):
+        # node's value as a name, which later statements don't change
+        value, stable = self.compile(node, scope, buffer)
+        if not stable or node.__class__ is LiteralTerm:
+            saved = self.temporary()
+            buffer.emit('{0} = {1}'.format(saved, value))
+            value = saved
+        return value
+
+    def _compile_branch(self, node, scope, buffer, tail):
+        #   if <first arm's test>: first arm
+        #   elif <second arm's test>: second arm
+        #   else: the send
+        jump, first, second = _BRANCHES[node.message]
+        tests = _TESTS.get(jump, _NOT_NIL_TESTS)
+        receiver = self._stable(node.receiver, scope, buffer)
+        value = None if tail else self.temporary()
+        for keyword, test, arm in zip(('if', 'elif'), tests,
+                                      (first, second)):
+            buffer.emit('{0} {1}:'.format(keyword, test.format(receiver)))
+            inner = _Buffer(buffer.indent + 1)
+            if arm in _CONSTANTS:
+                result = _CONSTANTS[arm]
+                if tail:
+                    inner.emit('return {0}'.format(result))
+            else:
+                result = self._compile_inline_body(node.arguments[arm],
+                                                   scope, inner, tail)
+            if result is not None and not tail:
+                inner.emit('{0} = {1}'.format(value, result))
+            buffer.lines.extend(inner.lines)
+        buffer.emit('else:')
+        inner = _Buffer(buffer.indent + 1)
+        result = self._compile_fallback(node, receiver, (), scope, inner,
+                                        tail)
+        if not tail:
+            inner.emit('{0} = {1}'.format(value, result))
+        buffer.lines.extend(inner.lines)
+        return value
+
+    def _constant_block(self, name):
+        return self.constant('b', FunctionBlock(
+            self.vm.block_class, _constant(getattr(self.vm, name)), 0))
+
+    def _compile_while(self, node, scope, buffer):
+        #   while True:
+        #       condition
+        #       if <it isn't the Boolean that runs the body>:
+        #           if <it is the other>: break
+        #           the sends whileTrue: (whileFalse:) would have made
+        #       body
+        if node.message == 'whileTrue:':
+            going, stopping = 'vm.true', 'vm.false'
+        else:
+            going, stopping = 'vm.false', 'vm.true'
+        buffer.emit('while True:')
+        loop = _Buffer(buffer.indent + 1)
+        condition = self._compile_inline_body(node.receiver, scope, loop,
+                                              False)
+        if condition is not None:
+            test = self.temporary()
+            loop.emit('{0} = {1}'.format(test, condition))
+            loop.emit('if {0} is not {1}:'.format(test, going))
+            loop.emit('    if {0} is {1}:'.format(test, stopping))
+            loop.emit('        break')
+            fallback = _Buffer(loop.indent + 1)
+            if node.message == 'whileFalse:':
+                fallback.emit('{0} = send({1}, {0}, [])'.format(
+                    test, self.constant('s', SendSite('not'))))
+                fallback.emit('if {0} is not vm.true:'.format(test))
+                fallback.emit('    if {0} is vm.false:'.format(test))
+                fallback.emit('        break')
+                fallback.indent += 1
+            fallback.emit('{0} = send({1}, {0}, [{2}, {3}])'.format(
+                test, self.constant('s', SendSite('ifFalse:ifTrue:')),
+                self._constant_block('false'), self._constant_block('true')))
+            fallback.emit('if {0} is vm.false:'.format(test))
+            fallback.emit('    break')
+            fallback.emit('if {0} is not vm.true:'.format(test))
+            fallback.emit('    continue')
+            loop.lines.extend(fallback.lines)
+            self._compile_inline_body(node.arguments[0], scope, loop, False)
+        loop.emit('pass')
+        buffer.lines.extend(loop.lines)
+        return 'None'
+
+    def _compile_to_do(self, node, scope, buffer):
+        #   if <the bounds are SmallInts>:
+        #       while <the variable isn't past the end>:
+        #           body
+        #           <step the variable>
+        #   else: the send
+        # the variable being a fresh local
+        start, end = [self._stable(operand, scope, buffer)
+                      for operand in (node.receiver, node.arguments[0])]
+        value = self.temporary()
+        block = node.arguments[1]
+        variable = self.temporary()
+        step = self.temporary()
+        buffer.emit('if ({0}.__class__ is int or {0}.__class__ is long) and '
+                    '({1}.__class__ is int or {1}.__class__ is long):'.format(
+                        start, end))
+        buffer.emit('    {0} = -1 if {1} < {2} else 1'.format(step, end,
+                                                             start))
+        buffer.emit('    {0} = {1}'.format(variable, start))
+        buffer.emit('    while {0} <= {1} if {2} > 0 else {0} >= {1}:'.format(
+            variable, end, step))
+        loop = _Buffer(buffer.indent + 2)
+        inner = _Scope([block.arguments[0].name], scope, set(),
+                       {block.arguments[0].name: variable})
+        self._compile_inline_body(block, inner, loop, False)
+        loop.emit('{0} += {1}'.format(variable, step))
+        buffer.lines.extend(loop.lines)
+        buffer.emit('    {0} = None'.format(value))
+        buffer.emit('else:')
+        fallback = _Buffer(buffer.indent + 1)
+        result = self._compile_fallback(node, start, [end], scope, fallback,
+                                        False)
+        fallback.emit('{0} = {1}'.format(value, result))
+        buffer.lines.extend(fallback.lines)
+        return value
+
+
+def _local(name):
+    return 'v_' + name
+
+
+def _find_cells(method):
+    # {id(method or block node): names it declares that a block inside it
+    # assigns}
+    cells = {}
+
+    def visit(node, scopes):
+        if node.__class__ is BlockTerm:
+            names = set(a.name for a in node.arguments)
+            names.update(t.name for t in node.temporary_variables)
+            scopes = scopes + [(node, names)]
+        elif node.__class__ is AssignTerm:
+            name = node.lhs.name
+            for depth in range(len(scopes) - 1, -1, -1):
+                owner, names = scopes[depth]
+                if name in names:
+                    if depth < len(scopes) - 1:
+                        cells.setdefault(id(owner), set()).add(name)
+                    break
+        elif is_inlined(node) and INLINED_SELECTORS[node.message][1]:
+            for child in inlined_children(node):
+                visit(child, scopes)
+            return
+        for child in children(node):
+            visit(child, scopes)
+
+    names = set(a.name for a in method.arguments)
+    names.update(t.name for t in method.temporary_variables)
+    for statement in method.statements:
+        visit(statement, [(method, names)])
+    return cells
+
+
+def _constant(value):
+    return lambda: value
@@ -1,14 +1,27 @@
+import mmap
 import operator
+import re
 
+from onyx.location import SourceError
 from onyx.term import Term
 
 
 class Classifier(object):
+    # characters below table_size are classified by indexing tables built
+    # from the registered predicates, anything else is memoized on first use
+    table_size = 128
+
     def __init__(self):
         self._classifiers = []
+        self._bits = {'eof': 1}
+        self._masks = None
 
     def add_func(self, func, names):
         self._classifiers.append((func, names))
+        for name in names:
+            if name not in self._bits:
+                self._bits[name] = 1 << len(self._bits)
+        self._masks = None
 
     def add_test(self, test_name, names):
         self.add_func(operator.methodcaller(test_name), names)
@@ -16,17 +29,68 @@ class Classifier(object):
     def add_chars(self, chars, names):
         self.add_func(chars.__contains__, names)
 
-    def classify(self, char):
-        cls = set()
+    def compile(self):
+        eof = self._bits['eof']
+        self._class_sets = {eof: frozenset(['eof'])}
+        self._fallback = {'': (eof, 'eof')}
+        entries = [self._compute(chr(n)) for n in range(self.table_size)]
+        self._init_classes = [init_class for mask, init_class in entries]
+        self._masks = [mask for mask, init_class in entries]
+
+    def _compute(self, char):
+        mask = 0
+        init_class = None
         for cl_func, cl_names in self._classifiers:
             if cl_func(char):
-                cls.update(cl_names)
-        return cls
+                if init_class is None:
+                    init_class = cl_names[0]
+                for name in cl_names:
+                    mask |= self._bits[name]
+        if mask not in self._class_sets:
+            self._class_sets[mask] = frozenset(
+                name for name, bit in self._bits.items() if mask & bit)
+        return mask, init_class
+
+    def _lookup(self, char):
+        try:
+            return self._fallback[char]
+        except KeyError:
+            entry = self._fallback[char] = self._compute(char)
+            return entry
+
+    def bit(self, name):
+        return self._bits.get(name, 0)
+
+    def table_chars(self, name, initial=False):
+        if self._masks is None:
+            self.compile()
+        if initial:
+            return ''.join(chr(n) for n, init_class
+                           in enumerate(self._init_classes)
+                           if init_class == name)
+        bit = self.bit(name)
+        return ''.join(chr(n) for n, mask in enumerate(self._masks)
+                       if mask & bit)
+
+    def mask(self, char):
+        if self._masks is None:
+            self.compile()
+        try:
+            return self._masks[ord(char)]
+        except (IndexError, TypeError):
+            return self._lookup(char)[0]
+
+    def classify(self, char):
+        mask = self.mask(char)
+        return self._class_sets[mask]
 
     def init_class(self, char):
-        for cl_func, cl_names in self._classifiers:
-            if cl_func(char):
-                return cl_names[0]
+        if self._masks is None:
+            self.compile()
+        try:
+            return self._init_classes[ord(char)]
+        except (IndexError, TypeError):
+            return self._lookup(char)[1]
 
 
 _default_classifier = Classifier()
@@ -43,16 +107,48 @@ _default_classifier.add_chars('[{(', ['opener'])
 _default_classifier.add_chars(']})', ['closer'])
 
 
-class ReadError(Exception):
+class ReadError(SourceError):
     pass
 
 
+class UnreadTerms(object):
+    # The terms of a compound that a lazy reader skipped over.  start and
+    # end are the absolute offsets of the compound, brackets included.
+    # Iterating reads the terms from the source.
+    __slots__ = ('reader_class', 'source', 'start', 'end')
+
+    def __init__(self, reader_class, source, start, end):
+        self.reader_class = reader_class
+        self.source = source
+        self.start = start
+        self.end = end
+
+    def reader(self, lazy=False):
+        lazy_depth = None
+        if lazy:
+            lazy_depth = 0
+        return self.reader_class(self.source, self.start + 1, self.end - 1,
+                                 self.start, lazy_depth)
+
+    def __iter__(self):
+        return self.reader()
+
+    def __repr__(self):
+        return '<{0} {1}:{2}>'.format(self.__class__.__name__,
+                                      self.start, self.end)
+
+
 class Reader(object):
     _classifier = _default_classifier
     _closers = {'[': ']', '(': ')', '{': '}'}
 
+    _lazy_depth = None
+
     def __init__(self, stream):
         self._stream = stream
+        self._position = 0
+        self._base = 0
+        self._depth = 0
 
     def is_at_end(self):
         return self._stream.is_empty
@@ -63,29 +159,34 @@ class Reader(object):
         return self._stream.first
 
     def current_class(self):
-        if self.is_at_end():
-            return {'eof'}
         return self._classifier.classify(self.current_char())
 
     def init_class(self):
-        if self.is_at_end():
-            return 'eof'
         return self._classifier.init_class(self.current_char())
 
     def step(self):
         self._stream = self._stream.rest
+        self._position += 1
 
     def __getattr__(self, name):
         if name[:3] == 'is_':
-            char_class = name[3:]
+            bit = self._classifier.bit(name[3:])
+            mask = self._classifier.mask
+            current_char = self.current_char
 
             def check_class():
-                return char_class in self.current_class()
+                return mask(current_char()) & bit != 0
             setattr(self, name, check_class)
             return check_class
         raise AttributeError("%r object has no attribute %r" %
                              (self.__class__.__name__, name))
 
+    def error(self, message, position=None):
+        # a ReadError at position, by default the current (absolute) one
+        if position is None:
+            position = self._position
+        return ReadError(message, position)
+
     def skip_spaces(self):
         init_class = self.init_class()
 
@@ -109,49 +210,58 @@ class Reader(object):
 
     def read_term(self):
         init_class = self.skip_spaces()
+        start = self._position
 
         if init_class == 'eof':
-            return Term(None, 'eof')
+            term = Term(None, 'eof')
         elif init_class == 'idchar':
-            return self.read_id_or_kw()
+            term = self.read_id_or_kw()
         elif init_class == 'binsel':
-            return self.read_binsel()
+            term = self.read_binsel()
         elif init_class == 'digit':
-            return self.read_number()
+            term = self.read_number()
         elif init_class == 'string':
-            return self.read_string()
+            term = self.read_string()
         elif init_class == 'delimiter':
-            return self.read_delimiter()
+            term = self.read_delimiter()
         elif init_class == 'assignment':
-            return self.read_assignment_or_block_argument()
+            term = self.read_assignment_or_block_argument()
         elif init_class == 'opener':
-            return self.read_compound()
+            term = self.read_compound()
         elif init_class == 'closer':
-            raise ReadError('unbalanced term: %s' % repr(self.current_char()))
+            raise self.error('unbalanced term: %s' %
+                             repr(self.current_char()))
+        else:
+            raise self.error('Unknown character: %s (%s)' %
+                             (repr(self.current_char()), init_class))
 
-        raise ReadError('Unknown character: %s (%s)' %
-                        (repr(self.current_char()), init_class))
+        # positions are relative to the start of the enclosing compound
+        term.start = start - self._base
+        term.end = self._position - self._base
+        return term
 
     def read_space(self):
         while self.is_space():
             self.step()
 
     def read_comment(self):
+        start = self._position
         self.step()
         while not self.is_eof() and not self.is_comment():
             self.step()
         if self.is_eof():
-            raise ReadError('eof encountered in comment')
+            raise self.error('eof encountered in comment', start)
         self.step()
 
     def read_string(self):
         s = ''
+        start = self._position
         self.step()
         while not self.is_eof() and not self.is_string():
             s += self.current_char()
             self.step()
         if self.is_eof():
-            raise ReadError('eof encountered in string')
+            raise self.error('eof encountered in string', start)
         self.step()
         return Term(s, 'string')
 
@@ -191,6 +301,7 @@ class Reader(object):
         return Term(s, 'binsel')
 
     def read_assignment_or_block_argument(self):
+        start = self._position
         self.step()
         if self.current_char() == '=':
             term = Term(None, 'assignment')
@@ -198,28 +309,297 @@ class Reader(object):
         elif self.is_idchar():
             value, kind = self.scan_id_or_kw()
             if kind == 'keyword':
-                raise ReadError('expected id not keyword')
+                raise self.error('expected id not keyword', start)
             term = Term(value, 'block_argument')
         else:
-            raise ReadError('Unexpected character: %s (%s)' %
-                            (repr(self.current_char()), self.init_class()))
+            raise self.error('Unexpected character: %s (%s)' %
+                             (repr(self.current_char()), self.init_class()))
         return term
 
     def read_compound(self):
+        if self._lazy_depth is not None and self._depth >= self._lazy_depth:
+            return self.skip_compound()
         start = self.current_char()
         end = self._closers[start]
+        base = self._base
+        self._base = self._position
+        self._depth += 1
         self.step()
 
         terms = []
         self.skip_spaces()
         while self.current_char() != end:
             if self.is_eof():
-                raise ReadError('eof encountered in compound (%s)' %
-                                repr(start))
+                raise self.error('eof encountered in compound (%s)' %
+                                 repr(start), self._base)
             t = self.read_term()
             terms.append(t)
             self.skip_spaces()
 
         self.step()
+        self._base = base
+        self._depth -= 1
         return Term(terms, 'compound', start+end)
 
+
+_compound_chars = re.compile('[][(){}\'"]')
+
+
+class StringReader(Reader):
+    # With a lazy_depth, compounds nested that deep (top-level compounds are
+    # at depth 0) are skipped rather than read, and their term's value is an
+    # UnreadTerms.
+    def __init__(self, source, position=0, end=None, base=0, lazy_depth=None):
+        self._source = source
+        self._position = position
+        self._base = base
+        self._depth = 0
+        self._lazy_depth = lazy_depth
+        if end is None:
+            end = len(source)
+        self._end = end
+
+    @classmethod
+    def from_file(cls, filename, use_mmap=True):
+        with open(filename, 'r') as f:
+            if use_mmap:
+                try:
+                    source = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                except (ValueError, mmap.error):
+                    # empty files (and some special files) can't be mapped
+                    source = f.read()
+            else:
+                source = f.read()
+        return cls(source)
+
+    def is_at_end(self):
+        return self._position >= self._end
+
+    def current_char(self):
+        if self._position >= self._end:
+            return ''
+        return self._source[self._position]
+
+    def step(self):
+        self._position += 1
+
+    def skip(self, char_class):
+        bit = self._classifier.bit(char_class)
+        mask = self._classifier.mask
+        source = self._source
+        end = self._end
+        position = self._position
+        while position < end and mask(source[position]) & bit:
+            position += 1
+        self._position = position
+
+    def scan(self, char_class):
+        start = self._position
+        self.skip(char_class)
+        return self._source[start:self._position]
+
+    def scan_to(self, char, error):
+        start = self._position + 1
+        position = self._source.find(char, start, self._end)
+        if position == -1:
+            self._position = self._end
+            raise self.error(error, start - 1)
+        self._position = position + 1
+        return self._source[start:position]
+
+    def read_space(self):
+        self.skip('space')
+
+    def read_comment(self):
+        self.scan_to('"', 'eof encountered in comment')
+
+    def read_string(self):
+        return Term(self.scan_to("'", 'eof encountered in string'), 'string')
+
+    def read_number(self):
+        return Term(int(self.scan('digit')), 'integer')
+
+    def scan_id_or_kw(self):
+        start = self._position
+        self.skip('idchar')
+        kind = 'id'
+        if self.current_char() == ':':
+            self.step()
+            kind = 'keyword'
+        return self._source[start:self._position], kind
+
+    def read_binsel(self):
+        return Term(self.scan('binsel'), 'binsel')
+
+    def skip_compound(self):
+        source = self._source
+        end = self._end
+        start = self._position
+        opener = source[start]
+        closers = self._closers
+        search = _compound_chars.search
+        expected = [closers[opener]]
+        openers = [start]
+        position = start + 1
+        while expected:
+            m = search(source, position, end)
+            if m is None:
+                self._position = end
+                raise self.error('eof encountered in compound (%s)' %
+                                 repr(opener), openers[-1])
+            char = m.group()
+            position = m.end()
+            if char == '"' or char == "'":
+                close = source.find(char, position, end)
+                if close == -1:
+                    self._position = end
+                    if char == '"':
+                        raise self.error('eof encountered in comment',
+                                         m.start())
+                    raise self.error('eof encountered in string', m.start())
+                position = close + 1
+            elif char in closers:
+                opener = char
+                expected.append(closers[char])
+                openers.append(m.start())
+            elif char == expected[-1]:
+                expected.pop()
+                openers.pop()
+            else:
+                self._position = m.start()
+                raise self.error('unbalanced term: %s' % repr(char))
+        self._position = position
+        return Term(UnreadTerms(self.__class__, source, start, position),
+                    'compound', source[start] + closers[source[start]])
+
+
+class FastReader(StringReader):
+    _patterns = {}
+
+    @classmethod
+    def master_pattern(cls):
+        try:
+            return cls._patterns[cls._classifier]
+        except KeyError:
+            pass
+
+        chars = cls._classifier.table_chars
+        outside = '[^\\x00-\\x%02x]' % (cls._classifier.table_size - 1)
+
+        def char_set(name, initial=False):
+            return '[%s]' % ''.join(re.escape(c)
+                                    for c in chars(name, initial))
+
+        # A run of characters must not be followed by another character of
+        # its class or by one outside the classifier table, so the regex can
+        # neither split a token nor guess at characters that the classifier
+        # only knows about through its fallback.
+        def run(name, initial=None):
+            if initial is None:
+                initial = char_set(name)
+            return '%s%s*(?!%s|%s)' % (initial, char_set(name),
+                                       char_set(name), outside)
+
+        pattern = '|'.join([
+            '(?P<space>%s)' % run('space'),
+            '(?P<comment>"[^"]*")',
+            "(?P<string>'(?P<string_value>[^']*)')",
+            '(?P<id>%s)(?P<keyword>:)?' % run(
+                'idchar', char_set('idchar', True)),
+            '(?P<digit>%s)' % run('digit'),
+            '(?P<binsel>%s)' % run('binsel', char_set('binsel', True)),
+            '(?P<delimiter>%s)' % char_set('delimiter'),
+            '(?P<assignment>:=)',
+            ':(?P<block_argument>%s)(?P<block_keyword>:)?' % run('idchar'),
+            '(?P<opener>%s)' % char_set('opener'),
+            '(?P<closer>%s)' % char_set('closer'),
+            ])
+        pattern = cls._patterns[cls._classifier] = re.compile(
+            pattern, re.UNICODE)
+        return pattern
+
+    def read_term(self):
+        match = self.master_pattern().match
+        closers = self._closers
+        source = self._source
+        end = self._end
+        base = self._base
+        stack = []
+        terms = None
+        opener = None
+
+        while True:
+            position = self._position
+            m = match(source, position, end)
+            if m is None:
+                if position >= end:
+                    if stack:
+                        raise self.error('eof encountered in compound (%s)' %
+                                         repr(opener), base)
+                    return Term(None, 'eof', None, end - base, end - base)
+                # Anything the pattern doesn't cover (characters outside the
+                # classifier table, unterminated strings and comments, and
+                # errors) goes through the generic reader.  Once spaces are
+                # skipped that reads exactly one non-compound term.
+                self.skip_spaces()
+                if self._position != position:
+                    continue
+                term = Reader.read_term(self)
+            else:
+                self._position = m.end()
+                kind = m.lastgroup
+                if kind == 'space' or kind == 'comment':
+                    continue
+                elif kind == 'id':
+                    term = Term(m.group('id'), 'id')
+                elif kind == 'keyword':
+                    term = Term(m.group(0), 'keyword')
+                elif kind == 'binsel' or kind == 'delimiter':
+                    term = Term(m.group(kind), kind)
+                elif kind == 'digit':
+                    term = Term(int(m.group('digit')), 'integer')
+                elif kind == 'string' or kind == 'string_value':
+                    term = Term(m.group('string_value'), 'string')
+                elif kind == 'assignment':
+                    term = Term(None, 'assignment')
+                elif kind == 'block_argument':
+                    term = Term(m.group('block_argument'), 'block_argument')
+                elif kind == 'block_keyword':
+                    raise self.error('expected id not keyword', position)
+                elif kind == 'opener':
+                    lazy_depth = self._lazy_depth
+                    if lazy_depth is not None and len(stack) >= lazy_depth:
+                        self._position = position
+                        term = self.skip_compound()
+                        term.start = position - base
+                        term.end = self._position - base
+                        if not stack:
+                            return term
+                        terms.append(term)
+                        continue
+                    stack.append((terms, opener, base))
+                    terms = []
+                    opener = m.group('opener')
+                    base = self._base = position
+                    continue
+                else:
+                    closer = m.group('closer')
+                    if opener is None or closers[opener] != closer:
+                        raise self.error('unbalanced term: %s' % repr(closer),
+                                         position)
+                    term = Term(terms, 'compound', opener + closer)
+                    start = base
+                    terms, opener, base = stack.pop()
+                    self._base = base
+                    term.start = start - base
+                    term.end = self._position - base
+                    if not stack:
+                        return term
+                    terms.append(term)
+                    continue
+                term.start = position - base
+                term.end = self._position - base
+
+            if not stack:
+                return term
+            terms.append(term)
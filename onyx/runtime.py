@@ -0,0 +1,331 @@
+import weakref
+
+from .analysis import tail_position
+
+
+class OnyxError(Exception):
+    # An error in running onyx code that onyx code didn't (or couldn't)
+    # handle: a primitive failing, an undefined variable, an exception
+    # signalled with no handler (value is the exception), ...
+    def __init__(self, message, value=None):
+        super(OnyxError, self).__init__(message)
+        self.value = value
+
+
+class Halt(OnyxError):
+    pass
+
+
+class Class(object):
+    # A class, and the object standing for it at run time.  Its metaclass is
+    # a Class too (named 'Foo class'), which holds the class side methods
+    # and whose instance_variables are the class instance variables.  ivars
+    # holds the values of those, as it would for an instance.
+    #
+    # instance_variables are the names of the class's own, and all_variables
+    # of those of its superclasses followed by its own, which is the layout
+    # of an instance's ivars; variable_index maps them to their index.
+    __slots__ = ('name', 'superclass', 'methods', 'instance_variables',
+                 'all_variables', 'variable_index', 'cls', 'ivars',
+                 'instance_class')
+
+    # bumped whenever any class's methods or superclass change, which is
+    # what inline caches are checked against
+    epoch = 0
+
+    def __init__(self, name, superclass=None, instance_variables=(),
+                 cls=None):
+        self.name = name
+        self.superclass = superclass
+        self.methods = {}
+        self.instance_variables = list(instance_variables)
+        self.cls = cls
+        self.instance_class = None
+        self.ivars = []
+        self.update_layout()
+
+    @property
+    def is_metaclass(self):
+        return self.instance_class is not None
+
+    # Change methods and superclasses through these, so that method caches
+    # drop what they had looked up through the class.
+
+    def define_method(self, method):
+        self.methods[method.selector] = method
+        _selector_changed(self, method.selector)
+
+    def remove_method(self, selector):
+        del self.methods[selector]
+        _selector_changed(self, selector)
+
+    def replace_methods(self, methods):
+        old = self.methods
+        self.methods = dict((method.selector, method) for method in methods)
+        for selector in set(old) | set(self.methods):
+            _selector_changed(self, selector)
+
+    def set_superclass(self, superclass):
+        if superclass is not self.superclass:
+            self.superclass = superclass
+            _class_changed(self)
+        self.update_layout()
+
+    def update_layout(self):
+        inherited = []
+        if self.superclass is not None:
+            inherited = self.superclass.all_variables
+        self.all_variables = inherited + self.instance_variables
+        self.variable_index = dict(
+            (name, index) for index, name in enumerate(self.all_variables))
+
+    def lookup(self, selector):
+        cls = self
+        while cls is not None:
+            method = cls.methods.get(selector)
+            if method is not None:
+                return method
+            cls = cls.superclass
+        return None
+
+    def inherits_from(self, other):
+        cls = self
+        while cls is not None:
+            if cls is other:
+                return True
+            cls = cls.superclass
+        return False
+
+    def __repr__(self):
+        return '<Class {0}>'.format(self.name)
+
+
+# every MethodCache, to be told of changes to classes
+_caches = weakref.WeakSet()
+
+
+def _selector_changed(cls, selector):
+    Class.epoch += 1
+    for cache in _caches:
+        cache.invalidate_selector(cls, selector)
+
+
+def _class_changed(cls):
+    Class.epoch += 1
+    for cache in _caches:
+        cache.invalidate_class(cls)
+
+
+class MethodCache(object):
+    # Caches Class.lookup by (class, selector), so that a send that has been
+    # looked up before costs a single dict probe.  It holds at most size
+    # methods, evicting the least recently used roughly by the clock
+    # algorithm: each entry has a referenced bit set on every hit, and the
+    # hand sweeping the ring of entries clears set bits and evicts the first
+    # entry it finds clear.
+    #
+    # Entries are invalidated precisely: defining or removing a selector in
+    # a class drops the entries for that selector in the class and its
+    # subclasses, and changing its superclass drops all of theirs.  hits,
+    # misses, evictions and invalidations count what it has done.
+    def __init__(self, size=4096):
+        self.size = size
+        # (class, selector) -> [method, referenced, slot in _ring]
+        self._entries = {}
+        self._ring = []
+        self._free = []
+        self._hand = 0
+        # selector -> classes with an entry for it
+        self._classes = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        _caches.add(self)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, cls, selector):
+        entry = self._entries.get((cls, selector))
+        if entry is not None:
+            self.hits += 1
+            entry[1] = True
+            return entry[0]
+        self.misses += 1
+        method = cls.lookup(selector)
+        if method is not None:
+            self._insert(cls, selector, method)
+        return method
+
+    def _insert(self, cls, selector, method):
+        key = (cls, selector)
+        if self._free:
+            slot = self._free.pop()
+        elif len(self._ring) < self.size:
+            slot = len(self._ring)
+            self._ring.append(None)
+        else:
+            slot = self._sweep()
+        self._ring[slot] = key
+        self._entries[key] = [method, False, slot]
+        self._classes.setdefault(selector, set()).add(cls)
+
+    def _sweep(self):
+        ring = self._ring
+        entries = self._entries
+        hand = self._hand
+        while True:
+            key = ring[hand]
+            entry = entries[key]
+            if entry[1]:
+                entry[1] = False
+                hand = (hand + 1) % len(ring)
+            else:
+                self._hand = (hand + 1) % len(ring)
+                self._remove(key)
+                self.evictions += 1
+                return self._free.pop()
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._ring[entry[2]] = None
+        self._free.append(entry[2])
+        classes = self._classes[key[1]]
+        classes.discard(key[0])
+        if not classes:
+            del self._classes[key[1]]
+
+    def invalidate_selector(self, cls, selector):
+        for other in list(self._classes.get(selector, ())):
+            if other.inherits_from(cls):
+                self._remove((other, selector))
+                self.invalidations += 1
+
+    def invalidate_class(self, cls):
+        for key in list(self._entries):
+            if key[0].inherits_from(cls):
+                self._remove(key)
+                self.invalidations += 1
+
+    def clear(self):
+        for key in list(self._entries):
+            self._remove(key)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'size': len(self._entries), 'capacity': self.size,
+                'hits': self.hits, 'misses': self.misses,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations}
+
+
+# the cache interpreters share unless given their own
+method_cache = MethodCache()
+
+
+class Instance(object):
+    __slots__ = ('cls', 'ivars')
+
+    def __init__(self, cls, ivars=None):
+        self.cls = cls
+        if ivars is None:
+            ivars = [None] * len(cls.all_variables)
+        self.ivars = ivars
+
+    def __repr__(self):
+        return '<a {0}>'.format(self.cls.name)
+
+
+class Method(object):
+    # A method installed in a class: owner is the class it was defined in
+    # (where super sends start looking) and node its MethodTerm.  The names
+    # of the arguments and temporaries are pulled out for invocation.  code
+    # is its CompiledCode once the virtual machine has compiled it, or
+    # function its Python function if it was compiled to Python instead.
+    # tail is the index of the statement that is its tail send, if any (see
+    # analysis.tail_position).
+    __slots__ = ('owner', 'selector', 'node', 'argument_names',
+                 'temporary_names', 'code', 'function', 'tail')
+
+    def __init__(self, owner, node, code=None):
+        self.owner = owner
+        self.selector = node.selector
+        self.node = node
+        self.argument_names = tuple(a.name for a in node.arguments)
+        self.temporary_names = tuple(t.name
+                                     for t in node.temporary_variables)
+        self.code = code
+        self.function = None
+        self.tail = tail_position(node.statements, True)
+
+    @property
+    def statements(self):
+        return self.node.statements
+
+    def __repr__(self):
+        return '<Method {0}>>{1}>'.format(self.owner.name, self.selector)
+
+
+class Block(object):
+    # A block closure: node is its BlockTerm and frame the frame it was
+    # made in, where its free variables are found.
+    __slots__ = ('cls', 'node', 'frame', 'argument_names', 'temporary_names')
+
+    def __init__(self, cls, node, frame):
+        self.cls = cls
+        self.node = node
+        self.frame = frame
+        self.argument_names = tuple(a.name for a in node.arguments)
+        self.temporary_names = tuple(t.name
+                                     for t in node.temporary_variables)
+
+    def __repr__(self):
+        return '<a BlockClosure>'
+
+
+class Continuation(Instance):
+    # A continuation up to a prompt, live (so invocable) until the primitive
+    # that captured it returns.  channel is set while the code it continues
+    # is parked, its prompt having been aborted to (see
+    # Interpreter.abort).
+    __slots__ = ('live', 'channel')
+
+    def __init__(self, cls):
+        super(Continuation, self).__init__(cls)
+        self.live = True
+        self.channel = None
+
+
+class Symbol(object):
+    # Symbols are interned, so compare by identity.
+    __slots__ = ('name',)
+    _table = {}
+
+    def __new__(cls, name):
+        try:
+            return cls._table[name]
+        except KeyError:
+            self = cls._table[name] = object.__new__(cls)
+            self.name = name
+            return self
+
+    def __repr__(self):
+        return '#{0}'.format(self.name)
+
+
+class Character(object):
+    __slots__ = ('code',)
+    _table = {}
+
+    def __new__(cls, code):
+        try:
+            return cls._table[code]
+        except KeyError:
+            self = cls._table[code] = object.__new__(cls)
+            self.code = code
+            return self
+
+    def __repr__(self):
+        return '$' + unichr(self.code).encode('utf-8')
@@ -1,25 +1,49 @@
 
 
+try:
+    from sys import intern
+except ImportError:
+    pass
+
+
 class TermError(Exception):
     pass
 
 
+TERM_KINDS = ('id', 'eof', 'compound', 'keyword', 'string', 'binsel',
+              'integer', 'delimiter', 'assignment', 'block_argument')
+_term_kind_codes = dict((kind, code) for code, kind in enumerate(TERM_KINDS))
+_interned_term_kinds = frozenset(
+    _term_kind_codes[kind] for kind in ('id', 'keyword', 'binsel',
+                                        'block_argument'))
+
+
+def _kind_test(code):
+    return property(lambda self: self.kind == code)
+
+
 class Term(object):
-    is_id = False
-    is_eof = False
-    is_compound = False
-    is_keyword = False
-    is_string = False
-    is_binsel = False
-    is_integer = False
-    is_delimiter = False
-    is_assignment = False
-    is_block_argument = False
-
-    def __init__(self, value, flag, shape=None):
+    # start and end are source offsets relative to the start of the
+    # enclosing compound term (or of the source, at the top level)
+    __slots__ = ('value', 'shape', 'kind', 'start', 'end')
+
+    def __init__(self, value, flag, shape=None, start=None, end=None):
+        kind = _term_kind_codes[flag]
+        if kind in _interned_term_kinds:
+            try:
+                value = intern(value)
+            except TypeError:
+                # Python 2 only interns byte strings
+                pass
         self.value = value
         self.shape = shape
-        setattr(self, 'is_%s' % flag, True)
+        self.kind = kind
+        self.start = start
+        self.end = end
+
+    @property
+    def kind_name(self):
+        return TERM_KINDS[self.kind]
 
     def as_identifier(self):
         if self.is_id or self.is_block_argument:
@@ -30,7 +54,143 @@ class Term(object):
         return '<{0} {1!r}>'.format(self.__class__.__name__, self.value)
 
 
-class Identifier(object):
+for _code, _kind in enumerate(TERM_KINDS):
+    setattr(Term, 'is_' + _kind, _kind_test(_code))
+del _code, _kind
+
+
+class NodeError(Exception):
+    pass
+
+
+class Node(object):
+    # Nodes compare and hash structurally over their _fields.  A node is
+    # mutable while it is being built and becomes immutable (and hashable,
+    # with the hash cached in _hash) once frozen.
+    #
+    # start and end are the absolute source offsets of the node's text (or
+    # None), set by the parser.  They are not part of the structure.
+    __slots__ = ('_hash', 'start', 'end')
+    _fields = ()
+
+    def __new__(cls, *args, **kwargs):
+        self = object.__new__(cls)
+        object.__setattr__(self, '_hash', None)
+        object.__setattr__(self, 'start', None)
+        object.__setattr__(self, 'end', None)
+        return self
+
+    @property
+    def span(self):
+        return self.start, self.end
+
+    @span.setter
+    def span(self, span):
+        if span is None:
+            span = None, None
+        self.start, self.end = span
+
+    def __setattr__(self, name, value):
+        if self._hash is not None:
+            raise NodeError('cannot modify a frozen node', self, name)
+        object.__setattr__(self, name, value)
+
+    @property
+    def is_frozen(self):
+        return self._hash is not None
+
+    def field_values(self):
+        return tuple(_freeze_value(getattr(self, name))
+                     for name in self._fields)
+
+    def freeze(self):
+        if self._hash is None:
+            for name in self._fields:
+                value = getattr(self, name)
+                if isinstance(value, list):
+                    value = tuple(value)
+                    object.__setattr__(self, name, value)
+                _freeze_children(value)
+            object.__setattr__(self, '_hash',
+                               hash((self.__class__,) + self.field_values()))
+        return self
+
+    def __hash__(self):
+        if self._hash is None:
+            raise TypeError(
+                'unhashable node (not frozen): {0!r}'.format(self))
+        return self._hash
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if self.__class__ is not other.__class__:
+            return NotImplemented
+        if (self._hash is not None and other._hash is not None and
+                self._hash != other._hash):
+            return False
+        return self.field_values() == other.field_values()
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __repr__(self):
+        return '<{0} {1}>'.format(
+            self.__class__.__name__,
+            ' '.join('{0}={1!r}'.format(name, getattr(self, name))
+                     for name in self._fields))
+
+
+def _freeze_value(value):
+    if isinstance(value, list):
+        return tuple(value)
+    return value
+
+
+def _freeze_children(value):
+    if isinstance(value, Node):
+        value.freeze()
+    elif isinstance(value, tuple):
+        for item in value:
+            _freeze_children(item)
+
+
+class NodeTable(object):
+    # Hash-conses nodes: structurally equal subtrees interned through the
+    # same table come back as one shared, frozen node, which keeps the
+    # positions of the first of them.
+    def __init__(self):
+        self._nodes = {}
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def intern(self, node):
+        if node.is_frozen:
+            shared = self._nodes.get(node)
+            if shared is not None:
+                return shared
+        for name in node._fields:
+            object.__setattr__(node, name,
+                               self._intern_value(getattr(node, name)))
+        node.freeze()
+        return self._nodes.setdefault(node, node)
+
+    def _intern_value(self, value):
+        if isinstance(value, Node):
+            return self.intern(value)
+        elif isinstance(value, (list, tuple)):
+            return tuple(self._intern_value(item) for item in value)
+        return value
+
+
+class Identifier(Node):
+    __slots__ = ('name',)
+    _fields = __slots__
+
     def __init__(self, name):
         self.name = name
 
@@ -38,46 +198,152 @@ class Identifier(object):
         return '<{0} {1!r}>'.format(self.__class__.__name__, self.name)
 
 
-class MessageSend(object):
+class MessageSend(Node):
+    # The cache_ slots are the send site's inline cache, which belongs to
+    # the interpreter: they aren't part of the structure, and are set even
+    # on frozen nodes.
+    __slots__ = ('receiver', 'message', 'arguments', 'cache_class',
+                 'cache_method', 'cache_epoch')
+    _fields = ('receiver', 'message', 'arguments')
+
     def __init__(self, receiver, message, arguments=None):
         self.receiver = receiver
         self.message = message
         if arguments is None:
             arguments = []
         self.arguments = arguments
+        self.cache_class = None
+        self.cache_method = None
+        self.cache_epoch = None
 
 
 class UnarySend(MessageSend):
-    pass
+    __slots__ = ()
 
 
 class BinarySend(MessageSend):
-    pass
+    __slots__ = ()
 
 
 class KeywordSend(MessageSend):
-    pass
+    __slots__ = ()
 
 
-class CascadeSend(object):
+class CascadeSend(Node):
+    __slots__ = ('receiver', 'messages')
+    _fields = __slots__
+
     def __init__(self, receiver, messages):
         self.receiver = receiver
         self.messages = messages
 
 
-class AssignTerm(object):
+class AssignTerm(Node):
+    __slots__ = ('lhs', 'rhs')
+    _fields = __slots__
+
     def __init__(self, lhs, rhs):
         self.lhs = lhs
         self.rhs = rhs
 
 
-class BlockTerm(object):
+class BlockTerm(Node):
+    __slots__ = ('arguments', 'temporary_variables', 'statements')
+    _fields = __slots__
+
     def __init__(self, arguments, temporary_variables, statements):
         self.arguments = arguments
         self.temporary_variables = temporary_variables
         self.statements = statements
 
 
-class EscapeTerm(object):
+class EscapeTerm(Node):
+    __slots__ = ('term',)
+    _fields = __slots__
+
     def __init__(self, term):
-        self.term = term
\ No newline at end of file
+        self.term = term
+
+
+class LiteralTerm(Node):
+    __slots__ = ('value',)
+    _fields = __slots__
+
+    def __init__(self, value):
+        self.value = value
+
+
+class MethodTerm(Node):
+    # A method's span covers the whole definition, header included.
+    #
+    # A method read lazily has a body (anything with a parse() method that
+    # returns the temporaries and statements) instead, which is parsed and
+    # memoized the first time either is needed.
+    __slots__ = ('selector', 'arguments', '_temporary_variables',
+                 '_statements', 'body')
+    _fields = ('selector', 'arguments', 'temporary_variables', 'statements')
+
+    def __init__(self, selector, arguments, temporary_variables=None,
+                 statements=None, span=None, body=None):
+        self.selector = selector
+        self.arguments = arguments
+        self._temporary_variables = temporary_variables
+        self._statements = statements
+        self.span = span
+        self.body = body
+
+    @property
+    def is_parsed(self):
+        return self.body is None
+
+    def parse_body(self):
+        if self.body is not None:
+            temporary_variables, statements = self.body.parse()
+            object.__setattr__(self, '_temporary_variables',
+                               temporary_variables)
+            object.__setattr__(self, '_statements', statements)
+            object.__setattr__(self, 'body', None)
+
+    @property
+    def temporary_variables(self):
+        if self.body is not None:
+            self.parse_body()
+        return self._temporary_variables
+
+    @temporary_variables.setter
+    def temporary_variables(self, value):
+        self.parse_body()
+        self._temporary_variables = value
+
+    @property
+    def statements(self):
+        if self.body is not None:
+            self.parse_body()
+        return self._statements
+
+    @statements.setter
+    def statements(self, value):
+        self.parse_body()
+        self._statements = value
+
+
+class ClassTerm(Node):
+    __slots__ = ('name', 'superclass', 'instance_variables', 'methods',
+                 'class_instance_variables', 'class_methods')
+    _fields = ('name', 'superclass', 'instance_variables', 'methods',
+               'class_instance_variables', 'class_methods')
+
+    def __init__(self, name, superclass, instance_variables, methods,
+                 class_instance_variables=None, class_methods=None,
+                 span=None):
+        self.name = name
+        self.superclass = superclass
+        self.instance_variables = instance_variables
+        self.methods = methods
+        if class_instance_variables is None:
+            class_instance_variables = []
+        self.class_instance_variables = class_instance_variables
+        if class_methods is None:
+            class_methods = []
+        self.class_methods = class_methods
+        self.span = span
@@ -0,0 +1,420 @@
+from . import cache
+from .compiler import (DUP, FOR_LOOP, FOR_NEXT, FOR_PREP, JUMP, JUMP_FALSE,
+                       JUMP_NOT_NIL, JUMP_TRUE, MAKE_BLOCK, POP, PUSH_FALSE,
+                       PUSH_LITERAL, PUSH_NAME, PUSH_NIL, PUSH_OUTER,
+                       PUSH_SELF, PUSH_TEMP, PUSH_TRUE, RETURN, RETURN_HOME,
+                       SEND, STORE_NAME, STORE_OUTER, STORE_TEMP, SUPER_SEND,
+                       TAIL_SEND, CompiledCode,
+                       Compiler, compile_definitions, compiled_path,
+                       read_compiled, write_compiled)
+from .interpreter import Interpreter, _NonLocalReturn, _TailCall
+from .pycompiler import FunctionBlock, PythonCompiler
+from .runtime import Class, OnyxError, method_cache
+from .term import ClassTerm
+
+
+class Context(object):
+    # The activation of a CompiledCode that blocks are made in, or of a
+    # block that doesn't share its frame: locals holds its arguments and
+    # temporaries, receiver is self, outer the context a block was made in
+    # and home the context of the method it is in, which ^ returns from and
+    # which is live until it has returned.  method is the Method being run
+    # (None at top level).  Other activations have no context, their locals
+    # being kept by run_code alone.
+    __slots__ = ('locals', 'receiver', 'outer', 'home', 'method', 'live')
+
+    def __init__(self, locals, receiver, outer=None, home=None, method=None):
+        self.locals = locals
+        self.receiver = receiver
+        self.outer = outer
+        if home is None:
+            home = self
+        self.home = home
+        self.method = method
+        self.live = True
+
+
+class Closure(object):
+    # A block closure made by MAKE_BLOCK: the CompiledCode of the block and
+    # the context it was made in.
+    __slots__ = ('cls', 'code', 'context')
+
+    def __init__(self, cls, code, context):
+        self.cls = cls
+        self.code = code
+        self.context = context
+
+    def __repr__(self):
+        return '<a BlockClosure>'
+
+
+class VirtualMachine(Interpreter):
+    # Runs methods, blocks and top level code compiled to bytecode by
+    # compiler, rather than walking their AST.  A method is compiled the
+    # first time it is invoked, unless load_file found its code in the
+    # compiled cache.  Classes, sends, primitives, prompts and marks are the
+    # interpreter's.
+    #
+    # The methods of the classes named in python_classes (see use_python)
+    # are compiled to Python functions by python_compiler instead.
+    def __init__(self, output=None, method_cache=method_cache,
+                 compiler=None):
+        super(VirtualMachine, self).__init__(output, method_cache)
+        if compiler is None:
+            compiler = Compiler()
+        self.compiler = compiler
+        self.python_compiler = PythonCompiler(self)
+        self.python_classes = set()
+
+    def use_python(self, name, enabled=True):
+        # turns compiling to Python on or off for the methods of the class
+        # named name, both sides
+        if enabled:
+            self.python_classes.add(name)
+        else:
+            self.python_classes.discard(name)
+        cls = self.globals.get(name)
+        if isinstance(cls, Class):
+            for side in (cls, cls.cls):
+                for method in side.methods.values():
+                    method.function = None
+
+    # loading
+
+    def load_file(self, filename, cache_dir=None):
+        # like the parse cache, the compiled code of the file is cached next
+        # to it (or in cache_dir)
+        with open(filename, 'rb') as f:
+            key = cache.source_key(f.read())
+        definitions = cache.load_file(filename, cache_dir)
+        path = compiled_path(filename, cache_dir)
+        compiled = read_compiled(path, key)
+        if compiled is None:
+            compiled = compile_definitions(definitions, self.compiler)
+            try:
+                write_compiled(path, key, compiled)
+            except (IOError, OSError):
+                pass
+        return self.execute(definitions, compiled)
+
+    def execute(self, definitions, compiled=None):
+        # compiled is as compile_definitions gives for definitions, or None
+        # to compile them as they are run
+        if compiled is None:
+            return super(VirtualMachine, self).execute(definitions)
+        value = None
+        for definition, code in zip(definitions, compiled):
+            if isinstance(definition, ClassTerm):
+                cls = self.define_class(definition)
+                for side, codes in zip((cls, cls.cls), code):
+                    for selector, method_code in codes.items():
+                        side.methods[selector].code = method_code
+            else:
+                value = self._run_top_level(code, None)
+        return value
+
+    def run(self, statements, frame, tail=None):
+        # runs top level code (which has no tail send), which is either
+        # statements to compile, with frame the interpreter Frame holding
+        # their temporaries, or their CompiledCode, which has none (but for
+        # those of its inlined loops)
+        if isinstance(statements, CompiledCode):
+            code = statements
+            context = Context([None] * code.temporary_count, None)
+        else:
+            names = [name for name in frame.variables if name != 'self']
+            code = self.compiler.compile_statements(statements, names)
+            locals = [frame.variables[name] for name in names]
+            locals.extend([None] * (code.local_count - len(locals)))
+            context = Context(locals, frame.variables['self'])
+        try:
+            return self.run_code(code, context.locals, context.receiver,
+                                 None, context)
+        except _NonLocalReturn as e:
+            if e.home is not context:
+                raise
+            return e.value
+        finally:
+            context.live = False
+
+    # sending
+
+    def invoke(self, method, receiver, arguments):
+        while True:
+            function = method.function
+            if function is None and self.python_classes:
+                owner = method.owner.instance_class or method.owner
+                if owner.name in self.python_classes:
+                    function = method.function = self.python_compiler.build(
+                        method)
+            if function is not None:
+                value = function(receiver, *arguments)
+            else:
+                code = method.code
+                if code is None:
+                    code = method.code = self.compiler.compile_method(
+                        method.node)
+                locals = list(arguments)
+                if code.temporary_count:
+                    locals.extend([None] * code.temporary_count)
+                if not code.blocks:
+                    # nothing can refer to the activation
+                    value = self.run_code(code, locals, receiver, method,
+                                          None)
+                else:
+                    context = Context(locals, receiver, None, None, method)
+                    try:
+                        value = self.run_code(code, locals, receiver, method,
+                                              context)
+                    except _NonLocalReturn as e:
+                        if e.home is not context:
+                            raise
+                        return e.value
+                    finally:
+                        context.live = False
+            if value.__class__ is not _TailCall:
+                return value
+            method = value.method
+            receiver = value.receiver
+            arguments = value.arguments
+
+    def call_block(self, block, arguments, tail=False):
+        if block.__class__ is FunctionBlock:
+            if len(arguments) != block.argument_count:
+                raise OnyxError('block takes {0} arguments, got {1}'.format(
+                    block.argument_count, len(arguments)))
+            value = block.function(*arguments)
+        elif block.__class__ is Closure:
+            code = block.code
+            if len(arguments) != code.argument_count:
+                raise OnyxError('block takes {0} arguments, got {1}'.format(
+                    code.argument_count, len(arguments)))
+            outer = block.context
+            base = code.base
+            if base is None:
+                locals = list(arguments)
+                if code.temporary_count:
+                    locals.extend([None] * code.temporary_count)
+                value = self.run_code(code, locals, outer.receiver,
+                                      outer.method,
+                                      Context(locals, outer.receiver, outer,
+                                              outer.home, outer.method))
+            elif code.local_count:
+                # in outer's frame, keeping what the block's locals held in
+                # case it is being called from inside itself
+                locals = outer.locals
+                end = base + code.local_count
+                saved = locals[base:end]
+                locals[base:base + len(arguments)] = arguments
+                if code.temporary_count:
+                    locals[end - code.temporary_count:end] = [
+                        None] * code.temporary_count
+                try:
+                    value = self.run_code(code, locals, outer.receiver,
+                                          outer.method, outer)
+                finally:
+                    locals[base:end] = saved
+            else:
+                value = self.run_code(code, outer.locals, outer.receiver,
+                                      outer.method, outer)
+        else:
+            raise OnyxError('not a block: {0}'.format(
+                self.print_string(block)))
+        if value.__class__ is _TailCall and not tail:
+            return self.invoke(value.method, value.receiver, value.arguments)
+        return value
+
+    def run_code(self, code, locals, receiver, method, context):
+        # The dispatch loop: runs code until it returns, keeping its
+        # operands on stack.  context is the code's Context (or for a block
+        # sharing a frame, that frame's), or None if it needs none: it makes
+        # no blocks.  The most frequent instructions are tested first.
+        true = self.true
+        false = self.false
+        bytecode = code.bytecode
+        literals = code.literals
+        sites = code.sites
+        stack = []
+        push = stack.append
+        pop = stack.pop
+        send_site = self.send_site
+        pc = 0
+        while True:
+            opcode = bytecode[pc]
+            if opcode == SEND:
+                site = sites[bytecode[pc + 1]]
+                count = bytecode[pc + 2]
+                pc += 3
+                if count:
+                    arguments = stack[-count:]
+                    del stack[-count:]
+                else:
+                    arguments = []
+                push(send_site(site, pop(), arguments))
+            elif opcode == PUSH_TEMP:
+                push(locals[bytecode[pc + 1]])
+                pc += 2
+            elif opcode == PUSH_SELF:
+                push(receiver)
+                pc += 1
+            elif opcode == PUSH_LITERAL:
+                push(literals[bytecode[pc + 1]])
+                pc += 2
+            elif opcode == POP:
+                pop()
+                pc += 1
+            elif opcode == JUMP_FALSE:
+                value = pop()
+                if value is true:
+                    pc += 3
+                elif value is false:
+                    pc = bytecode[pc + 1]
+                else:
+                    push(value)
+                    pc = bytecode[pc + 2]
+            elif opcode == JUMP:
+                pc = bytecode[pc + 1]
+            elif opcode == PUSH_NAME:
+                push(self._load_name(code.names[bytecode[pc + 1]], receiver,
+                                     method))
+                pc += 2
+            elif opcode == RETURN:
+                return pop()
+            elif opcode == TAIL_SEND:
+                site = sites[bytecode[pc + 1]]
+                count = bytecode[pc + 2]
+                if count:
+                    arguments = stack[-count:]
+                    del stack[-count:]
+                else:
+                    arguments = []
+                return self.tail_site(site, pop(), arguments)
+            elif opcode == JUMP_TRUE:
+                value = pop()
+                if value is false:
+                    pc += 3
+                elif value is true:
+                    pc = bytecode[pc + 1]
+                else:
+                    push(value)
+                    pc = bytecode[pc + 2]
+            elif opcode == FOR_LOOP:
+                local = bytecode[pc + 1]
+                if locals[local + 2] > 0:
+                    done = locals[local] > locals[local + 1]
+                else:
+                    done = locals[local] < locals[local + 1]
+                if done:
+                    pc = bytecode[pc + 2]
+                else:
+                    pc += 3
+            elif opcode == FOR_NEXT:
+                local = bytecode[pc + 1]
+                locals[local] += locals[local + 2]
+                pc = bytecode[pc + 2]
+            elif opcode == JUMP_NOT_NIL:
+                value = pop()
+                if value is None:
+                    pc += 3
+                elif (value is true or value is false or
+                      value.__class__ is int or value.__class__ is long):
+                    pc = bytecode[pc + 1]
+                else:
+                    push(value)
+                    pc = bytecode[pc + 2]
+            elif opcode == FOR_PREP:
+                end = stack[-1]
+                start = stack[-2]
+                if ((start.__class__ is int or start.__class__ is long) and
+                        (end.__class__ is int or end.__class__ is long)):
+                    del stack[-2:]
+                    local = bytecode[pc + 1]
+                    locals[local] = start
+                    locals[local + 1] = end
+                    # as Interval from:to: has it
+                    locals[local + 2] = -1 if end < start else 1
+                    pc += 3
+                else:
+                    pc = bytecode[pc + 2]
+            elif opcode == PUSH_OUTER:
+                outer = context
+                for _ in xrange(bytecode[pc + 1]):
+                    outer = outer.outer
+                push(outer.locals[bytecode[pc + 2]])
+                pc += 3
+            elif opcode == STORE_TEMP:
+                locals[bytecode[pc + 1]] = stack[-1]
+                pc += 2
+            elif opcode == MAKE_BLOCK:
+                push(Closure(self.block_class,
+                             code.blocks[bytecode[pc + 1]], context))
+                pc += 2
+            elif opcode == STORE_OUTER:
+                outer = context
+                for _ in xrange(bytecode[pc + 1]):
+                    outer = outer.outer
+                outer.locals[bytecode[pc + 2]] = stack[-1]
+                pc += 3
+            elif opcode == PUSH_NIL:
+                push(None)
+                pc += 1
+            elif opcode == PUSH_TRUE:
+                push(self.true)
+                pc += 1
+            elif opcode == PUSH_FALSE:
+                push(self.false)
+                pc += 1
+            elif opcode == DUP:
+                push(stack[-1])
+                pc += 1
+            elif opcode == STORE_NAME:
+                self._store_name(code.names[bytecode[pc + 1]], receiver,
+                                 method, stack[-1])
+                pc += 2
+            elif opcode == SUPER_SEND:
+                selector = sites[bytecode[pc + 1]].message
+                count = bytecode[pc + 2]
+                pc += 3
+                if count:
+                    arguments = stack[-count:]
+                    del stack[-count:]
+                else:
+                    arguments = []
+                push(self.send_super(method, pop(), selector, arguments))
+            elif opcode == RETURN_HOME:
+                value = pop()
+                home = context.home
+                if home is context and code.base is None:
+                    return value
+                if not home.live:
+                    raise OnyxError('non-local return to a method that has '
+                                    'returned')
+                raise _NonLocalReturn(home, value)
+            else:
+                raise OnyxError('bad opcode {0} at {1} in {2!r}'.format(
+                    opcode, pc, code))
+
+    def _load_name(self, name, receiver, method):
+        # an instance variable of the receiver, or else a global
+        if method is not None:
+            index = method.owner.variable_index.get(name)
+            if index is not None:
+                return receiver.ivars[index]
+        return self.load_global(name)
+
+    def _store_name(self, name, receiver, method, value):
+        if method is not None:
+            index = method.owner.variable_index.get(name)
+            if index is not None:
+                receiver.ivars[index] = value
+                return
+        self.store_global(name, value)
+
+    def load_global(self, name):
+        try:
+            return self.globals[name]
+        except KeyError:
+            raise OnyxError('undefined variable: {0}'.format(name))
+
+    def store_global(self, name, value):
+        self.globals[name] = value
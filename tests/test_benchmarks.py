@@ -0,0 +1,48 @@
+import glob
+import os
+import tempfile
+import unittest
+
+from benchmarks.runner import (BENCHMARKS, cases, compare, run_case,
+                               run_isolated)
+
+
+class CompareTests(unittest.TestCase):
+    def result(self, mean, stddev=0.0):
+        return {'mean': mean, 'stddev': stddev}
+
+    def test_regression(self):
+        baseline = {'a': self.result(100), 'b': self.result(100)}
+        results = {'a': self.result(80), 'b': self.result(95)}
+        self.assertEqual([(key, regression) for key, _, _, _, regression
+                          in compare(baseline, results, 0.1)],
+                         [('a', True), ('b', False)])
+
+    def test_noise_is_not_a_regression(self):
+        baseline = {'a': self.result(100, 15)}
+        results = {'a': self.result(80, 10)}
+        self.assertFalse(compare(baseline, results, 0.1)[0][4])
+
+    def test_new_cases_are_skipped(self):
+        self.assertEqual(compare({}, {'a': self.result(1)}), [])
+
+
+class RunTests(unittest.TestCase):
+    def test_every_case_runs(self):
+        for key, name, input_name in cases():
+            result = run_case(name, input_name, repeat=1, scale=0.05)
+            self.assertGreater(result['units'], 0, key)
+            self.assertGreater(result['mean'], 0, key)
+            self.assertEqual(result['unit'],
+                             BENCHMARKS[name][1] + '/s')
+
+    def test_temporary_files_are_removed(self):
+        pattern = os.path.join(tempfile.gettempdir(), 'tmp*.ost')
+        before = set(glob.glob(pattern))
+        run_case('stream.file', 'system', repeat=1, scale=0.05)
+        run_isolated('stream.file', 'system', 1, 0.05)
+        self.assertEqual(set(glob.glob(pattern)) - before, set())
+
+    def test_pattern(self):
+        self.assertEqual([key for key, _, _ in cases('headers')],
+                         ['parser.headers/headers'])
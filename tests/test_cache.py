@@ -0,0 +1,76 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+
+SYSTEM = os.path.join(os.path.dirname(__file__), '..', 'system.ost')
+
+
+class EncodeTests(unittest.TestCase):
+    def test_round_trip(self):
+        from onyx.cache import decode, encode, parse_source
+        with open(SYSTEM, 'rb') as f:
+            definitions = parse_source(f.read())
+        decoded = [decode(encode(d)) for d in definitions]
+        self.assertEqual(definitions, decoded)
+        self.assertEqual([getattr(d, 'span', None) for d in definitions],
+                         [getattr(d, 'span', None) for d in decoded])
+        self.assertEqual(definitions[0].methods[3].span,
+                         decoded[0].methods[3].span)
+
+
+class LoadFileTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.directory, 'cache')
+        self.filename = os.path.join(self.directory, 'test.ost')
+        self.write('Object subclass: A [ foo [ ^ 1 ] ]')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, source):
+        with open(self.filename, 'w') as f:
+            f.write(source)
+
+    def load(self):
+        from onyx.cache import load_file
+        return load_file(self.filename, self.cache_dir)
+
+    def cache_file(self):
+        from onyx.cache import cache_path
+        return cache_path(self.filename, self.cache_dir)
+
+    def test_writes_cache(self):
+        definitions = self.load()
+        self.assertTrue(os.path.exists(self.cache_file()))
+        self.assertEqual(['A'], [d.name for d in definitions])
+        self.assertEqual(1, len(os.listdir(self.cache_dir)))
+
+    def test_uses_cache(self):
+        from onyx import cache
+        first = self.load()
+        parse_source = cache.parse_source
+        cache.parse_source = None
+        try:
+            self.assertEqual(first, self.load())
+        finally:
+            cache.parse_source = parse_source
+
+    def test_stale(self):
+        self.load()
+        self.write('Object subclass: B [ ]')
+        self.assertEqual(['B'], [d.name for d in self.load()])
+
+    def test_corrupt(self):
+        self.load()
+        with open(self.cache_file(), 'wb') as f:
+            f.write('garbage')
+        self.assertEqual(['A'], [d.name for d in self.load()])
+
+    def test_default_location(self):
+        from onyx.cache import CACHE_DIRECTORY, cache_path
+        path = cache_path(self.filename)
+        self.assertEqual(os.path.join(self.directory, CACHE_DIRECTORY),
+                         os.path.dirname(path))
@@ -0,0 +1,187 @@
+import os
+import random
+import unittest
+
+from onyx.cache import parse_source
+from onyx.incremental import Document
+from onyx.parser import ParseError
+from onyx.reader import FastReader, ReadError
+from onyx.term import Node
+from onyx.util.stream import EmptyStreamError
+
+
+SYSTEM = os.path.join(os.path.dirname(__file__), '..', 'system.ost')
+
+SOURCE = '''\
+Object subclass: A [
+    | x |
+    foo [ ^ x ]
+    bar: y [ x := [:z | z + y ] value: 1 ]
+    A class [ | count | new [ ^ super new ] ]
+]
+a := A new .
+A subclass: B [ baz [ ^ 'a string' ] quux [ "comment" ^ ( 1 + 2 ) ] ]
+a foo
+'''
+
+
+def term_tree(term):
+    if term.is_compound:
+        return (term.kind, term.start, term.end,
+                [term_tree(t) for t in term.value])
+    return term.kind, term.start, term.end, term.value
+
+
+def spans(value):
+    # the positions of every node under value
+    if isinstance(value, Node):
+        result = [(value.__class__.__name__, value.start, value.end)]
+        for name in value._fields:
+            result.extend(spans(getattr(value, name)))
+        return result
+    elif isinstance(value, (list, tuple)):
+        return [span for item in value for span in spans(item)]
+    return []
+
+
+class DocumentEditTests(unittest.TestCase):
+    def setUp(self):
+        self.document = Document(SOURCE)
+
+    def edit(self, old, new, occurrence=0):
+        offset = -1
+        for _ in range(occurrence + 1):
+            offset = self.document.source.index(old, offset + 1)
+        return self.document.edit(offset, len(old), new)
+
+    def check(self):
+        source = self.document.source
+        self.assertEqual([term_tree(t) for t in self.document.terms],
+                         [term_tree(t) for t in FastReader(source)])
+        definitions = parse_source(source)
+        self.assertEqual(self.document.definitions, definitions)
+        self.assertEqual(spans(self.document.definitions), spans(definitions))
+
+    def test_method_body(self):
+        a, _, b, _ = self.document.definitions
+        foo, bar = a.methods
+        changed = self.edit('^ x', '^ x + 1')
+        self.assertEqual(len(changed), 1)
+        self.assertEqual(changed[0].selector, 'foo')
+        self.assertIs(self.document.definitions[0], a)
+        self.assertIs(a.methods[1], bar)
+        self.assertIs(self.document.definitions[2], b)
+        self.check()
+
+    def test_nested_block(self):
+        changed = self.edit('z + y', 'z * y')
+        self.assertEqual([method.selector for method in changed], ['bar:'])
+        self.check()
+
+    def test_class_side_method(self):
+        changed = self.edit('super new', 'self basicNew')
+        self.assertEqual([method.selector for method in changed], ['new'])
+        self.check()
+
+    def test_method_header_reuses_other_methods(self):
+        a = self.document.definitions[0]
+        foo, bar = a.methods
+        changed = self.edit('foo', 'foo2')
+        self.assertEqual([definition.name for definition in changed], ['A'])
+        self.assertEqual(changed[0].methods[0].selector, 'foo2')
+        self.assertIs(changed[0].methods[1], bar)
+        self.check()
+
+    def test_top_level(self):
+        self.edit('A new', 'A new foo')
+        self.check()
+        self.edit('B', 'C')
+        self.check()
+        self.edit('a foo', 'a foo .\nObject subclass: D [ ]')
+        self.check()
+        self.assertEqual(self.document.definitions[-1].name, 'D')
+
+    def test_edit_that_splits_a_token(self):
+        self.edit('count', 'co unt')
+        self.check()
+        self.edit('co unt', 'count')
+        self.check()
+
+    def test_unbalanced_edit(self):
+        with self.assertRaises(ReadError):
+            self.edit('^ x ]', '^ x ]]')
+        self.assertIsNone(self.document.terms)
+        self.edit(']]', ']')
+        self.check()
+
+    def test_method_that_does_not_parse(self):
+        a = self.document.definitions[0]
+        foo = a.methods[0]
+        with self.assertRaises(ParseError):
+            self.edit('^ x', '^ x :=')
+        self.assertIs(a.methods[0], foo)
+        self.edit(':=', '')
+        self.check()
+
+    def test_edit_after_a_method_that_does_not_parse(self):
+        # the broken method isn't kept in the definitions of later edits
+        with self.assertRaises(ParseError):
+            self.edit('^ x', '^ x :=')
+        with self.assertRaises(ParseError):
+            self.edit('z + y', 'z * y')
+        with self.assertRaises(ParseError):
+            self.document.definitions
+        self.edit(':=', '')
+        self.check()
+
+    def test_out_of_range(self):
+        with self.assertRaises(ValueError):
+            self.document.edit(len(SOURCE), 1, '')
+
+
+class DocumentRandomEdits(unittest.TestCase):
+    fragments = [' ', 'x', '.', '[', ']', '"', "'", ' foo ', '^ 1', '3',
+                 '\n', ':', 'a: b', ' | t | ']
+
+    def test_random_edits(self):
+        rng = random.Random(1)
+        document = Document(SOURCE)
+        for _ in range(300):
+            source = document.source
+            offset = rng.randrange(len(source) + 1)
+            length = min(rng.choice([0, 0, 1, 2, 5]), len(source) - offset)
+            text = rng.choice(self.fragments + [''])
+            try:
+                expected = parse_source(source[:offset] + text +
+                                        source[offset + length:])
+            except (ReadError, ParseError, EmptyStreamError):
+                expected = None
+            try:
+                document.edit(offset, length, text)
+            except (ReadError, ParseError, EmptyStreamError):
+                self.assertIsNone(expected)
+                # undo it, the document having been left either way
+                document.edit(offset, len(text),
+                              source[offset:offset + length])
+                continue
+            self.assertEqual(document.definitions, expected)
+            self.assertEqual(spans(document.definitions), spans(expected))
+            self.assertEqual(
+                [term_tree(t) for t in document.terms],
+                [term_tree(t) for t in FastReader(document.source)])
+
+
+class DocumentSystemTests(unittest.TestCase):
+    def test_edit_every_method(self):
+        with open(SYSTEM) as f:
+            document = Document(f.read())
+        # comment the end of each method body, last first
+        methods = [method for definition in document.definitions
+                   if hasattr(definition, 'methods')
+                   for method in definition.methods]
+        for method in reversed(methods):
+            changed = document.edit(method.span[1] - 1, 0, '"edited" ')
+            self.assertEqual(changed, [method])
+        definitions = parse_source(document.source)
+        self.assertEqual(document.definitions, definitions)
+        self.assertEqual(spans(document.definitions), spans(definitions))
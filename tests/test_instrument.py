@@ -0,0 +1,88 @@
+import unittest
+
+from onyx.instrument import Profiler
+from onyx.parser import Parser
+from onyx.reader import FastReader, Reader
+from onyx.util.stream import PendingState, Stream
+
+
+SOURCE = '''\
+Object subclass: A [
+    foo [ ^ [:a || b | a + b ] value: 1 ]
+]
+A new foo
+'''
+
+
+class ProfilerTests(unittest.TestCase):
+    def parse(self, reader):
+        return list(Parser(reader).parse_file())
+
+    def test_counts(self):
+        with Profiler() as profiler:
+            self.parse(Reader(Stream.from_sequence(SOURCE)))
+        calls = dict((name, count)
+                     for name, count, _ in profiler.report())
+        self.assertEqual(calls['Parser.parse_class_definition'], 1)
+        self.assertEqual(calls['Parser.parse_method_definition'], 1)
+        self.assertEqual(calls['Parser.parse_block'], 1)
+        self.assertEqual(calls['Parser.subparse'], 3)
+        self.assertGreater(calls['Reader.read_term'], 0)
+        self.assertEqual(profiler.counters['stream.force'], len(SOURCE) + 1)
+        self.assertEqual(profiler.counters['subparse.frame'], 3)
+        self.assertEqual(profiler.counters['parser'], 1)
+        # '||' is split and '|' pushed back into the block's terms
+        self.assertEqual(profiler.counters['push_term'], 1)
+        self.assertEqual(profiler.counters['push_term.rebuild'], 1)
+
+    def test_recursion_is_timed_once(self):
+        with Profiler() as profiler:
+            self.parse(FastReader(SOURCE))
+        seconds = dict((name, seconds)
+                       for name, _, seconds in profiler.report())
+        self.assertLessEqual(seconds['Parser.parse_expression'],
+                             seconds['Parser.parse_file_item'])
+
+    def test_disable_restores_methods(self):
+        methods = (Parser.__dict__['parse_block'],
+                   Reader.__dict__['read_term'],
+                   PendingState.__dict__['force'])
+        profiler = Profiler()
+        with profiler:
+            self.assertTrue(profiler.enabled)
+            self.assertIsNot(Parser.__dict__['parse_block'], methods[0])
+            with self.assertRaises(RuntimeError):
+                Profiler().enable()
+        self.assertFalse(profiler.enabled)
+        self.assertEqual((Parser.__dict__['parse_block'],
+                          Reader.__dict__['read_term'],
+                          PendingState.__dict__['force']), methods)
+        self.parse(FastReader(SOURCE))
+        self.assertEqual(profiler.report(), [])
+
+    def test_subclasses(self):
+        class MyParser(Parser):
+            def parse_statement(self):
+                return super(MyParser, self).parse_statement()
+
+        with Profiler([MyParser]) as profiler:
+            list(MyParser(FastReader('a foo . b bar')).parse_file())
+        calls = dict((name, count)
+                     for name, count, _ in profiler.report())
+        self.assertEqual(calls['MyParser.parse_statement'], 2)
+        self.assertEqual(calls['Parser.parse_statement'], 2)
+
+    def test_collapsed(self):
+        with Profiler() as profiler:
+            self.parse(FastReader(SOURCE))
+        lines = profiler.collapsed()
+        stacks = [line.rsplit(' ', 1)[0] for line in lines]
+        self.assertIn('Parser.parse_file_item;Parser.parse_class_definition',
+                      stacks)
+        for line in lines:
+            stack, count = line.rsplit(' ', 1)
+            self.assertGreaterEqual(int(count), 0)
+            self.assertNotIn(' ', stack)
+        report = profiler.format_report()
+        self.assertIn('Parser.parse_class_definition', report)
+        self.assertIn('subparse.frame', report)
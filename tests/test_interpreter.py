@@ -0,0 +1,464 @@
+import threading
+import unittest
+
+from onyx.cache import parse_source
+from onyx.interpreter import (IDLE_WORKERS, SITE_ENTRIES, SYSTEM, Interpreter,
+                              _Worker)
+from onyx.location import SourceError
+from onyx.runtime import Class, OnyxError, Symbol
+from onyx.parser import Parser
+from onyx.reader import FastReader
+from onyx.term import ClassTerm, UnarySend
+
+
+_system = []
+
+
+def system_definitions():
+    if not _system:
+        with open(SYSTEM, 'rb') as f:
+            _system.extend(parse_source(f.read(), filename=SYSTEM))
+    return _system
+
+
+class InterpreterTestCase(unittest.TestCase):
+    interpreter_class = Interpreter
+
+    def setUp(self):
+        self.interpreter = self.interpreter_class()
+        self.interpreter.execute(system_definitions())
+
+    def evaluate(self, source):
+        return self.interpreter.evaluate(source)
+
+    def load(self, source):
+        self.interpreter.load_source(source)
+
+    def assertEvaluates(self, source, expected):
+        self.assertEqual(
+            self.interpreter.print_string(self.evaluate(source)), expected)
+
+
+class BootstrapTests(InterpreterTestCase):
+    def test_classes(self):
+        globals = self.interpreter.globals
+        self.assertIsNone(globals['Object'].superclass)
+        self.assertIs(globals['True'].superclass, globals['Boolean'])
+        # the class side chain ends in Class and then Object
+        self.assertIs(globals['Object'].cls.superclass, globals['Class'])
+        self.assertTrue(globals['Array'].cls.inherits_from(globals['Object']))
+        self.assertEqual(globals['Interval'].all_variables,
+                         ['start', 'end', 'step'])
+
+    def test_top_level_statements(self):
+        globals = self.interpreter.globals
+        self.assertIs(globals['DefaultPromptTag'].cls, globals['PromptTag'])
+        self.assertIs(globals['CurtailedMark'].cls,
+                      globals['ContinuationMark'])
+
+    def test_bootstrap_from_file(self):
+        interpreter = self.interpreter_class()
+        interpreter.bootstrap()
+        self.assertIsInstance(interpreter.globals['OrderedCollection'], Class)
+
+    def test_primitive_dispatch(self):
+        from onyx.primitives import PRIMITIVES
+        self.assertIs(self.interpreter.primitives['_addSmallInt:'],
+                      PRIMITIVES['_addSmallInt:'])
+        selectors = set()
+        for definition in system_definitions():
+            if isinstance(definition, ClassTerm):
+                for method in definition.methods + definition.class_methods:
+                    for statement in method.statements:
+                        message = getattr(statement, 'message', '')
+                        if message.startswith('_'):
+                            selectors.add(message)
+        self.assertTrue(selectors)
+        self.assertEqual(selectors - set(PRIMITIVES), set())
+
+
+class EvaluateTests(InterpreterTestCase):
+    def test_arithmetic(self):
+        self.assertEqual(self.evaluate('3 + 4 * 2'), 14)
+        self.assertEqual(self.evaluate('7 // 2'), 3)
+        self.assertEqual(self.evaluate('-7 // 2'), -3)
+        self.assertEvaluates('3 < 4', 'true')
+        self.assertEvaluates('3 >= 4', 'false')
+        self.assertEvaluates('5 between: 1 and: 5', 'true')
+        self.assertEqual(self.evaluate('-5 sign'), -1)
+
+    def test_booleans_and_nil(self):
+        self.assertEqual(self.evaluate('(3 = 3) ifTrue: [ 1 ] ifFalse: [ 2 ]'),
+                         1)
+        self.assertEqual(self.evaluate('nil ifNil: [ 1 ] ifNotNil: [ 2 ]'), 1)
+        self.assertEvaluates('true and: [ false ]', 'false')
+        self.assertEvaluates('nil isNil', 'true')
+        self.assertEvaluates('3 ~= 4', 'true')
+
+    def test_variables(self):
+        self.assertEqual(self.evaluate('| a b | a := 3. b := a + 1. a * b'),
+                         12)
+        self.assertEqual(self.evaluate('Counter := 5. Counter + 1'), 6)
+        self.assertEqual(self.interpreter.globals['Counter'], 5)
+        with self.assertRaises(OnyxError):
+            self.evaluate('undefinedThing')
+        with self.assertRaises(OnyxError):
+            self.evaluate('self := 3')
+
+    def test_blocks(self):
+        self.assertEqual(self.evaluate('[:x :y | x - y ] value: 5 value: 3'),
+                         2)
+        self.assertEqual(self.evaluate(
+            '| n | n := 0. [ n < 20 ] whileTrue: [ n := n + 1 ]. n'), 20)
+        self.assertIsNone(self.evaluate('[ ] value'))
+        with self.assertRaises(OnyxError):
+            self.evaluate('[:x | x ] value')
+
+    def test_blocks_kept_by_callee(self):
+        # passed down, but kept and called after the code making them has
+        # returned, and from inside themselves
+        self.load('''\
+Object subclass: Holder [
+    | b |
+    set: aBlock [ b := aBlock ]
+    run: x [ ^ b value: x ]
+]
+Object subclass: Maker [
+    add: h [ | t | t := 10. h set: [:y | | z | z := y. t + z ]. ^ t ]
+    sum: h [
+        h set: [:y | y = 0 ifTrue: [ 0 ] ifFalse: [ y + (h run: y - 1) ] ]
+    ]
+]
+''')
+        self.assertEqual(self.evaluate(
+            '| h | h := Holder new. Maker new add: h. '
+            '(h run: 1) + (h run: 2)'), 23)
+        self.assertEqual(self.evaluate(
+            '| h | h := Holder new. Maker new sum: h. h run: 4'), 10)
+
+    def test_control_flow(self):
+        # whether or not the sends are inlined, they are sent to whatever
+        # isn't a Boolean, nil or a SmallInt
+        self.load('''\
+Object subclass: Maybe [
+    ifTrue: t ifFalse: f [ ^ 'maybe' ]
+    ifFalse: f ifTrue: t [ ^ t value ]
+    to: end do: aBlock [ ^ aBlock value: end ]
+]
+Object subclass: Flow [
+    pick: x [ ^ x ifTrue: [ 1 ] ifFalse: [ 2 ] ]
+    orNil: x [ ^ x ifNil: [ 0 ] ifNotNil: [ x + 1 ] ]
+    from: a to: b [
+        | c |
+        c := OrderedCollection new.
+        a to: b do: [:i | i isOdd ifFalse: [ c add: i ] ].
+        ^ c asArray
+    ]
+    firstOver: n [
+        | i |
+        i := 0.
+        [ true ] whileTrue: [ i := i + 1. i > n ifTrue: [ ^ i ] ]
+    ]
+    countDown: n [ | i | i := n. [ i = 0 ] whileFalse: [ i := i - 1 ]. ^ i ]
+    maybeLoop [
+        | i |
+        i := 0.
+        [ i < 3 ifTrue: [ Maybe new ] ifFalse: [ false ] ]
+            whileTrue: [ i := i + 1 ].
+        ^ i
+    ]
+]
+''')
+        self.assertEqual(self.evaluate('Flow new pick: true'), 1)
+        self.assertEqual(self.evaluate('Flow new pick: false'), 2)
+        self.assertEqual(self.evaluate('Flow new pick: Maybe new'), 'maybe')
+        with self.assertRaises(OnyxError):
+            self.evaluate('Flow new pick: 3')
+        self.assertEqual(self.evaluate('Flow new orNil: nil'), 0)
+        self.assertEqual(self.evaluate('Flow new orNil: 4'), 5)
+        self.assertEvaluates('Flow new from: 0 to: 6', '(0 2 4 6)')
+        self.assertEvaluates('Flow new from: 4 to: 1', '(4 2)')
+        self.assertEvaluates('Flow new from: 2 to: 2', '(2)')
+        self.assertEvaluates('Flow new from: Maybe new to: 2', '(2)')
+        self.assertEqual(self.evaluate('Flow new firstOver: 5'), 6)
+        self.assertEqual(self.evaluate('Flow new countDown: 3'), 0)
+        self.assertEqual(self.evaluate('Flow new maybeLoop'), 3)
+        self.assertEqual(self.evaluate('(Interval from: 1 to: 0 by: 1) size'),
+                         0)
+        self.assertEqual(self.evaluate('(5 to: 7) size'), 3)
+
+    def test_non_local_return(self):
+        self.assertEvaluates('3 isKindOf: Number', 'true')
+        self.assertEvaluates('3 isKindOf: String', 'false')
+        self.assertEqual(self.evaluate('[ ^ 3 ] value. 4'), 3)
+
+    def test_collections(self):
+        self.assertEqual(self.evaluate('(Array with: 5) at: 0'), 5)
+        self.assertEqual(self.evaluate(
+            '| c | c := OrderedCollection new. '
+            'c add: 1; add: 2; addFirst: 0. '
+            '(c inject: 0 into: [:a :e | a + e ]) + c size'), 6)
+        self.assertEvaluates(
+            '| c | c := OrderedCollection new. c add: 3; add: 4. '
+            'c asArray', '(3 4)')
+        self.assertEvaluates("'ab' , 'cd'", "'abcd'")
+        self.assertEqual(self.evaluate("'abc' size"), 3)
+        self.assertIs(self.evaluate("'abc' asSymbol"), Symbol('abc'))
+        self.assertEvaluates(
+            "| s | s := String new: 2. "
+            "s at: 0 put: (Character codePoint: 97); "
+            "  at: 1 put: (Character codePoint: 98). "
+            "s , 'c'", "'abc'")
+        self.assertEvaluates(
+            "| s | s := 'abc' copy. s at: 1 put: (Character codePoint: 120). "
+            "s", "'axc'")
+        self.assertIs(self.evaluate("'ab' copy asSymbol"), Symbol('ab'))
+        with self.assertRaises(OnyxError):
+            self.evaluate("'abc' at: 0 put: (Character codePoint: 120)")
+        self.assertEvaluates('(Array new: 2) includes: nil', 'true')
+        with self.assertRaises(OnyxError):
+            self.evaluate('(Array new: 2) at: 2')
+
+    def test_classes(self):
+        self.interpreter.load_source('''\
+Object subclass: Point [
+    | x y |
+    Point class [ x: ax y: ay [ self new setX: ax y: ay; yourself ] ]
+    setX: ax y: ay [ x := ax. y := ay ]
+    x [ x ]
+    y [ y ]
+    + other [ Point x: x + other x y: y + other y ]
+]
+Point subclass: Point3 [
+    | z |
+    x [ super x * 10 ]
+]
+''')
+        self.assertEqual(self.evaluate(
+            '((Point x: 1 y: 2) + (Point x: 3 y: 4)) x'), 4)
+        self.assertEqual(self.evaluate('(Point3 x: 1 y: 2) x'), 10)
+        self.assertEvaluates('Point3 new', 'a Point3')
+        self.assertEqual(self.evaluate('Point3 name'), 'Point3')
+        self.assertEqual(self.interpreter.globals['Point3'].all_variables,
+                         ['x', 'y', 'z'])
+
+    def test_loops_run_in_constant_stack(self):
+        # repeat recurses once per iteration
+        limit = self.interpreter.recursion_limit = 2000
+        self.assertEqual(self.evaluate(
+            '| n | n := 0. [ n < {0} ] whileTrue: [ n := n + 1 ]. n'.format(
+                limit)), limit)
+        self.interpreter.load_source('''\
+Object subclass: Countdown [
+    from: n [ n = 0 ifTrue: [ ^ 0 ]. ^ self from: n - 1 ]
+    down: n [ ^ n = 0 ifTrue: [ 0 ] ifFalse: [ self down: n - 1 ] ]
+]
+''')
+        # a method that a block can ^ return from keeps its activation
+        with self.assertRaises(OnyxError):
+            self.evaluate('Countdown new from: {0}'.format(limit))
+        self.assertEqual(self.evaluate(
+            'Countdown new down: {0}'.format(limit)), 0)
+
+    def test_parse_errors_are_located(self):
+        with self.assertRaises(SourceError) as raised:
+            self.interpreter.evaluate('3 +\n)', 'here.ost')
+        self.assertEqual(raised.exception.filename, 'here.ost')
+        self.assertEqual(raised.exception.line, 2)
+
+
+class ExceptionTests(InterpreterTestCase):
+    def test_handled(self):
+        self.assertEqual(self.evaluate(
+            "[ Error signal: 'boom' ] on: Error do: [:e | e messageText ]"),
+            'boom')
+        self.assertEqual(self.evaluate(
+            "[ [ Error signal: 'in' ] on: MessageNotUnderstood do: [:e | 1 ] ]"
+            "    on: Error do: [:e | e messageText , '!' ]"), 'in!')
+        self.assertEqual(self.evaluate(
+            "[ 1 foo ] on: MessageNotUnderstood do: [:e | 2 ]"), 2)
+
+    def test_unhandled(self):
+        with self.assertRaises(OnyxError) as raised:
+            self.evaluate("Error signal: 'top'")
+        self.assertEqual(str(raised.exception), 'top')
+        self.assertIs(raised.exception.value.cls,
+                      self.interpreter.globals['Error'])
+        with self.assertRaises(OnyxError) as raised:
+            self.evaluate('1 foo')
+        self.assertIn('#foo', str(raised.exception))
+        self.assertEqual(self.interpreter.mark_stack, [])
+
+    def test_escaping_continuation(self):
+        self.assertEqual(self.evaluate(
+            '[:k | 1 + (k value: 41) ] withCont: DefaultPromptTag'), 41)
+        with self.assertRaises(OnyxError):
+            self.evaluate('| k | k := [:c | c ] withCont: DefaultPromptTag. '
+                          'k value: 3')
+
+    def test_resume(self):
+        self.assertEqual(self.evaluate(
+            "[ (Error signal: 'x') + 1 ] on: Error do: [:e | e resume: 5 ]"),
+            6)
+        # what resuming returns is what the protected block does
+        self.assertEqual(self.evaluate(
+            "[ (Error signal: 'x') + 1 ] "
+            "    on: Error do: [:e | (e resume: 5) * 10 ]"), 60)
+        # signalling again once resumed, caught by the handler again
+        self.assertEqual(self.evaluate(
+            "| s | s := 0. "
+            "[ 1 to: 3 do: [:i | s := s + (Error signal: 'x') ]. s ] "
+            "    on: Error do: [:e | e resume: 10 ]"), 30)
+        self.assertEqual(self.evaluate(
+            "[ (Error signal: 'a') + (Error signal: 'bc') ] "
+            "    on: Error do: [:e | e resume: e messageText size ]"), 3)
+        with self.assertRaises(OnyxError):
+            self.evaluate("[ (Error signal: 'x') foo ] "
+                          "    on: Error do: [:e | e resume: 5 ]")
+        self.assertEqual(self.interpreter.mark_stack, [])
+        self.assertEqual(self.interpreter.mark_index, {})
+        self.assertEqual(self.interpreter.prompt_index, {})
+
+    def test_resume_nested(self):
+        # each level's handler runs in a worker thread of its own, but no
+        # more than IDLE_WORKERS are kept once they are done
+        self.assertEqual(self.evaluate(
+            "| f | f := nil. "
+            "f := [:n | n = 0 "
+            "    ifTrue: [ 0 ] "
+            "    ifFalse: [ [ (Error signal: 'x') + 1 ] "
+            "        on: Error do: [:e | e resume: (f value: n - 1) ] ] ]. "
+            "f value: 20"), 20)
+        self.assertLessEqual(len(_Worker.idle), IDLE_WORKERS)
+        self.assertEqual(self.interpreter.mark_index, {})
+        self.assertEqual(self.interpreter.prompt_index, {})
+
+    def test_resume_without_a_thread(self):
+        def start(worker):
+            raise threading.ThreadError("can't start new thread")
+        idle = _Worker.idle[:]
+        del _Worker.idle[:]
+        _Worker.start = start
+        try:
+            with self.assertRaises(OnyxError) as raised:
+                self.evaluate("[ [ (Error signal: 'x') + 1 ] "
+                              "      on: Error do: [:e | e resume: 5 ] ] "
+                              "    withMark: ExceptionHandlerMark value: 2")
+        finally:
+            del _Worker.start
+            _Worker.idle.extend(idle)
+        self.assertIn('thread', str(raised.exception))
+        self.assertEqual(self.interpreter.mark_stack, [])
+        self.assertEqual(self.interpreter.mark_index, {})
+        self.assertEqual(self.interpreter.prompt_index, {})
+
+    def test_prompts(self):
+        self.assertEqual(self.evaluate(
+            '| t | t := PromptTag new. '
+            '[ ([ t abort: 3 ] withPrompt: t abort: [:x | x * 2 ]) + 1 ] '
+            '    withPrompt: t abort: [:x | 0 ]'), 7)
+        self.assertEvaluates(
+            '| m t | m := ContinuationMark new. t := PromptTag new. '
+            '[ [ [ t abort: 1 ] withMark: m value: 2 ] '
+            '      withPrompt: t abort: [:x | m marks: DefaultPromptTag ] ] '
+            '    withMark: m value: 1', '(1)')
+        with self.assertRaises(OnyxError):
+            self.evaluate('[ PromptTag new abort: 1 ] withMark: 1 value: 2')
+        self.assertEqual(self.interpreter.mark_stack, [])
+
+    def test_marks(self):
+        self.assertEvaluates(
+            '| m | m := ContinuationMark new. '
+            '[ [ m marks: DefaultPromptTag ] withMark: m value: 2 ] '
+            '    withMark: m value: 1', '(2 1)')
+        self.assertEvaluates(
+            '| m t | m := ContinuationMark new. t := PromptTag new. '
+            '[ [ [ m marks: t ] withMark: m value: 2 ] withPrompt: t ] '
+            '    withMark: m value: 1', '(2)')
+
+    def test_first_mark(self):
+        self.assertEqual(self.evaluate(
+            '| m t | m := ContinuationMark new. t := PromptTag new. '
+            '[ [ m firstMark: t ] withMark: m value: 2 ] '
+            '    withMark: m value: 1'), 2)
+        self.assertIsNone(self.evaluate(
+            '| m t | m := ContinuationMark new. t := PromptTag new. '
+            '[ [ m firstMark: t ] withPrompt: t ] withMark: m value: 1'))
+        self.assertEqual(self.evaluate(
+            '| m t | m := ContinuationMark new. t := PromptTag new. '
+            '[ [ [ m firstMark: DefaultPromptTag ] withPrompt: t ] '
+            '      withMark: 3 value: 2 ] withMark: m value: 1'), 1)
+
+    def test_marks_are_unindexed_when_unwound(self):
+        self.evaluate(
+            "[ [ [ Error signal: 'x' ] on: Error do: [:e | 1 ] ] "
+            "      withMark: ExceptionHandlerMark value: 2 ] ifCurtailed: [ ]")
+        with self.assertRaises(OnyxError):
+            self.evaluate("[ Error signal: 'x' ] "
+                          "    on: MessageNotUnderstood do: [:e | 1 ]")
+        self.assertEqual(self.interpreter.mark_index, {})
+        self.assertEqual(self.interpreter.prompt_index, {})
+
+
+class SendSiteTests(InterpreterTestCase):
+    def setUp(self):
+        super(SendSiteTests, self).setUp()
+        self.interpreter.load_source('\n'.join(
+            'Object subclass: C{0} [ value [ {0} ] ]'.format(n)
+            for n in range(SITE_ENTRIES + 1)))
+        self.site = UnarySend(None, 'value')
+
+    def send(self, receiver):
+        return self.interpreter.send_site(self.site, receiver, [])
+
+    def instance(self, n):
+        return self.evaluate('C{0} new'.format(n))
+
+    def test_monomorphic_and_polymorphic(self):
+        self.assertEqual(self.send(self.instance(0)), 0)
+        self.assertIs(self.site.cache_class, self.instance(0).cls)
+        self.assertEqual(self.send(self.instance(0)), 0)
+        for n in range(1, SITE_ENTRIES):
+            self.assertEqual(self.send(self.instance(n)), n)
+        self.assertEqual(len(self.site.cache_class), SITE_ENTRIES)
+        self.assertEqual([self.send(self.instance(n))
+                          for n in range(SITE_ENTRIES)],
+                         range(SITE_ENTRIES))
+
+    def test_megamorphic(self):
+        for n in range(SITE_ENTRIES + 1):
+            self.send(self.instance(n))
+        self.assertNotIsInstance(self.site.cache_class, (tuple, Class))
+        self.assertIsNone(self.site.cache_method)
+        self.assertEqual([self.send(self.instance(n))
+                          for n in range(SITE_ENTRIES + 1)],
+                         range(SITE_ENTRIES + 1))
+
+    def test_redefinition_empties_sites(self):
+        receiver = self.instance(0)
+        self.send(receiver)
+        self.interpreter.load_source('Object subclass: C0 [ value [ 10 ] ]')
+        self.assertEqual(self.send(receiver), 10)
+        # through a subclass, after a superclass change
+        self.interpreter.load_source('C0 subclass: D [ ]')
+        receiver = self.evaluate('D new')
+        self.assertEqual(self.send(receiver), 10)
+        self.interpreter.load_source('C1 subclass: D [ ]')
+        self.assertEqual(self.send(receiver), 1)
+
+    def test_primitive_and_not_understood(self):
+        site = UnarySend(None, '_stringSize')
+        self.assertEqual(self.interpreter.send_site(site, 'abc', []), 3)
+        self.assertIs(site.cache_method,
+                      self.interpreter.primitives['_stringSize'])
+        with self.assertRaises(OnyxError):
+            self.send(3)
+        self.assertIsNone(self.site.cache_class)
+
+    def test_frozen_nodes(self):
+        statements = Parser(FastReader('-5 sign')).parse_executable_code()[1]
+        node = statements[0].freeze()
+        self.assertEqual(self.interpreter.run([node], None), -1)
+        self.assertIsNotNone(node.cache_class)
+        self.assertEqual(node, UnarySend(statements[0].receiver,
+                                         'sign').freeze())
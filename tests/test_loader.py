@@ -0,0 +1,109 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from onyx.cache import parse_source
+from onyx.loader import (LoadError, chunk, item_boundaries, load_files,
+                         parse_range)
+from onyx.parser import ParseError
+from onyx.reader import ReadError
+
+from .test_incremental import spans
+
+
+SYSTEM = os.path.join(os.path.dirname(__file__), '..', 'system.ost')
+
+
+class ChunkTests(unittest.TestCase):
+    def test_item_boundaries(self):
+        source = 'a foo . Object subclass: A [ ] Object subclass: B [ ]\nb bar'
+        self.assertEqual(item_boundaries(source), [0, 7, 30, 53])
+
+    def test_unreadable_source_is_not_split(self):
+        self.assertEqual(item_boundaries('a . b [ . c'), [0])
+
+    def test_chunks_parse_as_the_whole(self):
+        with open(SYSTEM) as f:
+            source = f.read() * 3
+        ranges = chunk(source, 5000)
+        self.assertGreater(len(ranges), 3)
+        self.assertEqual(ranges[0][0], 0)
+        self.assertEqual(ranges[-1][1], len(source))
+        definitions = []
+        for start, end in ranges:
+            definitions.extend(parse_range(source, start, end))
+        whole = parse_source(source)
+        self.assertEqual(definitions, whole)
+        self.assertEqual(spans(definitions), spans(whole))
+
+    def test_offset(self):
+        source = 'a foo . Object subclass: A [ bar [ ^ 1 ] ]'
+        definitions = parse_range(source[8:], 0, len(source) - 8,
+                                  offset=8)
+        whole = parse_source(source)[1:]
+        self.assertEqual(definitions, whole)
+        self.assertEqual(spans(definitions), spans(whole))
+        for text, error in [('a foo . b [ ', ReadError),
+                            ('a foo . b := .', ParseError)]:
+            with self.assertRaises(error) as whole:
+                parse_range(text, 0, len(text))
+            with self.assertRaises(error) as raised:
+                parse_range(text[8:], 0, len(text) - 8, offset=8)
+            self.assertEqual(raised.exception.position,
+                             whole.exception.position)
+
+
+class LoadFilesTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.directory, 'cache')
+        with open(SYSTEM) as f:
+            self.system = f.read()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, source):
+        filename = os.path.join(self.directory, name)
+        with open(filename, 'w') as f:
+            f.write(source)
+        return filename
+
+    def load(self, filenames, **options):
+        return load_files(filenames, cache_dir=self.cache_dir, **options)
+
+    def test_parallel_matches_serial(self):
+        filenames = [self.write('a.ost', self.system),
+                     self.write('b.ost', 'Object subclass: A [ foo [ ] ]'),
+                     self.write('c.ost', self.system * 2)]
+        parallel = self.load(filenames, workers=2, serial_size=0,
+                             chunk_size=8000)
+        expected = [parse_source(self.system),
+                    parse_source('Object subclass: A [ foo [ ] ]'),
+                    parse_source(self.system * 2)]
+        self.assertEqual(parallel, expected)
+        self.assertEqual(spans(parallel), spans(expected))
+        # and again from the cache
+        self.assertEqual(self.load(filenames, workers=2, serial_size=0),
+                         expected)
+
+    def test_errors_are_tagged_in_file_order(self):
+        filenames = [self.write('a.ost', self.system),
+                     self.write('b.ost', 'a foo . b := .'),
+                     self.write('c.ost', 'Object subclass: A [ foo [ ^ 1 ]'),
+                     self.write('d.ost', self.system + 'x ]' + self.system)]
+        for options in [{'workers': 1},
+                        {'workers': 2, 'serial_size': 0, 'chunk_size': 500}]:
+            with self.assertRaises(LoadError) as raised:
+                self.load(filenames, **options)
+            errors = raised.exception.errors
+            self.assertEqual([type(e) for e in errors],
+                             [ParseError, ReadError, ReadError])
+            self.assertEqual([e.filename for e in errors], filenames[1:])
+            self.assertEqual((errors[1].line, errors[1].column), (1, 20))
+            self.assertIn('b.ost:1:', str(raised.exception))
+            self.assertEqual((errors[2].line, errors[2].column),
+                             (len(self.system.splitlines()) + 1, 3))
+        # the file that loaded was cached all the same
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
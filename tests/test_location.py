@@ -0,0 +1,41 @@
+import unittest
+
+from onyx.location import LineIndex, SourceError
+
+
+class LineIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.lines = LineIndex('ab\ncd\n\nef')
+
+    def test_location(self):
+        self.assertEqual((1, 1), self.lines.location(0))
+        self.assertEqual((1, 3), self.lines.location(2))
+        self.assertEqual((2, 1), self.lines.location(3))
+        self.assertEqual((3, 1), self.lines.location(6))
+        self.assertEqual((4, 2), self.lines.location(8))
+
+    def test_offset(self):
+        for offset in range(9):
+            self.assertEqual(offset,
+                             self.lines.offset(*self.lines.location(offset)))
+
+    def test_len(self):
+        self.assertEqual(4, len(self.lines))
+        self.assertEqual(1, len(LineIndex('')))
+
+
+class SourceErrorTests(unittest.TestCase):
+    def test_str(self):
+        error = SourceError('oops')
+        self.assertEqual('oops', str(error))
+        error = SourceError('oops', 4)
+        self.assertEqual('oops (at offset 4)', str(error))
+        error.locate(LineIndex('ab\ncd'))
+        self.assertEqual('2:2: oops', str(error))
+        error.locate(LineIndex('ab\ncd'), 'a.ost')
+        self.assertEqual('a.ost:2:2: oops', str(error))
+        self.assertEqual((2, 2), (error.line, error.column))
+
+    def test_filename_only(self):
+        error = SourceError('oops').locate(LineIndex(''), 'a.ost')
+        self.assertEqual('a.ost: oops', str(error))
@@ -1,7 +1,9 @@
+import os
 import unittest
 
-from onyx.term import (AssignTerm, BinarySend, BlockTerm, Identifier,
-                       KeywordSend, UnarySend)
+from onyx.term import (AssignTerm, BinarySend, BlockTerm, ClassTerm,
+                       Identifier, KeywordSend, LiteralTerm, MethodTerm,
+                       UnarySend)
 
 
 # noinspection PyPep8Naming,PyAttributeOutsideInit
@@ -69,6 +71,26 @@ class TermTestCase(unittest.TestCase):
             term.as_identifier()
 
 
+class TermKindTestCase(unittest.TestCase):
+    def runTest(self):
+        from onyx.term import Term
+        term = Term('foo:', 'keyword')
+        self.assertTrue(term.is_keyword)
+        self.assertFalse(term.is_id)
+        self.assertEqual('keyword', term.kind_name)
+        self.assertFalse(hasattr(term, '__dict__'))
+
+        with self.assertRaises(AttributeError):
+            term.is_keyword = False
+
+
+class TermInternTestCase(unittest.TestCase):
+    def runTest(self):
+        from onyx.term import Term
+        name = ''.join(['sel', 'ector'])
+        self.assertIs(Term(name, 'id').value, Term('selector', 'id').value)
+
+
 class ParsePrimaryId(_ParserTestCase, unittest.TestCase):
     read_string = 'name'
     parse_method = 'primary'
@@ -310,3 +332,314 @@ class ParseTemporaryVariablesEmptyOneTerm(_ParserTestCase, unittest.TestCase):
     def check(self):
         self.assertEqual([], self.term)
 
+
+class TokenBufferTests(unittest.TestCase):
+    def test_peek_advance(self):
+        from onyx.parser import TokenBuffer
+        tokens = TokenBuffer(iter(range(5)))
+        self.assertEqual(0, tokens.peek())
+        self.assertEqual(3, tokens.peek(3))
+        tokens.advance()
+        self.assertEqual(1, tokens.peek())
+        self.assertTrue(tokens.has(3))
+        self.assertFalse(tokens.has(4))
+
+    def test_at_end(self):
+        from onyx.parser import TokenBuffer
+        from onyx.util.stream import EmptyStreamError
+        tokens = TokenBuffer(iter([1]))
+        self.assertFalse(tokens.at_end())
+        tokens.advance()
+        self.assertTrue(tokens.at_end())
+        with self.assertRaises(EmptyStreamError):
+            tokens.peek()
+
+    def test_pushback(self):
+        from onyx.parser import TokenBuffer
+        terms = [1, 2, 3]
+        tokens = TokenBuffer(terms)
+        tokens.pushback(0)
+        self.assertEqual(0, tokens.peek())
+        tokens.advance()
+        tokens.advance()
+        tokens.pushback('x')
+        self.assertEqual('x', tokens.peek())
+        self.assertEqual(2, tokens.peek(1))
+        self.assertEqual([1, 2, 3], terms)
+
+    def test_compaction(self):
+        from onyx.parser import TokenBuffer
+        tokens = TokenBuffer(iter(range(2000)))
+        for n in range(1999):
+            self.assertEqual(n, tokens.peek())
+            tokens.advance()
+        tokens.pushback('x')
+        self.assertEqual('x', tokens.peek())
+        self.assertEqual(1999, tokens.peek(1))
+        self.assertLess(len(tokens._terms), 1000)
+
+
+class ParseFromStream(unittest.TestCase):
+    def runTest(self):
+        from onyx.util.stream import Stream
+        from onyx.parser import Parser
+        from onyx.reader import Reader
+
+        reader = Reader(Stream.from_sequence('a foo: b'))
+        parser = Parser(Stream.from_sequence(reader))
+        self.assertIsInstance(parser.parse_expression(), KeywordSend)
+        self.assertTrue(parser.at_end())
+
+
+class SubparseInPlace(unittest.TestCase):
+    def parser(self, s):
+        from onyx.parser import Parser
+        from onyx.reader import StringReader
+        return Parser(StringReader(s))
+
+    def test_nested_blocks(self):
+        parser = self.parser('[ [ [ a ] ] ] foo')
+        term = parser.parse_expression()
+        self.assertIsInstance(term, UnarySend)
+        self.assertIsInstance(term.receiver.statements[0].statements[0],
+                              BlockTerm)
+        self.assertEqual(0, parser.tokens.depth)
+        self.assertTrue(parser.at_end())
+
+    def test_error_leaves_frame(self):
+        from onyx.parser import ParseError
+        parser = self.parser('[ ( a b c: ) ] foo')
+        with self.assertRaises(ParseError):
+            parser.parse_expression()
+        self.assertEqual(0, parser.tokens.depth)
+
+    def test_not_at_end(self):
+        from onyx.parser import ParseError
+        parser = self.parser('(a . b) c')
+        with self.assertRaises(ParseError):
+            parser.parse_expression()
+
+
+class ParsePrimaryInteger(_ParserTestCase, unittest.TestCase):
+    read_string = '42'
+    parse_method = 'primary'
+    term_cls = LiteralTerm
+
+    def check(self):
+        self.assertEqual(42, self.term.value)
+
+
+class ParsePrimaryNegativeInteger(_ParserTestCase, unittest.TestCase):
+    read_string = '-42'
+    parse_method = 'primary'
+    term_cls = LiteralTerm
+
+    def check(self):
+        self.assertEqual(-42, self.term.value)
+
+
+class ParseBinaryMinus(_ParserTestCase, unittest.TestCase):
+    read_string = 'a - 42'
+    parse_method = 'binary'
+    term_cls = BinarySend
+
+    def check(self):
+        self.assertEqual(42, self.term.arguments[0].value)
+
+
+class ParsePrimaryString(_ParserTestCase, unittest.TestCase):
+    read_string = "'foo' size"
+    parse_method = 'primary'
+    term_cls = UnarySend
+
+    def check(self):
+        self.assertEqual(LiteralTerm('foo'), self.term.receiver)
+
+
+class ParseEmptyBlock(_ParserTestCase, unittest.TestCase):
+    read_string = '[ ]'
+    parse_method = 'primary'
+    term_cls = BlockTerm
+
+    def check(self):
+        self.assertEqual([], self.term.statements)
+
+
+class ParseMethodDefinition(_ParserTestCase, unittest.TestCase):
+    read_string = 'at: i put: x [ | old | old := x. ^ old ]'
+    parse_method = 'method_definition'
+    term_cls = MethodTerm
+
+    def check(self):
+        self.assertEqual('at:put:', self.term.selector)
+        self.assertEqual([Identifier('i'), Identifier('x')],
+                         self.term.arguments)
+        self.assertEqual([Identifier('old')], self.term.temporary_variables)
+        self.assertEqual(2, len(self.term.statements))
+        self.assertEqual((0, len(self.read_string)), self.term.span)
+
+
+class ParseClassDefinition(_ParserTestCase, unittest.TestCase):
+    read_string = """Object subclass: Point [
+        | x y |
+        Point class [
+            | origin |
+            x: x y: y [ self new setX: x y: y ]
+        ]
+        x [ x ]
+        + aPoint [ self class x: x + aPoint x y: y + aPoint y ]
+    ]"""
+    parse_method = 'class_definition'
+    term_cls = ClassTerm
+
+    def check(self):
+        self.assertEqual('Point', self.term.name)
+        self.assertEqual('Object', self.term.superclass)
+        self.assertEqual([Identifier('x'), Identifier('y')],
+                         self.term.instance_variables)
+        self.assertEqual(['x', '+'], [m.selector for m in self.term.methods])
+        self.assertEqual([Identifier('origin')],
+                         self.term.class_instance_variables)
+        self.assertEqual(['x:y:'],
+                         [m.selector for m in self.term.class_methods])
+        self.assertEqual((0, len(self.read_string)), self.term.span)
+        start, end = self.term.methods[0].span
+        self.assertEqual('x [ x ]', self.read_string[start:end])
+
+
+class ParseClassDefinitionWrongClassSide(_FailingParserTestCase,
+                                         unittest.TestCase):
+    read_string = 'Object subclass: Point [ Other class [ ] ]'
+    parse_method = 'class_definition'
+
+
+class ParseFile(unittest.TestCase):
+    def parse_file(self, s):
+        from onyx.parser import Parser
+        from onyx.reader import StringReader
+        return Parser(StringReader(s)).parse_file()
+
+    def test_system(self):
+        from onyx.parser import Parser
+        from onyx.reader import StringReader
+        filename = os.path.join(os.path.dirname(__file__), '..',
+                                'system.ost')
+        parser = Parser(StringReader.from_file(filename))
+        definitions = list(parser.parse_file())
+        classes = [d for d in definitions if isinstance(d, ClassTerm)]
+        self.assertEqual(27, len(classes))
+        self.assertEqual(3, len(definitions) - len(classes))
+        self.assertEqual('Object', classes[0].name)
+        self.assertEqual('nil', classes[0].superclass)
+
+    def test_statements(self):
+        definitions = list(self.parse_file(
+            'a := 1. Object subclass: A [ ] b := 2'))
+        self.assertEqual([AssignTerm, ClassTerm, AssignTerm],
+                         [d.__class__ for d in definitions])
+
+    def test_streaming(self):
+        from onyx.reader import ReadError
+        definitions = self.parse_file('Object subclass: A [ ] a b c: )')
+        self.assertEqual('A', next(definitions).name)
+        with self.assertRaises(ReadError):
+            next(definitions)
+
+    def test_missing_period(self):
+        from onyx.parser import ParseError
+        with self.assertRaises(ParseError):
+            list(self.parse_file('a := b c d: e f := 1'))
+
+
+class ParseFileLazy(unittest.TestCase):
+    def parse_file(self, s, lazy_depth=1):
+        from onyx.parser import Parser
+        from onyx.reader import FastReader
+        return list(Parser(FastReader(s, lazy_depth=lazy_depth)).parse_file())
+
+    def test_system(self):
+        filename = os.path.join(os.path.dirname(__file__), '..',
+                                'system.ost')
+        with open(filename) as f:
+            source = f.read()
+        lazy = self.parse_file(source)
+        self.assertFalse(lazy[0].methods[0].is_parsed)
+        self.assertEqual(self.parse_file(source, None), lazy)
+        self.assertTrue(lazy[0].methods[0].is_parsed)
+
+    def test_parse_on_access(self):
+        source = 'Object subclass: A [ A class [ new [ ^ a ] ] foo [ a b ] ]'
+        cls, = self.parse_file(source)
+        foo, = cls.methods
+        new, = cls.class_methods
+        self.assertFalse(foo.is_parsed)
+        self.assertFalse(new.is_parsed)
+        self.assertEqual([UnarySend(Identifier('a'), 'b')], foo.statements)
+        self.assertTrue(foo.is_parsed)
+        self.assertFalse(new.is_parsed)
+        start, end = new.span
+        self.assertEqual('new [ ^ a ]', source[start:end])
+
+    def test_errors_on_access(self):
+        from onyx.parser import ParseError
+        cls, = self.parse_file('Object subclass: A [ foo [ a b: ] ]')
+        with self.assertRaises(ParseError):
+            cls.methods[0].statements
+
+
+class ParseNodePositions(unittest.TestCase):
+    source = 'x := y foo: -1 + (z bar) baz: [:a | a ] ; qux . ^ x'
+
+    def text(self, node):
+        return self.source[node.start:node.end]
+
+    def test_positions(self):
+        from onyx.parser import Parser
+        from onyx.reader import FastReader
+        parser = Parser(FastReader(self.source))
+        _, statements = parser.parse_executable_code()
+        assign, escape = statements
+        self.assertEqual(self.source.split(' .')[0], self.text(assign))
+        self.assertEqual('x', self.text(assign.lhs))
+        cascade = assign.rhs
+        self.assertEqual('y foo: -1 + (z bar) baz: [:a | a ] ; qux',
+                         self.text(cascade))
+        send, qux = cascade.messages
+        self.assertEqual('qux', self.text(qux))
+        minus, block = send.arguments
+        self.assertEqual('-1 + (z bar)', self.text(minus))
+        self.assertEqual('-1', self.text(minus.receiver))
+        self.assertEqual('(z bar)', self.text(minus.arguments[0]))
+        self.assertEqual('[:a | a ]', self.text(block))
+        self.assertEqual(':a', self.text(block.arguments[0]))
+        self.assertEqual('a', self.text(block.statements[0]))
+        self.assertEqual('^ x', self.text(escape))
+
+    def test_method_arguments(self):
+        from onyx.parser import Parser
+        from onyx.reader import FastReader
+        source = 'at: i put: v [ | t | ^ t ]'
+        method = Parser(FastReader(source)).parse_method_definition()
+        self.assertEqual([(4, 5), (11, 12)],
+                         [a.span for a in method.arguments])
+        self.assertEqual((17, 18), method.temporary_variables[0].span)
+        self.assertEqual((0, len(source)), method.span)
+
+
+class ParseErrorPositions(unittest.TestCase):
+    def test_position(self):
+        from onyx.parser import ParseError, Parser
+        from onyx.reader import FastReader
+        parser = Parser(FastReader('Object subclass: A [ foo [ a b: . ] ]'))
+        with self.assertRaises(ParseError) as context:
+            list(parser.parse_file())
+        self.assertEqual(32, context.exception.position)
+
+    def test_located(self):
+        from onyx.cache import parse_source
+        from onyx.parser import ParseError
+        with self.assertRaises(ParseError) as context:
+            parse_source('Object subclass: A [\n  foo [ a b: . ] ]',
+                         filename='a.ost')
+        self.assertEqual('a.ost:2:14: Expected primary',
+                         str(context.exception))
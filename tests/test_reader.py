@@ -1,3 +1,4 @@
+import os
 import unittest
 
 
@@ -343,3 +344,248 @@ class ReadCurrentClassEof(unittest.TestCase):
         self.assert_reader_at_end()
 
 
+class ClassifierTests(unittest.TestCase):
+    def setUp(self):
+        from onyx.reader import _default_classifier
+        self.classifier = _default_classifier
+
+    def test_classify(self):
+        self.assertEqual({'digit', 'idchar'}, self.classifier.classify('7'))
+        self.assertEqual({'binsel', 'idchar'}, self.classifier.classify('!'))
+        self.assertEqual({'eof'}, self.classifier.classify(''))
+        self.assertEqual(set(), self.classifier.classify('#'))
+
+    def test_init_class(self):
+        self.assertEqual('digit', self.classifier.init_class('7'))
+        self.assertEqual('binsel', self.classifier.init_class('!'))
+        self.assertEqual('idchar', self.classifier.init_class('_'))
+        self.assertEqual('eof', self.classifier.init_class(''))
+        self.assertIsNone(self.classifier.init_class('#'))
+
+    def test_non_ascii(self):
+        self.assertEqual({'idchar'}, self.classifier.classify(u'\xe9'))
+        self.assertEqual('idchar', self.classifier.init_class(u'\xe9'))
+        self.assertEqual({'space'}, self.classifier.classify(u'\u3000'))
+
+    def test_recompile_after_add(self):
+        from onyx.reader import Classifier
+        classifier = Classifier()
+        classifier.add_chars('a', ['first'])
+        self.assertEqual({'first'}, classifier.classify('a'))
+        classifier.add_chars('ab', ['second'])
+        self.assertEqual({'first', 'second'}, classifier.classify('a'))
+        self.assertEqual('second', classifier.init_class('b'))
+
+
+class ReaderClassChecks(unittest.TestCase):
+    def setUp(self):
+        from onyx.util.stream import Stream
+        from onyx.reader import Reader
+
+        self.reader = Reader(Stream.from_sequence('a1'))
+
+    def runTest(self):
+        self.assertTrue(self.reader.is_idchar())
+        self.assertFalse(self.reader.is_digit())
+        self.assertFalse(self.reader.is_unknown_class())
+        self.reader.step()
+        self.assertTrue(self.reader.is_digit())
+        self.reader.step()
+        self.assertTrue(self.reader.is_eof())
+        self.assertFalse(self.reader.is_idchar())
+
+
+class _StringReaderTestCase(object):
+    def init_reader(self, s):
+        from onyx.reader import StringReader, ReadError
+        self.reader = StringReader(s)
+        self.ReadError = ReadError
+
+
+class StringReadSpace(_StringReaderTestCase, ReadSpace):
+    pass
+
+
+class StringReadNormalId(_StringReaderTestCase, ReadNormalId):
+    pass
+
+
+class StringReadKeyword(_StringReaderTestCase, ReadKeyword):
+    pass
+
+
+class StringReadComment(_StringReaderTestCase, ReadComment,
+                        unittest.TestCase):
+    pass
+
+
+class StringReadCommentError(_StringReaderTestCase, ReadCommentError):
+    pass
+
+
+class StringReadString(_StringReaderTestCase, ReadString):
+    pass
+
+
+class StringReadStringError(_StringReaderTestCase, ReadStringError):
+    pass
+
+
+class StringReadBinarySelector(_StringReaderTestCase, ReadBinarySelector3):
+    pass
+
+
+class StringReadInteger(_StringReaderTestCase, ReadInteger):
+    pass
+
+
+class StringReadBlockArgument(_StringReaderTestCase, ReadBlockArgument):
+    pass
+
+
+class StringReadTermKeyword(_StringReaderTestCase, ReadTermKeyword):
+    pass
+
+
+class StringReadBlock(_StringReaderTestCase, ReadBlock):
+    pass
+
+
+class StringReadUnterminatedBlock(_StringReaderTestCase,
+                                  ReadUnterminatedBlock):
+    pass
+
+
+class StringReaderFromFile(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        fd, self.filename = tempfile.mkstemp(suffix='.ost')
+        self.file = os.fdopen(fd, 'w')
+
+    def tearDown(self):
+        self.file.close()
+        os.remove(self.filename)
+
+    def read_file(self, contents, use_mmap):
+        from onyx.reader import StringReader
+        self.file.write(contents)
+        self.file.close()
+        reader = StringReader.from_file(self.filename, use_mmap)
+        return [t.value for t in reader]
+
+    def test_mmap(self):
+        self.assertEqual(['foo:', 'bar', 42],
+                         self.read_file('foo: bar "baz" 42', True))
+
+    def test_no_mmap(self):
+        self.assertEqual(['foo:', 'bar', 42],
+                         self.read_file('foo: bar "baz" 42', False))
+
+    def test_empty(self):
+        self.assertEqual([], self.read_file('', True))
+
+
+def term_tree(term):
+    kinds = [name for name in dir(term)
+             if name.startswith('is_') and getattr(term, name)]
+    if term.is_compound:
+        return (kinds, term.start, term.end, term.shape,
+                [term_tree(t) for t in term.value])
+    return kinds, term.start, term.end, term.value
+
+
+def read_all(reader):
+    from onyx.reader import ReadError
+    trees = []
+    try:
+        while True:
+            term = reader.read_term()
+            trees.append(term_tree(term))
+            if term.is_eof:
+                return trees
+    except ReadError as e:
+        trees.append(('error', str(e)))
+        return trees
+
+
+class FastReaderDifferential(unittest.TestCase):
+    def check(self, source):
+        from onyx.reader import FastReader, StringReader
+        from onyx.util.stream import Stream
+        from onyx.reader import Reader
+
+        expected = read_all(Reader(Stream.from_sequence(source)))
+        self.assertEqual(expected, read_all(StringReader(source)))
+        self.assertEqual(expected, read_all(FastReader(source)))
+
+    def test_system(self):
+        filename = os.path.join(os.path.dirname(__file__), '..',
+                                'system.ost')
+        with open(filename) as f:
+            self.check(f.read())
+
+    def test_corpus(self):
+        corpus = set(value.read_string for value in globals().values()
+                     if isinstance(getattr(value, 'read_string', None), str))
+        self.assertTrue(corpus)
+        for source in sorted(corpus):
+            self.check(source)
+
+    def test_edge_cases(self):
+        for source in [u'caf\xe9 au: lait', u'a\u3000b', u'[ a\u3000]',
+                       'a:=b', ':a:', ': a', '#', '"open', "'open",
+                       '[ ( ] )', '[ [ ]', ')', '123abc', 'a!b? !b',
+                       'x := [:y | y + 1]', '{ 1. 2 }']:
+            self.check(source)
+
+
+class ReadTermPositions(unittest.TestCase):
+    def check(self, reader):
+        outer = reader.read_term()
+        self.assertEqual((2, 20), (outer.start, outer.end))
+        a, inner = outer.value
+        self.assertEqual((2, 3), (a.start, a.end))
+        self.assertEqual((4, 12), (inner.start, inner.end))
+        self.assertEqual((2, 6), (inner.value[0].start, inner.value[0].end))
+        self.assertEqual('foo:', inner.value[0].value)
+        eof = reader.read_term()
+        self.assertEqual((22, 22), (eof.start, eof.end))
+
+    def test_positions(self):
+        from onyx.reader import FastReader, Reader, StringReader
+        from onyx.util.stream import Stream
+        source = '  [ a ( foo: ) "x" ]  '
+        self.check(Reader(Stream.from_sequence(source)))
+        self.check(StringReader(source))
+        self.check(FastReader(source))
+
+
+class ReadErrorPositions(unittest.TestCase):
+    def check(self, source, position):
+        from onyx.reader import FastReader, Reader, ReadError, StringReader
+        from onyx.util.stream import Stream
+        readers = [Reader(Stream.from_sequence(source)), StringReader(source),
+                   FastReader(source), FastReader(source, lazy_depth=0)]
+        for reader in readers:
+            with self.assertRaises(ReadError) as context:
+                while not reader.read_term().is_eof:
+                    pass
+            self.assertEqual(position, context.exception.position)
+
+    def test_string(self):
+        self.check("a 'abc", 2)
+
+    def test_comment(self):
+        self.check('a "abc', 2)
+
+    def test_compound(self):
+        self.check('[ a ( b ]', 8)
+
+    def test_unbalanced(self):
+        self.check('a ]', 2)
+
+    def test_eof_in_compound(self):
+        self.check('[ a ( b', 4)
+
+    def test_block_keyword(self):
+        self.check('a :b: c', 2)
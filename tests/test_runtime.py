@@ -0,0 +1,84 @@
+import unittest
+
+from onyx.runtime import Class, MethodCache
+
+
+class FakeMethod(object):
+    def __init__(self, selector):
+        self.selector = selector
+
+
+class MethodCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.cache = MethodCache(8)
+        self.root = Class('Root')
+        self.child = Class('Child', self.root)
+        self.other = Class('Other', self.root)
+        self.foo = FakeMethod('foo')
+        self.root.define_method(self.foo)
+
+    def test_hit_and_miss(self):
+        self.assertIs(self.cache.lookup(self.child, 'foo'), self.foo)
+        self.assertIs(self.cache.lookup(self.child, 'foo'), self.foo)
+        self.assertIsNone(self.cache.lookup(self.child, 'bar'))
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['size']),
+                         (1, 2, 1))
+
+    def test_define_invalidates_subclasses_only(self):
+        for cls in self.root, self.child, self.other:
+            self.cache.lookup(cls, 'foo')
+        override = FakeMethod('foo')
+        self.child.define_method(override)
+        self.assertEqual(self.cache.invalidations, 1)
+        self.assertIs(self.cache.lookup(self.child, 'foo'), override)
+        self.assertIs(self.cache.lookup(self.other, 'foo'), self.foo)
+        self.assertEqual(self.cache.misses, 4)
+
+        self.child.remove_method('foo')
+        self.assertIs(self.cache.lookup(self.child, 'foo'), self.foo)
+
+    def test_superclass_change(self):
+        other_root = Class('OtherRoot')
+        bar = FakeMethod('foo')
+        other_root.define_method(bar)
+        self.cache.lookup(self.child, 'foo')
+        self.cache.lookup(self.other, 'foo')
+        self.child.set_superclass(other_root)
+        self.assertEqual(len(self.cache), 1)
+        self.assertIs(self.cache.lookup(self.child, 'foo'), bar)
+
+    def test_clock_eviction(self):
+        classes = [Class('C{0}'.format(i), self.root) for i in range(12)]
+        for cls in classes[:8]:
+            self.cache.lookup(cls, 'foo')
+        # referenced entries survive a sweep
+        self.cache.lookup(classes[0], 'foo')
+        for cls in classes[8:]:
+            self.cache.lookup(cls, 'foo')
+        self.assertEqual(len(self.cache), 8)
+        self.assertEqual(self.cache.evictions, 4)
+        hits = self.cache.hits
+        self.cache.lookup(classes[0], 'foo')
+        self.cache.lookup(classes[11], 'foo')
+        self.assertEqual(self.cache.hits, hits + 2)
+        self.cache.clear()
+        self.assertEqual(len(self.cache), 0)
+
+
+class InterpreterCacheTests(unittest.TestCase):
+    def test_redefinition(self):
+        from onyx.interpreter import Interpreter
+        from .test_interpreter import system_definitions
+        cache = MethodCache()
+        interpreter = Interpreter(method_cache=cache)
+        interpreter.execute(system_definitions())
+        interpreter.load_source('Object subclass: A [ foo [ 1 ] ]\n'
+                                'A subclass: B [ ]')
+        self.assertEqual(interpreter.evaluate('B new foo'), 1)
+        misses = cache.misses
+        self.assertEqual(interpreter.evaluate('B new foo'), 1)
+        self.assertEqual(cache.misses, misses)
+        interpreter.load_source('Object subclass: A [ foo [ 2 ] ]')
+        self.assertEqual(interpreter.evaluate('B new foo'), 2)
+        self.assertGreater(cache.invalidations, 0)
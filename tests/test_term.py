@@ -0,0 +1,75 @@
+import unittest
+
+from onyx.term import (BlockTerm, Identifier, KeywordSend, NodeError,
+                       NodeTable, UnarySend)
+
+
+def parse(s):
+    from onyx.parser import Parser
+    from onyx.reader import StringReader
+    return Parser(StringReader(s)).parse_expression()
+
+
+class NodeEqualityTests(unittest.TestCase):
+    def test_structural_equality(self):
+        self.assertEqual(parse('a foo: [ b bar ]'), parse('a foo: [ b bar ]'))
+        self.assertNotEqual(parse('a foo: [ b bar ]'),
+                            parse('a foo: [ b baz ]'))
+
+    def test_different_classes(self):
+        self.assertNotEqual(UnarySend(Identifier('a'), 'b'),
+                            KeywordSend(Identifier('a'), 'b'))
+
+    def test_frozen_equals_unfrozen(self):
+        self.assertEqual(parse('a + b').freeze(), parse('a + b'))
+
+    def test_unfrozen_is_unhashable(self):
+        with self.assertRaises(TypeError):
+            hash(Identifier('a'))
+
+    def test_hash(self):
+        self.assertEqual(hash(parse('a foo: b; bar').freeze()),
+                         hash(parse('a foo: b; bar').freeze()))
+
+
+class FreezeTests(unittest.TestCase):
+    def setUp(self):
+        self.node = parse('[:x | x foo: y ]').freeze()
+
+    def test_is_frozen(self):
+        self.assertTrue(self.node.is_frozen)
+        self.assertTrue(self.node.statements[0].is_frozen)
+
+    def test_lists_become_tuples(self):
+        self.assertIsInstance(self.node, BlockTerm)
+        self.assertIsInstance(self.node.arguments, tuple)
+        self.assertIsInstance(self.node.statements[0].arguments, tuple)
+
+    def test_cannot_modify(self):
+        with self.assertRaises(NodeError):
+            self.node.statements = ()
+        with self.assertRaises(NodeError):
+            self.node.statements[0].message = 'bar:'
+
+
+class NodeTableTests(unittest.TestCase):
+    def test_shares_subtrees(self):
+        table = NodeTable()
+        a = table.intern(parse('self foo: [ false ]'))
+        b = table.intern(parse('self bar: [ false ]'))
+        self.assertIsNot(a, b)
+        self.assertIs(a.receiver, b.receiver)
+        self.assertIs(a.arguments[0], b.arguments[0])
+
+    def test_shares_equal_trees(self):
+        table = NodeTable()
+        a = table.intern(parse('self foo: [ false ]'))
+        size = len(table)
+        self.assertIs(a, table.intern(parse('self foo: [ false ]')))
+        self.assertEqual(size, len(table))
+
+    def test_frozen_node(self):
+        table = NodeTable()
+        a = table.intern(parse('self foo'))
+        b = table.intern(parse('self foo').freeze())
+        self.assertIs(a, b)
@@ -0,0 +1,232 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from onyx.compiler import (PUSH_NAME, CompiledCode, Compiler,
+                           compile_definitions, compiled_path)
+from onyx.parser import Parser
+from onyx.reader import FastReader
+from onyx.pycompiler import FunctionBlock
+from onyx.runtime import Class, OnyxError
+from onyx.vm import Closure, VirtualMachine
+
+from tests import test_interpreter
+
+
+def compile_method(source):
+    return Compiler().compile_method(
+        Parser(FastReader(source)).parse_method_definition())
+
+
+class CompilerTests(unittest.TestCase):
+    def instructions(self, code):
+        return [(name,) + operands
+                for _, name, operands in code.instructions()]
+
+    def test_method(self):
+        code = compile_method('at: i put: v [ | t | t := v. ^ items at: i ]')
+        self.assertEqual((code.argument_count, code.temporary_count), (2, 1))
+        self.assertEqual(self.instructions(code), [
+            ('PUSH_TEMP', 1), ('STORE_TEMP', 2), ('POP',),
+            ('PUSH_NAME', 0), ('PUSH_TEMP', 0), ('TAIL_SEND', 0, 1)])
+        self.assertEqual(code.names, ('items',))
+        self.assertEqual([site.message for site in code.sites], ['at:'])
+
+    def test_blocks_and_cascades(self):
+        code = compile_method(
+            'foo: x [ ^ self bar; baz: [:y | ^ x + y + 1 ] ]')
+        self.assertEqual(self.instructions(code), [
+            ('PUSH_SELF',), ('DUP',), ('SEND', 0, 0), ('POP',),
+            ('MAKE_BLOCK', 0), ('SEND', 1, 1), ('RETURN',)])
+        # the block is only passed down, so runs in the method's frame,
+        # where y is the second local
+        block = code.blocks[0]
+        self.assertEqual((block.base, code.temporary_count), (1, 1))
+        self.assertEqual(self.instructions(block), [
+            ('PUSH_TEMP', 0), ('PUSH_TEMP', 1), ('SEND', 0, 1),
+            ('PUSH_LITERAL', 0), ('SEND', 1, 1), ('RETURN_HOME',)])
+        self.assertEqual(block.literals, (1,))
+
+    def test_escaping_blocks(self):
+        # stored or returned, or with a block inside using its variables
+        for source in ('foo: x [ b := [:y | x + y ] ]',
+                       'foo: x [ ^ [:y | x + y ] ]',
+                       'foo: x [ self bar: [:y | [ x + y ] ] ]'):
+            code = compile_method(source)
+            self.assertIsNone(code.blocks[0].base)
+            self.assertEqual(code.temporary_count, 0)
+        self.assertEqual(self.instructions(code.blocks[0].blocks[0])[:2], [
+            ('PUSH_OUTER', 2, 0), ('PUSH_OUTER', 1, 0)])
+
+    def test_tail_sends(self):
+        # not a method that a block can ^ return from, nor super sends
+        code = compile_method('foo [ ^ self bar: [ ^ 1 ] ]')
+        self.assertEqual(self.instructions(code)[-2:],
+                         [('SEND', 0, 1), ('RETURN',)])
+        code = compile_method('foo [ super foo ]')
+        self.assertEqual(self.instructions(code)[-2:],
+                         [('SUPER_SEND', 0, 0), ('RETURN',)])
+        # but blocks' are, other than a ^
+        code = compile_method('foo [ [ self bar. self bar ] ]')
+        self.assertEqual(self.instructions(code.blocks[0]), [
+            ('PUSH_SELF',), ('SEND', 0, 0), ('POP',),
+            ('PUSH_SELF',), ('TAIL_SEND', 1, 0)])
+
+    def test_empty_body_and_pseudo_variables(self):
+        self.assertEqual(self.instructions(compile_method('foo [ ]')),
+                         [('PUSH_NIL',), ('RETURN',)])
+        with self.assertRaises(OnyxError):
+            compile_method('foo [ self := 3 ]')
+
+    def test_inlined_sends(self):
+        # the branches return from the method themselves
+        code = compile_method('foo: x [ ^ x ifTrue: [ 1 ] ifFalse: [ bar ] ]')
+        self.assertEqual(self.instructions(code), [
+            ('PUSH_TEMP', 0), ('JUMP_FALSE', 8, 11), ('PUSH_LITERAL', 0),
+            ('RETURN',), ('PUSH_NAME', 0), ('RETURN',),
+            ('MAKE_BLOCK', 0), ('MAKE_BLOCK', 1), ('TAIL_SEND', 0, 2)])
+        # a to:do:'s variable, end and step are temporaries
+        code = compile_method(
+            'foo: n [ | s | s := 0. 1 to: n do: [:i | s := s + i ]. ^ s ]')
+        self.assertEqual(code.temporary_count, 4)
+        self.assertEqual(self.instructions(code)[5:14], [
+            ('FOR_PREP', 2, 31), ('FOR_LOOP', 2, 28), ('PUSH_TEMP', 1),
+            ('PUSH_TEMP', 2), ('SEND', 0, 1), ('STORE_TEMP', 1), ('POP',),
+            ('FOR_NEXT', 2, 12), ('PUSH_NIL',)])
+        # not blocks with temporaries, nor loops whose variable a block
+        # captures
+        for source in ('foo [ x ifTrue: [ | t | t ] ]',
+                       'foo [ x ifTrue: y ]',
+                       'foo [ 1 to: 3 do: [:i | [ i ] ] ]'):
+            code = compile_method(source)
+            self.assertEqual(self.instructions(code)[-1][0], 'TAIL_SEND')
+
+    def test_encode(self):
+        code = compile_method("foo [ ^ [:a | a , 'x' ] value: Bar ]")
+        decoded = CompiledCode.decode(code.encode())
+        self.assertEqual(decoded.bytecode, code.bytecode)
+        self.assertEqual(decoded.encode(), code.encode())
+        self.assertIsNot(decoded.sites[0], code.sites[0])
+        self.assertEqual(list(decoded.instructions()),
+                         list(code.instructions()))
+        self.assertEqual(decoded.bytecode[2], PUSH_NAME)
+
+
+class VirtualMachineTestCase(object):
+    interpreter_class = VirtualMachine
+
+
+class VMBootstrapTests(VirtualMachineTestCase,
+                       test_interpreter.BootstrapTests):
+    pass
+
+
+class VMEvaluateTests(VirtualMachineTestCase,
+                      test_interpreter.EvaluateTests):
+    def test_blocks_are_closures(self):
+        self.assertIsInstance(self.evaluate('[ 3 ]'), Closure)
+        self.assertEqual(self.evaluate(
+            '| a | a := 1. [:b | a := a + b ] value: 2. a'), 3)
+        self.assertEqual(self.interpreter.stack_trace(), [])
+
+
+class VMExceptionTests(VirtualMachineTestCase,
+                       test_interpreter.ExceptionTests):
+    pass
+
+
+class PythonTestCase(VirtualMachineTestCase):
+    def setUp(self):
+        super(PythonTestCase, self).setUp()
+        for name, value in self.interpreter.globals.items():
+            if isinstance(value, Class):
+                self.interpreter.use_python(name)
+
+    def load(self, source):
+        super(PythonTestCase, self).load(source)
+        for name, value in self.interpreter.globals.items():
+            if isinstance(value, Class):
+                self.interpreter.use_python(name)
+
+
+class PythonEvaluateTests(PythonTestCase, test_interpreter.EvaluateTests):
+    def test_blocks_are_functions(self):
+        self.interpreter.load_source('''\
+Object subclass: Counter [
+    | count |
+    count [ count ]
+    countTo: n [ | i | i := 0. [ i < n ] whileTrue: [ i := i + 1 ]. ^ i ]
+    increment [
+        count isNil ifTrue: [ count := 0 ].
+        count := count + 1.
+        ^ [ count ]
+    ]
+    firstOver: n in: c [ c do: [:e | e > n ifTrue: [ ^ e ] ]. ^ nil ]
+]
+''')
+        self.interpreter.use_python('Counter')
+        self.assertEqual(self.evaluate('Counter new countTo: 50'), 50)
+        self.assertIsInstance(self.evaluate('Counter new increment'),
+                              FunctionBlock)
+        self.assertEqual(self.evaluate(
+            '| c | c := Counter new. c increment. c increment value'), 2)
+        self.assertEqual(self.evaluate(
+            '| c | c := OrderedCollection new. c add: 1; add: 5; add: 7. '
+            'Counter new firstOver: 2 in: c'), 5)
+        counter = self.interpreter.globals['Counter']
+        self.assertIsNotNone(counter.methods['countTo:'].function)
+
+    def test_switch(self):
+        self.interpreter.use_python('Object', False)
+        self.evaluate('nil isNil')
+        self.assertIsNone(
+            self.interpreter.globals['Object'].methods['isNil'].function)
+        self.assertTrue(self.interpreter.globals['UndefinedObject'].methods[
+            'isNil'].function)
+
+
+class PythonExceptionTests(PythonTestCase, test_interpreter.ExceptionTests):
+    pass
+
+
+class CountingCompiler(Compiler):
+    def __init__(self):
+        super(CountingCompiler, self).__init__()
+        self.count = 0
+
+    def compile_body(self, *args):
+        self.count += 1
+        return super(CountingCompiler, self).compile_body(*args)
+
+
+class CompiledCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'test.ost')
+        shutil.copy(test_interpreter.SYSTEM, self.filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_load_file(self):
+        compiler = CountingCompiler()
+        VirtualMachine(compiler=compiler).load_file(self.filename)
+        self.assertGreater(compiler.count, 0)
+        self.assertTrue(os.path.exists(compiled_path(self.filename)))
+        # the second load compiles nothing
+        compiler = CountingCompiler()
+        vm = VirtualMachine(compiler=compiler)
+        vm.load_file(self.filename)
+        self.assertEqual(compiler.count, 0)
+        self.assertIsNotNone(vm.globals['Object'].methods['isNil'].code)
+        self.assertEqual(vm.evaluate('-5 sign'), -1)
+        self.assertEqual(compiler.count, 1)
+
+    def test_compile_definitions(self):
+        definitions = test_interpreter.system_definitions()
+        compiled = compile_definitions(definitions)
+        self.assertEqual(len(compiled), len(definitions))
+        methods, class_methods = compiled[0]
+        self.assertEqual(set(methods),
+                         set(m.selector for m in definitions[0].methods))